@@ -0,0 +1,194 @@
+import asyncio
+import threading
+from typing import Callable, Optional
+import communication
+import errors
+from portforwarding import PortForwarder
+from tickscheduler import TickScheduler
+
+PORT_FORWARDING_UPDATE_INTERVAL = 0.1 # in seconds
+
+# alternative to the threaded endpoints in communication.py:
+# receiving, resend timers and port forwarding all run on one asyncio event loop (in its own thread),
+# instead of a thread each. The public API is the same, and other threads may still send and poll messages.
+# work that should not race with receiving (e.g. GameServer ticks) can be run on the loop with run_tick_scheduler
+
+class EndpointProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, endpoint: communication.CommunicationEndpoint):
+        self.endpoint = endpoint
+
+    def datagram_received(self, data: bytes, addr):
+        self.endpoint.handle_packet(data, addr)
+
+    def error_received(self, exc: Exception):
+        print(f"WARNING: Socket error on the event loop. {type(exc).__name__}: {exc}")
+
+# mixin for subclasses of communication.CommunicationEndpoint. Call init_event_loop at the end of __init__
+class AsyncioEndpoint:
+
+    def init_event_loop(self: "AsyncioCommunicationServer | AsyncioInternetCommunicationClient", thread_name: str):
+        assert self.message_socket != None, "the event loop needs a UDP socket"
+        self.event_loop = asyncio.new_event_loop()
+        self.resend_timer: Optional[asyncio.TimerHandle] = None
+
+        # the event loop replaces the receive and resend threads
+        self.threads = []
+        self.add_thread(threading.Thread(target=self.event_loop_mainloop, daemon=True), thread_name)
+        self.unconfirmed_message_storage.on_wake = lambda: self.call_soon_threadsafe(self.on_resend_timer)
+
+    def event_loop_mainloop(self: "AsyncioCommunicationServer | AsyncioInternetCommunicationClient"):
+        asyncio.set_event_loop(self.event_loop)
+        transport, _ = self.event_loop.run_until_complete(
+            self.event_loop.create_datagram_endpoint(lambda: EndpointProtocol(self), sock=self.message_socket)
+        )
+        self.start_event_loop_tasks()
+        self.on_resend_timer()
+
+        self.event_loop.run_forever()
+        transport.close()
+
+    def start_event_loop_tasks(self):
+        pass
+
+    def on_resend_timer(self: "AsyncioCommunicationServer | AsyncioInternetCommunicationClient"):
+        if self.resend_timer != None:
+            self.resend_timer.cancel()
+
+        max_sleep = self.run_resend_iteration()
+        delay = self.unconfirmed_message_storage.get_time_until_next_deadline(max_sleep)
+        self.resend_timer = self.event_loop.call_later(delay, self.on_resend_timer)
+
+    def call_soon_threadsafe(self: "AsyncioCommunicationServer | AsyncioInternetCommunicationClient", callback: Callable, *args):
+        if self.running and not self.event_loop.is_closed():
+            self.event_loop.call_soon_threadsafe(callback, *args)
+
+    # runs the ticks of scheduler on the event loop, as long as is_active returns true (see tickscheduler.py).
+    # A tick that raises is logged, and the ticks after it still run
+    def run_tick_scheduler(self: "AsyncioCommunicationServer | AsyncioInternetCommunicationClient", scheduler: TickScheduler, is_active: Callable[[], bool]):
+        def run():
+            if not (self.running and is_active()):
+                return
+
+            delay = 0.0
+            try:
+                delay = scheduler.run_due_ticks()
+            except Exception as exception:
+                errors.log_nonfatal(exception)
+            self.event_loop.call_later(delay, run)
+
+        self.call_soon_threadsafe(run)
+
+    # the endpoint may still send (e.g. a DisconnectMessage) before the event loop stops
+    def stop(self: "AsyncioCommunicationServer | AsyncioInternetCommunicationClient", asyncronous = False):
+        super().stop(asyncronous=True)
+        self.event_loop.call_soon_threadsafe(self.event_loop.stop)
+
+        if not asyncronous:
+            for thread in self.threads:
+                thread.join()
+
+class AsyncioCommunicationServer(AsyncioEndpoint, communication.CommunicationServer):
+
+    def __init__(self, private_address: tuple[str, int], external_address: Optional[tuple[str, int]] = None, start = False, multicast_address: Optional[tuple[str, int]] = None):
+        communication.CommunicationServer.__init__(self, private_address, external_address, start=False, multicast_address=multicast_address)
+        self.init_event_loop("async-comm-server")
+
+        if start:
+            self.start()
+
+    def start_event_loop_tasks(self):
+        if self.external_address != None:
+            self.event_loop.create_task(self.port_forwarding_task())
+
+    # the UPnP calls block, so they are run in the default executor
+    async def port_forwarding_task(self):
+        assert self.external_address != None
+        forwarder = await self.event_loop.run_in_executor(None, PortForwarder, self.private_address[0], self.private_address[1], self.external_address[0], self.external_address[1])
+
+        while self.running:
+            await self.event_loop.run_in_executor(None, forwarder.update)
+            await asyncio.sleep(PORT_FORWARDING_UPDATE_INTERVAL)
+
+class AsyncioInternetCommunicationClient(AsyncioEndpoint, communication.InternetCommunicationClient):
+
+    def __init__(self, own_address, server_address, start = False):
+        communication.InternetCommunicationClient.__init__(self, own_address, server_address, start=False)
+        self.init_event_loop("async-inet-comm-client")
+
+        if start:
+            self.start()
+
+# compares the threaded and the asyncio server on loopback: how many packets per second they handle, while clients
+# send at the given rate (packets per second per client), and how late the ticks run meanwhile (the tick jitter).
+# The clients run in the same process, so at high rates they compete with the server for the interpreter
+if __name__ == "__main__":
+    import sys
+    from time import perf_counter, sleep
+    from pymunk import Vec2d
+    import messages
+
+    CLIENT_COUNT = 4
+    DURATION = 4 # in seconds, shorter than the statistics window
+    TICK_RATE = 50
+    rates = [int(a) for a in sys.argv[1:]] if len(sys.argv) > 1 else [250, 1000, 4000]
+
+    def send_mouse_positions(client: communication.InternetCommunicationClient, rate: int, is_running: Callable[[], bool]):
+        next_send_time = perf_counter()
+        while is_running():
+            client.send(messages.MousePositionUpdate(Vec2d(1, 2)))
+            next_send_time += 1 / rate
+            delay = next_send_time - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+    def benchmark(server_type: type, rate: int) -> tuple[float, dict]:
+        server = server_type(("127.0.0.1", 0), start=True)
+        server_address = server.message_socket.getsockname()
+        clients = [communication.InternetCommunicationClient(("127.0.0.1", 0), server_address, start=True) for _ in range(CLIENT_COUNT)]
+        for client in clients:
+            client.send_reliable(messages.JoinGameMessage("benchmark"))
+        while len(server.connected_players) < CLIENT_COUNT:
+            sleep(0.01)
+
+        # a tick like the game server's: handle the messages, and send everyone a snapshot
+        state_messages = [messages.BulletStateUpdate(i, Vec2d(i / 10, 0), 0.1) for i in range(50)]
+        def tick():
+            server.poll_messages()
+            for i, state_message in enumerate(state_messages):
+                state_message.position = Vec2d((i + scheduler.statistics.tick_count) / 10 % 20, 0)
+            server.send_snapshot_to_all(state_messages)
+            server.flush()
+        scheduler = TickScheduler(TICK_RATE, tick)
+
+        is_running = True
+        if isinstance(server, AsyncioEndpoint):
+            server.run_tick_scheduler(scheduler, lambda: is_running)
+        else:
+            threading.Thread(target=scheduler.run, args=(lambda: is_running,), daemon=True).start()
+        sender_threads = [threading.Thread(target=send_mouse_positions, args=(client, rate, lambda: is_running)) for client in clients]
+        for thread in sender_threads:
+            thread.start()
+
+        start_counts = {player.id: player.statistics.received_packets.get_count() for player in server.connected_players.values()}
+        sleep(DURATION)
+        handled_count = sum(player.statistics.received_packets.get_count() - start_counts[player.id] for player in server.connected_players.values())
+        is_running = False
+
+        for thread in sender_threads:
+            thread.join()
+        for client in clients:
+            client.stop(asyncronous=True) # the receiving threads are daemons, blocked until the process exits
+        server.stop(asyncronous=True)
+        return handled_count / DURATION, scheduler.get_statistics()
+
+    # printed at the end, so that the warnings of the endpoints don't get mixed in
+    results = []
+    for rate in rates:
+        results.append(f"{CLIENT_COUNT} clients, {rate} packets/s each:")
+        for name, server_type in (("threaded", communication.CommunicationServer), ("asyncio", AsyncioCommunicationServer)):
+            packets_per_second, tick_statistics = benchmark(server_type, rate)
+            lateness = tick_statistics["lateness_ms"]
+            results.append(f"  {name}: {packets_per_second:.0f} packets/s handled, tick lateness p50 {lateness['p50']:.2f} ms, p99 {lateness['p99']:.2f} ms, {tick_statistics['total_skipped_ticks']} ticks skipped")
+    sleep(0.1)
+    print("\n".join(results))
@@ -1,193 +1,1257 @@
 import socket
+import select
 import threading
 from thread_owner import ThreadOwner
-import pickle
 import messages
-from random import random
+import wirecodec
+import snapshot
+import networkstatistics
+import compression
+import fec
+import ratelimiting
+from random import random, randrange
 from abc import ABC, abstractmethod
 from typing import Optional, Callable
-from dataclasses import dataclass, field
+from collections import deque, OrderedDict
+import heapq
+from dataclasses import dataclass
+from contextlib import contextmanager
 from time import time, sleep
 from objectid import ObjectId, get_new_object_id
+import itertools
 from portforwarding import PortForwarder
 
 RELIABLE_MESSAGE_INITIAL_SEND_COUNT = 2
-RELIABLE_MESSAGE_ID_STORAGE_SIZE = 1024
-RELIABLE_MESSAGE_RESEND_DELAY = 30 #in milli seconds
-RESEND_MESSAGE_RESEND_ITERATION_DELAY = 15
+RELIABLE_FEC_ENABLED = False # if true, reliable messages are sent once, protected by parity packets instead (see fec.py)
+RECEIVED_SEQUENCE_WINDOW_SIZE = 1024 # how far behind the newest received sequence number duplicates are detected
+INITIAL_RETRANSMISSION_TIMEOUT = 100 # in milli seconds, used until the round trip time has been measured
+MIN_RETRANSMISSION_TIMEOUT = 30 # in milli seconds
+MAX_RETRANSMISSION_TIMEOUT = 3000 # in milli seconds, also caps the exponential backoff
+RTT_SMOOTHING = 1/8 # weight of a new round trip time sample
+RTT_VARIANCE_SMOOTHING = 1/4
+RESEND_THREAD_MAX_SLEEP = 100 # in milli seconds
+ACK_DELAY = 10 # in milli seconds, if no packet has carried the acks by then, a packet without messages is sent
+MAX_EXTRA_ACKS_PER_PACKET = 32
+MAX_PACKET_SIZE = 1200 # in bytes, stays below common MTUs so that IP doesn't fragment the packets
+MAX_BATCH_DELAY = 20 # in milli seconds, queued messages are sent at latest after this even if nobody flushes
+MAX_PACKET_DATA_SIZE = MAX_PACKET_SIZE - 64 # leaves room for the packet header
+RECEIVE_BUFFER_SIZE = 16_384 # in bytes, bigger datagrams are truncated (and dropped as malformed)
+RECEIVE_BATCH_SIZE = 32 # how many datagrams are taken from the socket at once, at most
+RELIABLE_MESSAGE_OVERHEAD = 6 # in bytes, ReliableMessage tag and sequence number
+MAX_UNFRAGMENTED_MESSAGE_SIZE = MAX_PACKET_DATA_SIZE - RELIABLE_MESSAGE_OVERHEAD # bigger reliable messages are split into MessageFragments
+FRAGMENT_OVERHEAD = 16 # in bytes, MessageFragment fields and a possible MessageToServerWithId around it
+MAX_FRAGMENT_DATA_SIZE = MAX_UNFRAGMENTED_MESSAGE_SIZE - FRAGMENT_OVERHEAD
+MAX_FRAGMENT_COUNT = 256 # per message, bounds how much memory a peer can make the receiver reserve
+MAX_PARTIAL_MESSAGES_PER_CONNECTION = 8 # incomplete fragmented messages, the oldest is forgotten when there are more
+MIN_SNAPSHOT_RATE = 4 # snapshots per second, a congested client gets at least this many
+MAX_SNAPSHOT_RATE = 60 # snapshots per second, above the tick rate, so an uncongested client gets every tick
+SNAPSHOT_RATE_INCREASE = 4 # snapshots per second, added after every congestion free period
+SNAPSHOT_RATE_DECREASE = 1/2 # multiplier of the snapshot rate after a congested period
+CONGESTION_LOSS_THRESHOLD = 0.05 # fraction of unacked snapshots, above which a period counts as congested
+CONGESTION_RTT_THRESHOLD = 2 # the round trip time is congested, if it grows above this times the lowest seen
+MIN_CONGESTION_PERIOD = 250 # in milli seconds. A period is at least a round trip time
+MAX_RETRANSMISSION_BACKOFF = 4 # retransmission timeouts are multiplied by up to this much under congestion
+HEARTBEAT_INTERVAL = 1000 # in milli seconds, a packet without messages is sent if nothing else has been sent for this long
+CONNECTION_TIMEOUT = 5000 # in milli seconds, a peer that hasn't sent anything for this long is disconnected
+DISCONNECT_MESSAGE_SEND_COUNT = 3 # the disconnect message isn't reliable (no one waits for the ack), so it's sent a few times
+MAX_UNCONFIRMED_MESSAGES_PER_CONNECTION = 512 # above this, the oldest unconfirmed message of the connection is dropped
+SATURATION_THRESHOLD = 1/2 # of MAX_UNCONFIRMED_MESSAGES_PER_CONNECTION, above which senders should hold back (see is_saturated)
+MAX_RESEND_COUNT = 16 # a reliable message is dropped after this many resends
+MAX_UNCONFIRMED_AGE = 15000 # in milli seconds, a reliable message is dropped if it hasn't been confirmed by then
+DEPARTED_PLAYER_MEMORY = 256 # how many disconnected players are remembered, so that their later packets are dropped
+DEFAULT_TICK_BYTE_BUDGET = 2 * MAX_PACKET_SIZE # how much scheduled data (snapshots, scheduled reliables) a client gets per tick
+DEFAULT_MULTICAST_GROUP = "239.255.56.75" # in the organization-local scope (RFC 2365), which routers don't forward out of the site
+MULTICAST_TTL = 1 # multicast packets don't leave the LAN
+UNHANDLED_MESSAGE_WARNING_THRESHOLD = 100 # polling warns, if more received messages are left unhandled
+MAX_QUEUED_MESSAGES_PER_PLAYER = 64 # unpolled messages to the game, more are dropped (see ratelimiting.py for the rates)
+MULTICAST_ACK_TIMEOUT = 2000 # in milli seconds, a subscriber that hasn't acked a multicast snapshot for this long gets unicast snapshots again
 
 # reliable communication protocol:
 # at first, the message (ReliableMessage) is sent multiple times
-# if the receiver receives the message, it sends a confirmation (MessageConfirmation)
-# the message is resent on regular intervals, until a confirmation is received
-# the receiver remembers recently received messages (by id), and only acts on the first message (confirmation is always sent)
-
+# the receiver acknowledges messages in the header of every packet it sends to the sender (wirecodec.AckHeader):
+# the newest received sequence number, and a bitfield of the 32 previous ones. Older duplicates are acked explicitly
+# if no packet is going out within ACK_DELAY, a packet with only the header is sent
+# the message is resent until a confirmation is received, or until it's given up on (too many resends, too old,
+# or too many unconfirmed messages for the same connection). Giving up is reported in the statistics.
+# A message sent with a supersede key replaces the unconfirmed message with the same key (e.g. an older lobby state),
+# and senders can check is_saturated to skip what they can, while the peer is behind. The resend timeout is computed from the smoothed round trip time
+# and its variance (like TCP, RFC 6298), and doubled after every resend of the same message
+# every connection numbers its reliable messages with increasing sequence numbers
+# the receiver remembers which of the recent sequence numbers it has received (ReceivedSequenceWindow),
+# and only acts on the first message (ack is always sent)
+
+# fragmentation:
+# a reliable message that doesn't fit into one packet is encoded, and split into MessageFragments, which are sent as
+# separate reliable messages (so only the lost fragments are resent). The receiver collects the fragments per connection
+# (FragmentReassembler), and handles the message when the last one arrives. Client to server fragments are wrapped in
+# MessageToServerWithId like everything else the client sends
+
+# batching:
+# a packet contains one or more messages. The server queues everything it sends to a client during a tick
+# into an OutgoingPacketBatch, which is flushed at the end of the tick as few MAX_PACKET_SIZE sized packets
+
+# bandwidth budget:
+# per tick, each client gets at most tick_byte_budget bytes of entity deltas and scheduled reliable messages.
+# Every candidate has a priority, which is added to its accumulated priority every tick it's a candidate.
+# The tick is filled greedily in order of accumulated priority, and the accumulator of everything sent is reset,
+# so low priority items are sent less often, but never starve. Entities that didn't fit keep the state
+# the client already has (held in the snapshot). Messages sent with send_to_all/send_to aren't budgeted
+
+# congestion control:
+# every server side connection has a CongestionController, that limits how many snapshots per second the client gets.
+# A snapshot counts as lost, if its SnapshotAck hasn't arrived within a retransmission timeout. Once per period,
+# the rate is halved if too many snapshots were lost, or if the round trip time has grown (queues filling up),
+# and increased by a constant otherwise (AIMD, like TCP). Below the full rate, reliable messages are sent only once
+# at first, and their retransmission timeouts are stretched by the same ratio. SnapshotAcks also give the
+# round trip time samples of the connection
+
+# connection lifecycle:
+# every packet counts as a sign of life. If nothing else has been sent to a peer within HEARTBEAT_INTERVAL,
+# a packet without messages is sent. The server disconnects clients, that haven't sent anything within CONNECTION_TIMEOUT,
+# and clients that send a DisconnectMessage when they stop. A disconnected player's connection is removed, its unconfirmed
+# and unpolled messages are dropped, and the game is told with poll_disconnected_players. A message the game polled just
+# before that mustn't add the player back, the game checks is_player_connected. The ids of disconnected players are remembered
+# and their packets dropped, so a client that timed out doesn't silently come back as a new connection (its sequence windows
+# and snapshot receivers would reject the new connection's messages). It stops hearing from the server instead, and
+# has_lost_connection becomes true. Multicast snapshots don't count as a sign of life, as they don't depend on the connection
+
+# LAN multicast (optional, see the multicast_address of CommunicationServer):
+# the server tells every new client the multicast group with a reliable MulticastChannelNotification. The client joins
+# the group and answers with MulticastSubscribed. From then on, the client's snapshots aren't sent over unicast: once per tick,
+# the server publishes a snapshot of the whole world to the group, so the send cost doesn't grow with the player count.
+# The published deltas are against the newest snapshot every subscriber has acked (MulticastSnapshotAck, see
+# snapshot.SharedSnapshotSender). Subscribers get no area of interest filtering or bandwidth budget for snapshots, as a LAN
+# can take it. A subscriber that hasn't acked anything within MULTICAST_ACK_TIMEOUT (e.g. a switch filtering multicast) goes back
+# to unicast snapshots. Reliable and per-client messages always use unicast
+
+# drops outgoing UDP packets at random. For latency, bursts, reordering etc. see networksimulator.py
 SIMULATED_PACKAGE_LOSS_PERCENTAGE = 0
 if float(SIMULATED_PACKAGE_LOSS_PERCENTAGE) != 0.0:
     print(f"Simulated package loss of {SIMULATED_PACKAGE_LOSS_PERCENTAGE} %")
 
+# messages to the server, that only carry the newest value of something about the sender
+LATEST_VALUE_MESSAGES_TO_SERVER = (messages.MousePositionUpdate, messages.ViewBoundsUpdate)
+
+# the key of the latest-value slot of the message (see ReceivedMessageStorage), or None if every copy must be handled.
+# Entity states (to clients) are keyed by (type, entity id), the values in LATEST_VALUE_MESSAGES_TO_SERVER by (sender, type)
+def get_latest_value_slot_key(message) -> Optional[tuple]:
+    if isinstance(message, messages.MessageToServerWithId):
+        return (message.sender_id, type(message.payload)) if isinstance(message.payload, LATEST_VALUE_MESSAGES_TO_SERVER) else None
+    if isinstance(message, snapshot.STATE_TYPES):
+        return type(message), snapshot.get_entity_id(message)
+    return None
+
+# messages are stored in a queue per type, so that polling a type (or a family of types, e.g. GameMessage)
+# only touches the returned messages. The arrival order is kept also between types.
+# A message with a slot key is stored in a latest-value slot instead: it replaces the unpolled message with the same key,
+# and takes its place in the arrival order. So a stalled game handles only the newest state of each entity,
+# and the storage holds at most one message per key.
+# Optionally, the messages of each sender are capped: when a sender has max_messages_per_sender unpolled messages,
+# its new messages are dropped (slot replacements excepted). Reliable messages are checked with has_room_for before
+# they're acked, so that they are sent again instead
 class ReceivedMessageStorage:
 
-    def __init__(self):
+    # get_message_type: returns the type the message is routed by (e.g. the type of its payload)
+    # get_slot_key: returns the latest-value slot key of the message, or None to queue it
+    # get_sender: returns the sender of the message, used with max_messages_per_sender
+    def __init__(self, get_message_type: Callable[..., type] = type, get_slot_key: Callable[..., Optional[tuple]] = lambda message: None,
+                 get_sender: Callable = lambda message: None, max_messages_per_sender: Optional[int] = None):
+        self.get_message_type = get_message_type
+        self.get_slot_key = get_slot_key
+        self.get_sender = get_sender
+        self.max_messages_per_sender = max_messages_per_sender
         self.lock = threading.Lock()
-        self.messages = []
+        self.queues: dict[type, deque[tuple[int, object]]] = {} # items are (arrival index, message)
+        self.slots: dict[type, OrderedDict[tuple, tuple[int, object]]] = {} # values are (arrival index, message), in arrival order
+        self.types_by_family: dict[type, list[type]] = {} # cache
+        self.message_counts_by_sender: dict[object, int] = {} # unpolled messages, if they are capped
+        self.message_count = 0
+        self.superseded_message_count = 0 # replaced in their slot before being polled
+        self.capped_message_count = 0 # dropped, because the sender had too many unpolled messages
+        self.next_arrival_index = 0
 
     def add(self, message):
-        with self.lock:
-            self.messages.append(message)
+        self.add_all([message])
 
-    def poll(self, filter_predicate: Callable[..., bool]):
+    # takes the lock once for all the messages, e.g. those of a received batch of packets
+    def add_all(self, new_messages: list):
+        routed_messages = [(message, self.get_message_type(message), self.get_slot_key(message)) for message in new_messages]
+        with self.lock:
+            for message, message_type, slot_key in routed_messages:
+                if message_type not in self.queues:
+                    self.queues[message_type] = deque()
+                    self.slots[message_type] = OrderedDict()
+                    self.types_by_family.clear()
+
+                is_replacement = slot_key != None and slot_key in self.slots[message_type]
+                if not is_replacement:
+                    if not self.try_count_sender_message(message):
+                        self.capped_message_count += 1
+                        continue
+                    self.message_count += 1
+
+                if slot_key == None:
+                    self.queues[message_type].append((self.next_arrival_index, message))
+                else:
+                    slots = self.slots[message_type]
+                    if is_replacement:
+                        del slots[slot_key]
+                        self.superseded_message_count += 1
+                    slots[slot_key] = (self.next_arrival_index, message)
+                self.next_arrival_index += 1
+
+    # returns false if the sender of the message has too many unpolled messages
+    def try_count_sender_message(self, message) -> bool:
+        if self.max_messages_per_sender == None:
+            return True
+
+        sender = self.get_sender(message)
+        count = self.message_counts_by_sender.get(sender, 0)
+        if count >= self.max_messages_per_sender:
+            return False
+        self.message_counts_by_sender[sender] = count + 1
+        return True
+
+    # returns false if a message of the sender would be dropped now. pending_count: its messages about to be added
+    def has_room_for(self, sender, pending_count = 0) -> bool:
+        if self.max_messages_per_sender == None:
+            return True
         with self.lock:
-            output = [m for m in self.messages if filter_predicate(m)]
-            self.messages = [m for m in self.messages if m not in output]
-            unhandled_count = len(self.messages)
+            return self.message_counts_by_sender.get(sender, 0) + pending_count < self.max_messages_per_sender
 
-        if unhandled_count > 100:
+    def uncount_sender_messages(self, removed_messages):
+        if self.max_messages_per_sender == None:
+            return
+
+        for message in removed_messages:
+            sender = self.get_sender(message)
+            count = self.message_counts_by_sender[sender] - 1
+            if count == 0:
+                del self.message_counts_by_sender[sender]
+            else:
+                self.message_counts_by_sender[sender] = count
+
+    # returns and removes all messages of the given type, or its subtypes, in arrival order
+    def poll(self, type_to_poll: type = object):
+        with self.lock:
+            types = self.get_types_of_family(type_to_poll)
+            queues = [self.queues[t] for t in types if len(self.queues[t]) > 0]
+            slots = [self.slots[t] for t in types if len(self.slots[t]) > 0]
+            sources = queues + [type_slots.values() for type_slots in slots] # each in arrival order
+            if len(sources) == 1:
+                output = [message for _, message in sources[0]]
+            else:
+                output = [message for _, message in heapq.merge(*sources)]
+
+            for container in queues + slots:
+                container.clear()
+            self.message_count -= len(output)
+            self.uncount_sender_messages(output)
+            unhandled_count = self.message_count
+
+        if unhandled_count > UNHANDLED_MESSAGE_WARNING_THRESHOLD:
             print(f"WARNING: {unhandled_count} messages left in buffer.")
 
         return output
     
-    def remove_non_matching(self, filter_predicate: Callable[..., bool]):
+    # removes all messages that aren't of the given type, or its subtypes
+    def remove_non_matching(self, valid_type: type = object):
         with self.lock:
-            self.messages = [m for m in self.messages if filter_predicate(m)]
+            for message_type in self.queues:
+                if not issubclass(message_type, valid_type):
+                    self.message_count -= len(self.queues[message_type]) + len(self.slots[message_type])
+                    self.uncount_sender_messages(message for _, message in self.queues[message_type])
+                    self.uncount_sender_messages(message for _, message in self.slots[message_type].values())
+                    self.queues[message_type].clear()
+                    self.slots[message_type].clear()
+
+    # removes all unpolled messages of the sender, e.g. those received in the same batch as its disconnect
+    def remove_sender(self, sender):
+        with self.lock:
+            removed_messages = []
+            for message_type in self.queues:
+                queue = self.queues[message_type]
+                kept = [item for item in queue if self.get_sender(item[1]) != sender]
+                if len(kept) < len(queue):
+                    removed_messages += [message for _, message in queue if self.get_sender(message) == sender]
+                    self.queues[message_type] = deque(kept)
+
+                slots = self.slots[message_type]
+                for slot_key in [key for key, (_, message) in slots.items() if self.get_sender(message) == sender]:
+                    removed_messages.append(slots.pop(slot_key)[1])
+
+            self.message_count -= len(removed_messages)
+            self.uncount_sender_messages(removed_messages)
+
+    def get_types_of_family(self, family: type) -> list[type]:
+        types = self.types_by_family.get(family)
+        if types == None:
+            types = [t for t in self.queues if issubclass(t, family)]
+            self.types_by_family[family] = types
+        return types
+
+# remembers which of the last RECEIVED_SEQUENCE_WINDOW_SIZE sequence numbers have been received
+class ReceivedSequenceWindow:
 
-class ConstSizeQueue:
+    def __init__(self):
+        self.newest_sequence = -1
+        self.received_mask = 0 # bit i is set if sequence (newest_sequence - i) has been received
+
+    # returns True if the sequence is received for the first time
+    def add(self, sequence: int) -> bool:
+        if sequence > self.newest_sequence:
+            shift = sequence - self.newest_sequence
+            if shift >= RECEIVED_SEQUENCE_WINDOW_SIZE:
+                self.received_mask = 1
+            else:
+                self.received_mask = ((self.received_mask << shift) | 1) & ((1 << RECEIVED_SEQUENCE_WINDOW_SIZE) - 1)
+            self.newest_sequence = sequence
+            return True
+
+        offset = self.newest_sequence - sequence
+        if offset >= RECEIVED_SEQUENCE_WINDOW_SIZE:
+            return False # too old to tell, assume it's a duplicate
+
+        bit = 1 << offset
+        if self.received_mask & bit:
+            return False
+        self.received_mask |= bit
+        return True
+
+    # returns True if the sequence has been received, or is too old to tell
+    def contains(self, sequence: int) -> bool:
+        if sequence > self.newest_sequence:
+            return False
+        offset = self.newest_sequence - sequence
+        return offset >= RECEIVED_SEQUENCE_WINDOW_SIZE or self.received_mask & (1 << offset) != 0
 
-    def __init__(self, size):
-        self.size = size
-        self.array = [None] * size
-        self.next_item_index = 0
+@dataclass
+class ReliableMessage:
+    payload: ...
+    sequence: int # increasing, separately for each connection
 
-    def add(self, item):
-        self.array[self.next_item_index] = item
+wirecodec.register_message_type(ReliableMessage, 20, [
+    ("payload", wirecodec.MESSAGE),
+    ("sequence", wirecodec.UINT32)
+])
 
-        self.next_item_index += 1
-        self.next_item_index %= self.size
+# a client is leaving (see the connection lifecycle comment at the top)
+@dataclass
+class DisconnectMessage(messages.MessageToServer):
+    pass
 
-    def __len__(self):
-        return self.size
+wirecodec.register_message_type(DisconnectMessage, 22, [])
 
-    def __contains__(self, item):
-        return item in self.array
+# a piece of an encoded message, that was too big for one packet (see fragmentation at the top)
+@dataclass
+class MessageFragment(messages.MessageToServer):
+    fragmented_message_id: int # increasing, separately for each connection
+    index: int
+    fragment_count: int
+    data: bytes
+
+wirecodec.register_message_type(MessageFragment, 23, [
+    ("fragmented_message_id", wirecodec.UINT32),
+    ("index", wirecodec.UINT16),
+    ("fragment_count", wirecodec.UINT16),
+    ("data", wirecodec.BYTES)
+])
+
+# the server publishes snapshots to this multicast group (see LAN multicast at the top)
+@dataclass
+class MulticastChannelNotification(messages.MessageToClient):
+    group: str
+    port: int
+
+wirecodec.register_message_type(MulticastChannelNotification, 25, [
+    ("group", wirecodec.STRING),
+    ("port", wirecodec.UINT16)
+])
 
+# the client has joined the multicast group, and doesn't need snapshots over unicast anymore
 @dataclass
-class ReliableMessage:
-    payload: ...
-    id: ObjectId = field(init=False)
+class MulticastSubscribed(messages.MessageToServer):
+    pass
 
-    def __post_init__(self):
-        self.id = get_new_object_id()
+wirecodec.register_message_type(MulticastSubscribed, 26, [])
 
+# like snapshot.SnapshotAck, for the snapshots published to the multicast group
 @dataclass
-class MessageConfirmation:
-    message_id: int
+class MulticastSnapshotAck(messages.MessageToServer):
+    snapshot_id: int
+
+wirecodec.register_message_type(MulticastSnapshotAck, 27, [
+    ("snapshot_id", wirecodec.UINT32)
+])
+
+# carry other messages, see unwrap_message
+WRAPPER_MESSAGE_TYPES = (MessageFragment, compression.CompressedMessage)
+
+# handled by the server endpoint itself, they don't reach the game and aren't rate limited
+ENDPOINT_MESSAGE_TYPES = (DisconnectMessage, snapshot.SnapshotAck, MulticastSubscribed, MulticastSnapshotAck)
+
+# message: MessageToServerWithId, or any (possibly already encoded) message to a client. Returns the fragments to send in place of it
+def split_into_fragments(message, fragmented_message_id: int) -> list:
+    is_wrapped = isinstance(message, messages.MessageToServerWithId)
+    data = wirecodec.encode_message(message.payload if is_wrapped else message)
+    if len(data) > MAX_FRAGMENT_COUNT * MAX_FRAGMENT_DATA_SIZE:
+        raise wirecodec.WireFormatError(f"{type(message).__name__} of {len(data)} bytes is too big to send.")
+
+    chunks = [data[i:i + MAX_FRAGMENT_DATA_SIZE] for i in range(0, len(data), MAX_FRAGMENT_DATA_SIZE)]
+    fragments = [MessageFragment(fragmented_message_id, index, len(chunks), chunk) for index, chunk in enumerate(chunks)]
+    if is_wrapped:
+        return [messages.MessageToServerWithId(message.sender_id, fragment) for fragment in fragments]
+    return fragments
 
 @dataclass
-class UnconfirmedMessage:
-    message: ReliableMessage
-    address: tuple[str, int]
-    last_send_time: float = field(init=False)
-    
-    def __post_init__(self):
+class PartialMessage:
+    fragments: list[Optional[bytes]]
+    missing_count: int
+
+# collects the fragments received from one connection. Used by the receiving thread only
+class FragmentReassembler:
+
+    def __init__(self):
+        self.partial_messages: dict[int, PartialMessage] = {} # by fragmented message id, oldest first
+
+    # returns the data of the whole message, when its last fragment arrives
+    def add(self, fragment: MessageFragment) -> Optional[bytes]:
+        if not (0 <= fragment.index < fragment.fragment_count <= MAX_FRAGMENT_COUNT):
+            print(f"WARNING: Dropped an invalid fragment {fragment.index}/{fragment.fragment_count}.")
+            return None
+
+        partial_message = self.partial_messages.get(fragment.fragmented_message_id)
+        if partial_message == None:
+            if len(self.partial_messages) >= MAX_PARTIAL_MESSAGES_PER_CONNECTION:
+                oldest_id = next(iter(self.partial_messages))
+                del self.partial_messages[oldest_id]
+                print(f"WARNING: Gave up on reassembling fragmented message {oldest_id}.")
+            partial_message = PartialMessage([None] * fragment.fragment_count, fragment.fragment_count)
+            self.partial_messages[fragment.fragmented_message_id] = partial_message
+        elif len(partial_message.fragments) != fragment.fragment_count:
+            print(f"WARNING: Dropped a fragment of message {fragment.fragmented_message_id}, with an inconsistent fragment count.")
+            return None
+
+        if partial_message.fragments[fragment.index] == None:
+            partial_message.fragments[fragment.index] = fragment.data
+            partial_message.missing_count -= 1
+        if partial_message.missing_count > 0:
+            return None
+
+        del self.partial_messages[fragment.fragmented_message_id]
+        return b"".join(partial_message.fragments)
+
+# one end of a connection, as seen from the other end
+class Connection:
+
+    def __init__(self, address: tuple[str, int]):
+        self.address = address
+        self.reliable_sequence_counter = itertools.count(randrange(2**30)) # next() is atomic, so multiple threads can send
+        self.fragmented_message_counter = itertools.count(randrange(2**30))
+        self.fragment_reassembler = FragmentReassembler()
+        self.fec_encoder = fec.FecEncoder() if RELIABLE_FEC_ENABLED else None
+        self.fec_decoder = fec.FecDecoder(MAX_PACKET_SIZE) if RELIABLE_FEC_ENABLED else None
+        self.round_trip_time = RoundTripTimeEstimator()
+        self.statistics = networkstatistics.ConnectionStatistics()
+
+        self.ack_lock = threading.Lock()
+        self.received_reliable_sequences = ReceivedSequenceWindow()
+        self.extra_acks: list[int] = [] # received sequences too old for the ack bitfield
+        self.ack_pending_since: Optional[float] = None # time of the oldest reliable message, that no sent packet has acked yet
         self.last_send_time = time()
-    
-class UncofirmedMessageStorage:
+        self.last_receive_time = time()
+
+    def has_received_reliable_sequence(self, sequence: int) -> bool:
+        with self.ack_lock:
+            return self.received_reliable_sequences.contains(sequence)
+
+    # returns True if the sequence is received for the first time
+    def receive_reliable_sequence(self, sequence: int) -> bool:
+        with self.ack_lock:
+            is_new = self.received_reliable_sequences.add(sequence)
+
+            is_outside_bitfield = sequence < self.received_reliable_sequences.newest_sequence - wirecodec.ACK_BITFIELD_SIZE
+            if is_outside_bitfield and sequence not in self.extra_acks:
+                self.extra_acks.append(sequence)
+
+            if self.ack_pending_since == None:
+                self.ack_pending_since = time()
+
+            return is_new
+
+    # returns the acks to put into the next packet going to this connection
+    def take_ack_header(self) -> Optional[wirecodec.AckHeader]:
+        with self.ack_lock:
+            window = self.received_reliable_sequences
+            if window.newest_sequence < 0:
+                return None
+
+            extra_acks = self.extra_acks[:MAX_EXTRA_ACKS_PER_PACKET]
+            self.extra_acks = self.extra_acks[MAX_EXTRA_ACKS_PER_PACKET:]
+            if len(self.extra_acks) == 0:
+                self.ack_pending_since = None
+
+            previous_sequences = (window.received_mask >> 1) & ((1 << wirecodec.ACK_BITFIELD_SIZE) - 1)
+            return wirecodec.AckHeader(window.newest_sequence, previous_sequences, extra_acks)
+
+    def is_standalone_ack_due(self):
+        return self.ack_pending_since != None and time() - self.ack_pending_since > ACK_DELAY / 1000
+
+    def is_heartbeat_due(self):
+        return time() - self.last_send_time > HEARTBEAT_INTERVAL / 1000
+
+    def has_timed_out(self):
+        return time() - self.last_receive_time > CONNECTION_TIMEOUT / 1000
+
+    def add_round_trip_time_sample(self, rtt: float):
+        self.round_trip_time.add_sample(rtt)
+        self.statistics.on_round_trip_time_sample(rtt)
+
+    # in seconds
+    def get_retransmission_timeout(self, resend_count: int = 0):
+        return self.round_trip_time.get_retransmission_timeout(resend_count)
+
+    def get_initial_send_count(self):
+        return 1 if self.fec_encoder != None else RELIABLE_MESSAGE_INITIAL_SEND_COUNT
+
+    def get_name(self):
+        return f"{self.address[0]}:{self.address[1]}"
+
+    # see networkstatistics.ConnectionStatistics.to_dict
+    def get_statistics(self) -> dict:
+        statistics = self.statistics.to_dict()
+        smoothed_rtt = self.round_trip_time.smoothed_rtt
+        statistics["smoothed_rtt_ms"] = None if smoothed_rtt == None else 1000 * smoothed_rtt
+        statistics["retransmission_timeout_ms"] = 1000 * self.get_retransmission_timeout()
+        statistics["fec_recovered_packets"] = None if self.fec_decoder == None else self.fec_decoder.recovered_packet_count
+        return statistics
+
+class RoundTripTimeEstimator:
 
     def __init__(self):
-        self.unconfirmed_messages: dict[ObjectId, UnconfirmedMessage] = {}
+        self.smoothed_rtt: Optional[float] = None # in seconds
+        self.rtt_variance: Optional[float] = None
+
+    def add_sample(self, rtt: float):
+        if self.smoothed_rtt == None or self.rtt_variance == None:
+            self.smoothed_rtt = rtt
+            self.rtt_variance = rtt / 2
+        else:
+            self.rtt_variance = (1 - RTT_VARIANCE_SMOOTHING) * self.rtt_variance + RTT_VARIANCE_SMOOTHING * abs(self.smoothed_rtt - rtt)
+            self.smoothed_rtt = (1 - RTT_SMOOTHING) * self.smoothed_rtt + RTT_SMOOTHING * rtt
+
+    # in seconds
+    def get_retransmission_timeout(self, resend_count: int = 0):
+        if self.smoothed_rtt == None or self.rtt_variance == None:
+            timeout = INITIAL_RETRANSMISSION_TIMEOUT / 1000
+        else:
+            timeout = self.smoothed_rtt + 4 * self.rtt_variance
+
+        timeout *= 2**resend_count
+        return min(MAX_RETRANSMISSION_TIMEOUT / 1000, max(MIN_RETRANSMISSION_TIMEOUT / 1000, timeout))
+
+# see the congestion control comment at the top
+class CongestionController:
+
+    def __init__(self, connection: "Connection"):
+        self.connection = connection
+        self.round_trip_time = connection.round_trip_time
         self.lock = threading.Lock()
+        self.snapshot_rate: float = MAX_SNAPSHOT_RATE # snapshots per second
+        self.snapshot_credit = 1.0 # a snapshot is sent when this reaches 1
+        self.time_of_last_snapshot_check = time()
+        self.unacked_snapshots: dict[int, float] = {} # send times by snapshot id
+        self.min_rtt: Optional[float] = None
+        self.period_start = time()
+        self.period_acked_count = 0
+        self.period_lost_count = 0
+
+        # statistics
+        self.acked_snapshot_count = 0
+        self.lost_snapshot_count = 0
+        self.rate_decrease_count = 0
+        self.last_loss_fraction = 0.0
+
+    # call once per tick. Returns True if this tick's snapshot should be sent
+    def should_send_snapshot(self):
+        now = time()
+        with self.lock:
+            self.update_period(now)
+
+            self.snapshot_credit = min(1.0, self.snapshot_credit + self.snapshot_rate * (now - self.time_of_last_snapshot_check))
+            self.time_of_last_snapshot_check = now
+            if self.snapshot_credit < 1.0:
+                return False
+
+            self.snapshot_credit -= 1.0
+            return True
+
+    def on_snapshot_sent(self, snapshot_id: int):
+        with self.lock:
+            self.unacked_snapshots[snapshot_id] = time()
 
-    def recieve_confirmation(self, confirmation: MessageConfirmation):
+    def on_snapshot_acked(self, snapshot_id: int):
         with self.lock:
-            if confirmation.message_id in self.unconfirmed_messages:
-                self.unconfirmed_messages.pop(confirmation.message_id)
+            send_time = self.unacked_snapshots.pop(snapshot_id, None)
+            if send_time == None:
+                return # late, already counted as lost
+
+            rtt = time() - send_time
+            self.min_rtt = rtt if self.min_rtt == None else min(self.min_rtt, rtt)
+            self.period_acked_count += 1
+            self.acked_snapshot_count += 1
+        self.connection.add_round_trip_time_sample(rtt)
+
+    def update_period(self, now: float):
+        loss_timeout = self.round_trip_time.get_retransmission_timeout()
+        lost_ids = [id for id, send_time in self.unacked_snapshots.items() if now - send_time > loss_timeout]
+        for id in lost_ids:
+            self.unacked_snapshots.pop(id)
+        self.period_lost_count += len(lost_ids)
+        self.lost_snapshot_count += len(lost_ids)
+
+        smoothed_rtt = self.round_trip_time.smoothed_rtt
+        period = max(MIN_CONGESTION_PERIOD / 1000, smoothed_rtt if smoothed_rtt != None else 0.0)
+        if now - self.period_start < period:
+            return
+
+        sample_count = self.period_acked_count + self.period_lost_count
+        self.last_loss_fraction = self.period_lost_count / sample_count if sample_count > 0 else 0.0
+        is_rtt_congested = smoothed_rtt != None and self.min_rtt != None and smoothed_rtt > CONGESTION_RTT_THRESHOLD * max(self.min_rtt, MIN_RETRANSMISSION_TIMEOUT / 1000)
+
+        if self.last_loss_fraction > CONGESTION_LOSS_THRESHOLD or is_rtt_congested:
+            self.snapshot_rate = max(MIN_SNAPSHOT_RATE, self.snapshot_rate * SNAPSHOT_RATE_DECREASE)
+            self.rate_decrease_count += 1
+        else:
+            self.snapshot_rate = min(MAX_SNAPSHOT_RATE, self.snapshot_rate + SNAPSHOT_RATE_INCREASE)
+
+        self.period_start = now
+        self.period_acked_count = 0
+        self.period_lost_count = 0
+
+    def is_congested(self):
+        return self.snapshot_rate < MAX_SNAPSHOT_RATE
+
+    def get_retransmission_backoff(self):
+        return min(MAX_RETRANSMISSION_BACKOFF, MAX_SNAPSHOT_RATE / self.snapshot_rate)
+
+@dataclass
+class UnconfirmedMessage:
+    sequence: int
+    encoded_message: bytes # the encoded ReliableMessage, resent as is
+    connection: Connection
+    first_send_time: float
+    resend_count: int = 0
+    deadline: float = 0.0 # time of the next resend
+
+# unconfirmed messages are ordered by their resend deadlines in a heap, so that the resend thread
+# can sleep until the next deadline, and only touches the messages that are due
+class UncofirmedMessageStorage:
+
+    def __init__(self):
+        self.unconfirmed_messages: dict[tuple[str, int], dict[int, UnconfirmedMessage]] = {} # by address, then sequence. Oldest first
+        self.superseding_keys: dict[tuple[str, int], dict[object, int]] = {} # by address, then supersede key. Values are sequences
+        self.deadlines: list[tuple[float, tuple[tuple[str, int], int]]] = [] # heap of (deadline, (address, sequence)). Entries of confirmed messages are skipped lazily
+        self.condition = threading.Condition()
+        self.on_wake: Optional[Callable[[], None]] = None # called when the resend timer should be re-evaluated
+        self.dropped_message_count = 0 # given up on, see MAX_RESEND_COUNT
+
+    # drops every message the acks cover, in one pass
+    def receive_acks(self, ack_header: wirecodec.AckHeader, address):
+        with self.condition:
+            connection_messages = self.unconfirmed_messages.get(address, {})
+            acked_messages = [connection_messages.pop(sequence, None) for sequence in ack_header.get_acked_sequences()]
+
+        # the newest sequence was most likely acked right away. Only messages that weren't resent give unambiguous samples (Karn's algorithm)
+        newest_message = acked_messages[0]
+        if newest_message != None and newest_message.resend_count == 0:
+            newest_message.connection.add_round_trip_time_sample(time() - newest_message.first_send_time)
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify()
+        if self.on_wake != None:
+            self.on_wake()
+
+    # supersede_key: an unconfirmed message sent with the same key to the same connection is not resent anymore
+    def add_message(self, sequence: int, encoded_message: bytes, connection: Connection, supersede_key = None):
+        now = time()
+        address = connection.address
+        unconfirmed_message = UnconfirmedMessage(sequence, encoded_message, connection, now)
+        unconfirmed_message.deadline = now + connection.get_retransmission_timeout()
+
+        with self.condition:
+            connection_messages = self.unconfirmed_messages.setdefault(address, {})
+            if supersede_key != None:
+                superseding_keys = self.superseding_keys.setdefault(address, {})
+                superseded_sequence = superseding_keys.get(supersede_key)
+                if superseded_sequence != None:
+                    connection_messages.pop(superseded_sequence, None)
+                superseding_keys[supersede_key] = sequence
+
+            # the connection is hopelessly behind, give up on its oldest message
+            if len(connection_messages) >= MAX_UNCONFIRMED_MESSAGES_PER_CONNECTION:
+                oldest_sequence = next(iter(connection_messages))
+                self.drop(connection_messages.pop(oldest_sequence), "the connection has too many unconfirmed messages")
+
+            connection_messages[sequence] = unconfirmed_message
+            heapq.heappush(self.deadlines, (unconfirmed_message.deadline, (address, sequence)))
+        self.wake()
+
+    def drop(self, message: UnconfirmedMessage, reason: str):
+        self.dropped_message_count += 1
+        message.connection.statistics.on_reliable_message_dropped()
+        print(f"WARNING: Gave up on reliable message {message.sequence} to {message.connection.get_name()}, {reason}.")
+
+    # returns the messages that should be resent now, and schedules their next resend.
+    # Messages that have been resent too many times, or are too old, are dropped
+    def get_due_messages(self) -> list[UnconfirmedMessage]:
+        now = time()
+        due_messages = []
+        with self.condition:
+            while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+                deadline, (address, sequence) = heapq.heappop(self.deadlines)
+                connection_messages = self.unconfirmed_messages.get(address, {})
+                message = connection_messages.get(sequence)
+                if message == None or message.deadline != deadline:
+                    continue # confirmed, superseded or rescheduled
+
+                if message.resend_count >= MAX_RESEND_COUNT or now - message.first_send_time > MAX_UNCONFIRMED_AGE / 1000:
+                    connection_messages.pop(sequence)
+                    self.drop(message, f"not confirmed after {message.resend_count} resends in {now - message.first_send_time:.1f} s")
+                    continue
 
-    def add_message(self, message: ReliableMessage, address):
+                message.resend_count += 1
+                message.deadline = now + message.connection.get_retransmission_timeout(message.resend_count)
+                heapq.heappush(self.deadlines, (message.deadline, (address, sequence)))
+                due_messages.append(message)
+
+        return due_messages
+
+    # drops the unconfirmed messages of a closed connection. Their heap entries are skipped lazily
+    def remove_connection(self, address):
+        with self.condition:
+            self.unconfirmed_messages.pop(address, None)
+            self.superseding_keys.pop(address, None)
+
+    def get_count(self, address) -> int:
+        return len(self.unconfirmed_messages.get(address, {}))
+
+    def get_count_by_address(self) -> dict[tuple[str, int], int]:
+        with self.condition:
+            return {address: len(connection_messages) for address, connection_messages in self.unconfirmed_messages.items()}
+
+    # the sender should skip or coalesce what it can, until the peer has caught up
+    def is_saturated(self, address):
+        return self.get_count(address) >= SATURATION_THRESHOLD * MAX_UNCONFIRMED_MESSAGES_PER_CONNECTION
+
+    # in seconds, at most max_sleep
+    def get_time_until_next_deadline(self, max_sleep: float):
+        with self.condition:
+            if len(self.deadlines) > 0:
+                return max(0.0, min(max_sleep, self.deadlines[0][0] - time()))
+            return max_sleep
+
+    # sleeps until the next resend deadline, a wake up, or max_sleep seconds
+    def wait_for_next_deadline(self, max_sleep: float):
+        with self.condition: # held from reading the deadlines until waiting, so that a message added in between wakes the thread
+            sleep_time = self.get_time_until_next_deadline(max_sleep)
+            if sleep_time > 0:
+                self.condition.wait(sleep_time)
+
+# collects encoded messages going to one address, and packs them into as few packets as possible
+class OutgoingPacketBatch:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.packets: list[bytearray] = []
+        self.reliable_packet_indices: set[int] = set() # packets containing reliable messages
+        self.time_of_first_message = 0.0
+
+    def add(self, encoded_message: bytes, is_reliable = False):
         with self.lock:
-            self.unconfirmed_messages[message.id] = UnconfirmedMessage(message, address)
+            if len(self.packets) == 0:
+                self.time_of_first_message = time()
+
+            if len(self.packets) == 0 or len(self.packets[-1]) + len(encoded_message) > MAX_PACKET_DATA_SIZE:
+                self.packets.append(bytearray())
+            self.packets[-1] += encoded_message
+            if is_reliable:
+                self.reliable_packet_indices.add(len(self.packets) - 1)
 
-    def get_messages(self):
+    # returns (message data, contains reliable messages) of the packets, and empties the batch
+    def take_packets(self) -> list[tuple[bytearray, bool]]:
         with self.lock:
-            return list(self.unconfirmed_messages.values())
+            packets = [(packet, i in self.reliable_packet_indices) for i, packet in enumerate(self.packets)]
+            self.packets = []
+            self.reliable_packet_indices = set()
+            return packets
+
+    def is_stale(self):
+        return len(self.packets) > 0 and time() - self.time_of_first_message > MAX_BATCH_DELAY / 1000
+
+@dataclass
+class ScheduledItem:
+    key: object # e.g. an entity id
+    priority: float
+    size: int # in bytes
+
+# chooses what fits into a tick's byte budget (see the comment at the top)
+class PriorityScheduler:
+
+    def __init__(self):
+        self.accumulated_priorities: dict[object, float] = {}
+        self.starved_ticks: dict[object, int] = {} # how many ticks in a row each item has been left out
+        self.sent_item_count = 0
+        self.deferred_item_count = 0 # times an item was left out of a tick
+        self.max_starved_ticks = 0 # the longest any item has waited
+
+    # returns the items that are sent this tick. Items that aren't candidates anymore are forgotten
+    def schedule(self, items: list[ScheduledItem], byte_budget: int) -> list[ScheduledItem]:
+        accumulated_priorities = {}
+        for item in items:
+            accumulated_priorities[item.key] = self.accumulated_priorities.get(item.key, 0.0) + item.priority
+        self.accumulated_priorities = accumulated_priorities
+        self.starved_ticks = {key: self.starved_ticks.get(key, 0) for key in accumulated_priorities}
+
+        selected_items = []
+        remaining_budget = byte_budget
+        for item in sorted(items, key=lambda item: accumulated_priorities[item.key], reverse=True):
+            # the first item is always sent, so that an item bigger than the budget doesn't starve
+            if item.size <= remaining_budget or len(selected_items) == 0:
+                selected_items.append(item)
+                remaining_budget -= item.size
+                self.accumulated_priorities[item.key] = 0.0
+                self.starved_ticks[item.key] = 0
+            else:
+                self.starved_ticks[item.key] += 1
+                self.max_starved_ticks = max(self.max_starved_ticks, self.starved_ticks[item.key])
+
+        self.sent_item_count += len(selected_items)
+        self.deferred_item_count += len(items) - len(selected_items)
+        return selected_items
+
+def is_valid_message_to_server(message):
+    return isinstance(message, messages.MessageToServerWithId) and isinstance(message.payload, messages.MessageToServer)
+
+# carries packets between endpoints. HighLevelSocket uses UDP, networksimulator.SimulatedTransport
+# an in-process network with configurable conditions
+class Transport(ABC):
+
+    def __init__(self):
+        self.compressor = compression.Compressor() if compression.COMPRESSION_ENABLED else None
+        self.dropped_send_count = 0 # datagrams that couldn't be sent, e.g. because the send buffer was full
+
+    # packet: encoded with wirecodec.encode_packet
+    @abstractmethod
+    def send_datagram(self, packet: bytes, address):
+        pass
+
+    # returns (packet, sender's address), or None if nothing arrived within a while
+    @abstractmethod
+    def receive_packet(self) -> Optional[tuple[bytes, tuple]]:
+        pass
+
+    # like receive_packet, but returns every packet that has arrived (possibly none). Transports can drain more at once
+    def receive_packets(self) -> list[tuple[bytes, tuple]]:
+        received = self.receive_packet()
+        return [] if received == None else [received]
+
+    # message_data: encoded messages. Pending acks of the connection are added to the header.
+    # Packets with reliable messages are protected by forward error correction, if the connection uses it
+    def send_packet(self, message_data: bytes, connection: Connection, is_reliable = False):
+        fec_header = None
+        if is_reliable and connection.fec_encoder != None:
+            fec_header = connection.fec_encoder.add(bytes(message_data))
+
+        self.send_encoded_packet(wirecodec.encode_packet(message_data, connection.take_ack_header(), fec_header), connection)
+        if fec_header != None and connection.fec_encoder.is_full():
+            self.send_fec_parity(connection)
+
+    def send_encoded_packet(self, packet: bytes, connection: Connection):
+        connection.statistics.on_packet_sent(len(packet))
+        connection.last_send_time = time()
+        self.send_datagram(packet, connection.address)
+
+    # ends the connection's current forward error correction group
+    def send_fec_parity(self, connection: Connection):
+        parity = connection.fec_encoder.take_parity()
+        if parity != None:
+            fec_header, parity_data = parity
+            self.send_encoded_packet(wirecodec.encode_packet(parity_data, connection.take_ack_header(), fec_header), connection)
+
+    def send_to(self, message, connection: Connection):
+        self.send_packet(wirecodec.encode_message(message), connection)
+
+    # returns the message to send reliably in place of message, compressed if that pays off (see compression.py).
+    # message may be a MessageToServerWithId, or a (possibly already encoded) message to a client
+    def compress(self, message):
+        is_wrapped = isinstance(message, messages.MessageToServerWithId)
+        payload = message.payload if is_wrapped else message
+        if self.compressor == None or isinstance(payload, (compression.CompressedMessage, MessageFragment)):
+            return message
+
+        encoded_payload = wirecodec.encode_message(payload)
+        if len(encoded_payload) < compression.COMPRESSION_THRESHOLD or encoded_payload[0] == wirecodec.schemas_by_type[compression.CompressedMessage].tag:
+            return message
+        compressed_message = self.compressor.compress(encoded_payload, compression.get_type_name(payload))
+        if compressed_message == None:
+            return message
+        return messages.MessageToServerWithId(message.sender_id, compressed_message) if is_wrapped else compressed_message
+
+    # message may be a wirecodec.EncodedMessage, so that a broadcast encodes the payload only once.
+    # The ReliableMessage is encoded once, and the same bytes are used for every (re)send.
+    # If a batch is given, the first copy is piggy-backed on it. See UncofirmedMessageStorage.add_message for supersede_key.
+    # Big messages are compressed (unless is_compressed, e.g. a broadcast compressed once), and messages too big for one packet are sent as fragments
+    def send_to_reliable(self, message, connection: Connection, unconfirmed_message_storage: UncofirmedMessageStorage, batch: Optional[OutgoingPacketBatch] = None, supersede_key = None, is_compressed = False):
+        if not is_compressed:
+            message = self.compress(message)
+        encoded_payload = wirecodec.encode_message(message)
+        if len(encoded_payload) > MAX_UNFRAGMENTED_MESSAGE_SIZE:
+            fragments = split_into_fragments(message, next(connection.fragmented_message_counter))
+            for index, fragment in enumerate(fragments):
+                fragment_supersede_key = None if supersede_key == None else (supersede_key, index)
+                self.send_to_reliable(fragment, connection, unconfirmed_message_storage, batch, fragment_supersede_key, is_compressed=True)
+            return
+
+        sequence = next(connection.reliable_sequence_counter)
+        encoded_message = wirecodec.encode_message(ReliableMessage(wirecodec.EncodedMessage(encoded_payload), sequence))
+        unconfirmed_message_storage.add_message(sequence, encoded_message, connection, supersede_key)
+        connection.statistics.on_reliable_message_sent()
+
+        send_count = connection.get_initial_send_count()
+        if batch != None:
+            batch.add(encoded_message, is_reliable=True)
+            send_count -= 1
+        for _ in range(send_count):
+            self.send_packet(encoded_message, connection, is_reliable=True)
+
+    def send_batch(self, batch: OutgoingPacketBatch, connection: Connection):
+        for message_data, is_reliable in batch.take_packets():
+            self.send_packet(message_data, connection, is_reliable)
 
-class HighLevelSocket:
+class HighLevelSocket(Transport):
 
     def __init__(self, low_level_socket: socket.socket):
+        super().__init__()
         self.socket = low_level_socket
         self.send_lock = threading.Lock()
+        self.receive_buffers: list[memoryview] = [] # allocated on the first receive_packets
 
-    def send_to(self, message, address):
-        packet = pickle.dumps(message)
+    # the asyncio endpoints make the socket non-blocking. Then a full send buffer loses the datagram, like a full
+    # router queue would, instead of blocking the sender (e.g. a tick)
+    def send_datagram(self, packet: bytes, address):
         with self.send_lock:
             if 100 * random() > SIMULATED_PACKAGE_LOSS_PERCENTAGE:
-                self.socket.sendto(packet, address)
-
-    def send_to_reliable(self, message, address, unconfirmed_message_storage: UncofirmedMessageStorage):
-        reliable_message = ReliableMessage(message)
-        unconfirmed_message_storage.add_message(reliable_message, address)
-        for _ in range(RELIABLE_MESSAGE_INITIAL_SEND_COUNT):
-            self.send_to(reliable_message, address)
-
-    # returns (data, sender's address)
-    def receive_message(self):
-        data, address = self.socket.recvfrom(16_384)
-        message = pickle.loads(data)
-        return message, address
+                try:
+                    self.socket.sendto(packet, address)
+                except BlockingIOError:
+                    self.dropped_send_count += 1
+
+    def receive_packet(self):
+        try:
+            return self.socket.recvfrom(RECEIVE_BUFFER_SIZE)
+        except socket.timeout:
+            return None # only if the socket has a timeout
+
+    # waits for a datagram, then takes the ones that have arrived after it without waiting (up to RECEIVE_BATCH_SIZE).
+    # No allocations per datagram: the packets are views of preallocated buffers, that the next call overwrites
+    def receive_packets(self) -> list[tuple[memoryview, tuple]]:
+        if len(self.receive_buffers) == 0:
+            self.receive_buffers = [memoryview(bytearray(RECEIVE_BUFFER_SIZE)) for _ in range(RECEIVE_BATCH_SIZE)]
+
+        try:
+            size, address = self.socket.recvfrom_into(self.receive_buffers[0])
+        except socket.timeout:
+            return []
+        received = [(self.receive_buffers[0][:size], address)]
+
+        # a socket with a timeout would wait despite MSG_DONTWAIT, and Windows doesn't have it
+        if hasattr(socket, "MSG_DONTWAIT") and self.socket.gettimeout() == None:
+            receive_into = self.socket.recvfrom_into
+            for buffer in self.receive_buffers[1:]:
+                try:
+                    size, address = receive_into(buffer, 0, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+                received.append((buffer[:size], address))
+        else:
+            for buffer in self.receive_buffers[1:]:
+                readable, _, _ = select.select([self.socket], [], [], 0)
+                if len(readable) == 0:
+                    break
+                size, address = self.socket.recvfrom_into(buffer)
+                received.append((buffer[:size], address))
+        return received
+
+def create_udp_socket(address) -> HighLevelSocket:
+    message_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    message_socket.bind(address)
+    return HighLevelSocket(message_socket)
+
+# packets sent to a multicast group from this socket go out through the interface of interface_ip
+def enable_multicast_sending(low_level_socket: socket.socket, interface_ip: str):
+    low_level_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+    low_level_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface_ip))
+    low_level_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1) # for clients on the same machine
+
+# a socket receiving the packets sent to the group, on the interface of interface_ip. Raises OSError if joining fails
+def create_multicast_socket(group_address: tuple[str, int], interface_ip: str) -> HighLevelSocket:
+    multicast_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    try:
+        multicast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # multiple clients on the same machine
+        multicast_socket.bind(("", group_address[1]))
+        membership = socket.inet_aton(group_address[0]) + socket.inet_aton(interface_ip)
+        multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        multicast_socket.settimeout(RESEND_THREAD_MAX_SLEEP / 1000) # so that the receiving thread notices stopping
+    except OSError:
+        multicast_socket.close()
+        raise
+    return HighLevelSocket(multicast_socket)
 
 class CommunicationEndpoint(ThreadOwner, ABC):
 
-    def __init__(self, low_level_socket: socket.socket, resend_thread_name: str):
-        self.message_socket = low_level_socket
-        self.message_storage = ReceivedMessageStorage() # unhandled received messages
+    # get_sender and max_messages_per_sender: see ReceivedMessageStorage
+    def __init__(self, transport: Transport, resend_thread_name: str, get_message_type: Callable[..., type] = type, get_sender: Callable = lambda message: None, max_messages_per_sender: Optional[int] = None):
+        self.message_socket = transport.socket if isinstance(transport, HighLevelSocket) else None # the UDP socket, if there is one
+        self.message_storage = ReceivedMessageStorage(get_message_type, get_latest_value_slot_key, get_sender, max_messages_per_sender) # unhandled received messages
         self.unconfirmed_message_storage = UncofirmedMessageStorage() # sent unconfirmed reliable messages
-        self.socket = HighLevelSocket(low_level_socket)
+        self.enqueue_batch = threading.local() # see enqueueing_in_batch
+        self.socket = transport
  
         ThreadOwner.__init__(self)
         self.add_thread(threading.Thread(target=self.reliable_message_resend_mainloop, daemon=True), resend_thread_name)
         self.send_lock = threading.Lock()
 
-    def handle_reliable_message(self, reliable_message: ReliableMessage, address, received_reliable_message_id_storage: ConstSizeQueue):
-        self.socket.send_to(MessageConfirmation(reliable_message.id), address)
+    # the packets that have arrived are handled together, and their messages stored at once
+    def inwards_message_mainloop(self):
+        while self.running:
+            packets = self.socket.receive_packets()
+            with self.enqueueing_in_batch():
+                for packet, address in packets:
+                    self.handle_packet(packet, address)
+
+    def handle_packet(self, packet: bytes, address):
+        connection = self.find_connection(address)
+        if connection != None:
+            connection.statistics.on_packet_received(len(packet))
+            connection.last_receive_time = time()
+
+        try:
+            ack_header, fec_header, message_data = wirecodec.decode_packet_header(packet)
+            is_parity = fec_header != None and fec_header.is_parity
+            received_messages = [] if is_parity else wirecodec.decode_messages(message_data)
+
+            recovered_message_data = None
+            if fec_header != None and connection != None and connection.fec_decoder != None:
+                recovered_message_data = connection.fec_decoder.add(fec_header, bytes(message_data)) # kept until the group is done
+        except wirecodec.WireFormatError as exception:
+            print(f"WARNING: Dropped a malformed packet. {exception}")
+            return
+
+        if ack_header != None:
+            self.unconfirmed_message_storage.receive_acks(ack_header, address)
+        for message in received_messages:
+            self.handle_received_message(message, address)
+        if recovered_message_data != None:
+            self.handle_recovered_packet(recovered_message_data, address)
+
+    # a packet that was lost, but recovered by forward error correction. Only its reliable messages are still relevant
+    def handle_recovered_packet(self, message_data: bytes, address):
+        try:
+            recovered_messages = wirecodec.decode_messages(message_data)
+        except wirecodec.WireFormatError as exception:
+            print(f"WARNING: Dropped a malformed recovered packet. {exception}")
+            return
 
-        if reliable_message.id in received_reliable_message_id_storage:
+        for message in recovered_messages:
+            if isinstance(message, ReliableMessage):
+                self.handle_received_message(message, address)
+
+    @abstractmethod
+    def handle_received_message(self, message, address):
+        pass
+
+    # returns the payload, or None if the message is a duplicate
+    def handle_reliable_message(self, reliable_message: ReliableMessage, connection: Connection):
+        is_new = connection.receive_reliable_sequence(reliable_message.sequence)
+        self.unconfirmed_message_storage.wake() # for a possible standalone ack
+
+        return reliable_message.payload if is_new else None
+
+    # undoes fragmentation and compression. Returns the original message, or None if it isn't complete yet (or is malformed)
+    def unwrap_message(self, message, connection: Connection):
+        try:
+            if isinstance(message, MessageFragment):
+                data = connection.fragment_reassembler.add(message)
+                if data == None:
+                    return None
+                message = wirecodec.decode_complete_message(data)
+
+            if isinstance(message, compression.CompressedMessage):
+                if self.socket.compressor == None:
+                    raise wirecodec.WireFormatError("Compression is disabled.")
+                message = self.socket.compressor.decompress(message)
+        except wirecodec.WireFormatError as exception:
+            print(f"WARNING: Dropped a malformed {type(message).__name__}. {exception}")
             return None
-        else:
-            received_reliable_message_id_storage.add(reliable_message.id)
-            return reliable_message.payload
+
+        return message
 
     def reliable_message_resend_mainloop(self):
         while self.running:
-            for message in self.unconfirmed_message_storage.get_messages():
-                now = time()
-                time_since_last_send = now - message.last_send_time
+            max_sleep = self.run_resend_iteration()
+            self.unconfirmed_message_storage.wait_for_next_deadline(max_sleep)
+
+    # sends everything that is due. Returns how long (in seconds) until this should be called again, at most
+    def run_resend_iteration(self) -> float:
+        for message in self.unconfirmed_message_storage.get_due_messages():
+            message.connection.statistics.on_retransmission()
+            self.socket.send_packet(message.encoded_message, message.connection, is_reliable=True)
+
+        self.flush_stale_batches()
+        self.send_stale_fec_parities()
+        self.send_standalone_acks()
+        self.send_heartbeats()
+        self.remove_timed_out_connections()
+
+        max_sleep = RESEND_THREAD_MAX_SLEEP
+        if self.has_pending_batches():
+            max_sleep = min(max_sleep, MAX_BATCH_DELAY)
+        if any(connection.fec_encoder != None and connection.fec_encoder.has_pending_group() for connection in self.get_connections()):
+            max_sleep = min(max_sleep, fec.MAX_FEC_GROUP_DELAY)
+        if any(connection.ack_pending_since != None for connection in self.get_connections()):
+            max_sleep = min(max_sleep, ACK_DELAY)
+        return max_sleep / 1000
+
+    # acks that no packet has carried within ACK_DELAY are sent in a packet without messages
+    def send_standalone_acks(self):
+        for connection in self.get_connections():
+            if connection.is_standalone_ack_due():
+                self.socket.send_packet(b"", connection)
+
+    def send_stale_fec_parities(self):
+        for connection in self.get_connections():
+            if connection.fec_encoder != None and connection.fec_encoder.is_stale():
+                self.socket.send_fec_parity(connection)
+
+    def send_heartbeats(self):
+        for connection in self.get_connections():
+            if connection.is_heartbeat_due():
+                self.socket.send_packet(b"", connection)
+
+    def remove_timed_out_connections(self):
+        pass
+
+    @abstractmethod
+    def get_connections(self) -> list[Connection]:
+        pass
 
-                if time_since_last_send > (RELIABLE_MESSAGE_RESEND_DELAY / 1000):
-                    self.socket.send_to(message.message, message.address)
-                    message.last_send_time = now
+    def find_connection(self, address) -> Optional[Connection]:
+        for connection in self.get_connections():
+            if connection.address == address:
+                return connection
+        return None
+
+    # rolling statistics of the endpoint and each of its connections, see networkstatistics.py
+    def get_statistics(self) -> dict:
+        unconfirmed_counts = self.unconfirmed_message_storage.get_count_by_address()
+        connection_statistics = {}
+        for connection in self.get_connections():
+            statistics = connection.get_statistics()
+            statistics["unconfirmed_messages"] = unconfirmed_counts.get(connection.address, 0)
+            connection_statistics[connection.get_name()] = statistics
+
+        return {
+            "received_queue_depth": self.message_storage.message_count,
+            "superseded_received_messages": self.message_storage.superseded_message_count,
+            "capped_received_messages": self.message_storage.capped_message_count,
+            "unconfirmed_messages": sum(unconfirmed_counts.values()),
+            "dropped_reliable_messages": self.unconfirmed_message_storage.dropped_message_count,
+            "dropped_sent_packets": self.socket.dropped_send_count,
+            "compression": None if self.socket.compressor == None else self.socket.compressor.statistics.to_dict(),
+            "connections": connection_statistics
+        }
+
+    def get_statistics_json(self) -> str:
+        return networkstatistics.to_json(self.get_statistics())
+
+    # sends batches, that have waited too long for a flush
+    def flush_stale_batches(self):
+        pass
 
-            sleep(RESEND_MESSAGE_RESEND_ITERATION_DELAY / 1000)
+    def has_pending_batches(self):
+        return False
 
     @abstractmethod
     def poll_messages(self, type_to_poll: type = object) -> list:
         pass
 
     def enqueue_message(self, message):
-        self.message_storage.add(message)
+        batch = getattr(self.enqueue_batch, "messages", None)
+        if batch != None:
+            batch.append(message)
+        else:
+            self.message_storage.add(message)
+
+    # the messages this thread enqueues within the block are stored at the end, with one lock acquisition
+    @contextmanager
+    def enqueueing_in_batch(self):
+        self.enqueue_batch.messages = []
+        try:
+            yield
+        finally:
+            batch = self.enqueue_batch.messages
+            self.enqueue_batch.messages = None
+            self.message_storage.add_all(batch)
+
+    # returns false if a message of the sender would be dropped by the cap of the message storage
+    def has_room_for_message_of(self, sender) -> bool:
+        batch = getattr(self.enqueue_batch, "messages", None)
+        pending_count = 0 if batch == None else sum(1 for message in batch if self.message_storage.get_sender(message) == sender)
+        return self.message_storage.has_room_for(sender, pending_count)
+
+    # drops the sender's unhandled messages, including those this thread hasn't stored yet
+    def remove_messages_of_sender(self, sender):
+        batch = getattr(self.enqueue_batch, "messages", None)
+        if batch != None:
+            batch[:] = [message for message in batch if self.message_storage.get_sender(message) != sender]
+        self.message_storage.remove_sender(sender)
 
 class CommunicationServer(CommunicationEndpoint):
 
-    # if external_address is provided, port forwarding will be set up
-    def __init__(self, private_address: tuple[str, int], external_address: Optional[tuple[str, int]] = None, start = False):
+    # if external_address is provided, port forwarding will be set up.
+    # if multicast_address (group, port) is provided, snapshots are published to it (see LAN multicast at the top).
+    # By default, a UDP socket bound to private_address is used as the transport
+    def __init__(self, private_address: tuple[str, int], external_address: Optional[tuple[str, int]] = None, start = False, transport: Optional[Transport] = None, multicast_address: Optional[tuple[str, int]] = None):
         self.private_address = private_address
         self.external_address = external_address
+        self.multicast_address = multicast_address
+        self.multicast_snapshot_sender = snapshot.SharedSnapshotSender()
+        self.multicast_statistics = networkstatistics.ConnectionStatistics()
 
         self.hosting_client: Optional[HostingCommunicationClient] = None
         self.connected_players: dict[ObjectId, ServerSidePlayerHandle] = {}
-
-        message_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-        message_socket.bind(private_address)
-
-        super().__init__(message_socket, "comm-server-resend")
+        self.players_by_address: dict[tuple[str, int], ServerSidePlayerHandle] = {}
+        self.disconnected_players_lock = threading.Lock()
+        self.disconnected_player_ids: list[ObjectId] = [] # not yet polled
+        self.departed_player_ids: deque[ObjectId] = deque(maxlen=DEPARTED_PLAYER_MEMORY) # sent a DisconnectMessage or timed out
+        self.local_player_entity_ids: set[ObjectId] = set() # entities the hosting client got in the last snapshot
+
+        if transport == None:
+            transport = create_udp_socket(private_address)
+        if self.multicast_address != None:
+            if isinstance(transport, HighLevelSocket):
+                enable_multicast_sending(transport.socket, private_address[0])
+            else:
+                print("WARNING: Multicast needs a UDP transport, snapshots are sent over unicast.")
+                self.multicast_address = None
+
+        super().__init__(transport, "comm-server-resend",
+            get_message_type=lambda message: type(message.payload),
+            get_sender=lambda message: message.sender_id,
+            max_messages_per_sender=MAX_QUEUED_MESSAGES_PER_PLAYER
+        )
         self.add_thread(threading.Thread(target=self.inwards_message_mainloop, daemon=True), "comm-server")
 
         if self.external_address != None:
@@ -196,20 +1260,54 @@ class CommunicationServer(CommunicationEndpoint):
         if start:
             self.start()
 
-    def inwards_message_mainloop(self):
-        while self.running:
-            message, address = self.socket.receive_message()
+    def handle_received_message(self, message, address):
+        # packets come from untrusted peers, so check the types before trusting the structure
+        payload = message.payload if isinstance(message, ReliableMessage) else message
+        if not is_valid_message_to_server(payload):
+            print(f"WARNING: Dropped an unexpected {type(payload).__name__} from {address}.")
+            return
+        if isinstance(payload.payload, WRAPPER_MESSAGE_TYPES) and not isinstance(message, ReliableMessage):
+            print(f"WARNING: Dropped an unreliable {type(payload.payload).__name__} from {address}.")
+            return
 
-            if isinstance(message, MessageConfirmation):
-                self.unconfirmed_message_storage.recieve_confirmation(message)
-                continue
+        if isinstance(message, ReliableMessage):
+            connection = self.get_player_connection(message.payload.sender_id, address)
+            if connection == None:
+                return
+            is_new = not connection.has_received_reliable_sequence(message.sequence)
+            if is_new and not self.is_within_limits(message.payload, connection, is_reliable=True):
+                return # not acked, so the client sends it again
+            message = self.handle_reliable_message(message, connection)
+            if message == None:
+                return
+
+            if isinstance(message.payload, WRAPPER_MESSAGE_TYPES):
+                payload = self.unwrap_message(message.payload, connection)
+                if payload == None:
+                    return
+                if not isinstance(payload, messages.MessageToServer) or isinstance(payload, WRAPPER_MESSAGE_TYPES):
+                    print(f"WARNING: Dropped an unexpected wrapped {type(payload).__name__} from {address}.")
+                    return
+                message = messages.MessageToServerWithId(message.sender_id, payload)
+        elif not self.is_within_limits(message, self.connected_players.get(message.sender_id)):
+            return
 
-            if isinstance(message, ReliableMessage):
-                message = self.handle_reliable_message(message, address, self.get_reliable_message_id_storage(message, address))
-                if message == None:
-                    continue
+        self.handle_message(message, address)
+
+    # the limits of the messages a client sends to the game (see ratelimiting.py). The hosting client isn't limited.
+    # Wrapped messages count as their wrapper, as they are checked before they're acked
+    def is_within_limits(self, message: messages.MessageToServerWithId, player: Optional["ServerSidePlayerHandle"], is_reliable = False) -> bool:
+        if player == None or isinstance(message.payload, ENDPOINT_MESSAGE_TYPES):
+            return True
+        if is_reliable and not self.has_room_for_message_of(message.sender_id):
+            return False
 
-            self.handle_message(message, address)
+        message_type = type(message.payload)
+        if not player.rate_limiter.allow(message_type):
+            if player.rate_limiter.dropped_counts[message_type.__name__] == 1:
+                print(f"WARNING: Player {player.id} sends too many {message_type.__name__}s, throttling them.")
+            return False
+        return True
 
     def port_forwarding_mainloop(self):
         assert self.external_address != None
@@ -221,32 +1319,221 @@ class CommunicationServer(CommunicationEndpoint):
 
     def handle_message(self, message: messages.MessageToServerWithId, address):
         assert(isinstance(message, messages.MessageToServerWithId))
+        if isinstance(message.payload, DisconnectMessage):
+            self.departed_player_ids.append(message.sender_id)
+            self.remove_player(message.sender_id, "left")
+            return
+        if message.sender_id not in self.connected_players and message.sender_id in self.departed_player_ids:
+            return # arrived after the disconnect
+
         self.add_player_if_new(message.sender_id, address)
+
+        if isinstance(message.payload, snapshot.SnapshotAck):
+            player = self.connected_players.get(message.sender_id)
+            if player != None:
+                player.snapshot_sender.receive_ack(message.payload.snapshot_id)
+                player.congestion_controller.on_snapshot_acked(message.payload.snapshot_id)
+            return
+        if isinstance(message.payload, (MulticastSubscribed, MulticastSnapshotAck)):
+            player = self.connected_players.get(message.sender_id)
+            if player != None and self.multicast_address != None:
+                self.handle_multicast_message(message.payload, player)
+            return
+
         self.enqueue_message(message)
 
-    def get_reliable_message_id_storage(self, message, address):
-        player_id = message.payload.sender_id
+    def handle_multicast_message(self, message, player: "ServerSidePlayerHandle"):
+        if isinstance(message, MulticastSubscribed):
+            player.last_multicast_ack_time = time() # the subscription gets MULTICAST_ACK_TIMEOUT to prove it works
+            self.multicast_snapshot_sender.add_receiver(player.id)
+            player.is_multicast_subscriber = True
+        elif player.is_multicast_subscriber:
+            player.last_multicast_ack_time = time()
+            self.multicast_snapshot_sender.receive_ack_from(player.id, message.snapshot_id)
+
+    def unsubscribe_from_multicast(self, player: "ServerSidePlayerHandle"):
+        player.is_multicast_subscriber = False
+        self.multicast_snapshot_sender.remove_receiver(player.id)
+
+    def get_player_connection(self, player_id: ObjectId, address) -> Optional[Connection]:
         self.add_player_if_new(player_id, address)
-        return self.connected_players[player_id].reliable_message_id_storage
+        return self.connected_players.get(player_id)
 
+    # called for every received message, so the common case (a known player) is checked first
     def add_player_if_new(self, player_id: messages.ObjectId, address):
-        known_ids = list(self.connected_players.keys())
-        if self.hosting_client != None:
-            known_ids.append(self.hosting_client.id)
+        if player_id in self.connected_players or self.is_local_player(player_id):
+            return
+
+        if player_id not in self.departed_player_ids:
+            player = ServerSidePlayerHandle(player_id, address)
+            self.connected_players[player_id] = player
+            self.players_by_address[address] = player
+
+            if self.multicast_address != None:
+                notification = MulticastChannelNotification(*self.multicast_address)
+                self.socket.send_to_reliable(notification, player, self.unconfirmed_message_storage)
+
+    def remove_player(self, player_id: ObjectId, reason: str):
+        player = self.connected_players.pop(player_id, None)
+        if player == None:
+            return
 
-        if player_id not in known_ids:
-            self.connected_players[player_id] = ServerSidePlayerHandle(player_id, address)
+        self.players_by_address.pop(player.address, None)
+        self.unconfirmed_message_storage.remove_connection(player.address)
+        self.unsubscribe_from_multicast(player)
+        self.remove_messages_of_sender(player_id)
+        with self.disconnected_players_lock:
+            self.disconnected_player_ids.append(player_id)
+        print(f"Player {player_id} disconnected ({reason}).")
 
+    def remove_timed_out_connections(self):
+        for player in list(self.connected_players.values()):
+            if player.has_timed_out():
+                self.departed_player_ids.append(player.id)
+                self.remove_player(player.id, "timed out")
+
+    # returns the ids of the players, that have disconnected since the last call
+    def poll_disconnected_players(self) -> list[ObjectId]:
+        with self.disconnected_players_lock:
+            disconnected_player_ids = self.disconnected_player_ids
+            self.disconnected_player_ids = []
+            return disconnected_player_ids
+
+    # messages are queued, and sent on the next flush
+    # the message is encoded once, and the same bytes are queued for every player
     def send_to_all(self, message):
-        for player in self.connected_players.values():
-            self.socket.send_to(message, player.address)
+        encoded_message = wirecodec.encode_message(message)
+        for player in list(self.connected_players.values()):
+            player.outgoing_batch.add(encoded_message)
 
         if self.hosting_client != None:
             self.hosting_client.handle_message(message)
 
-    def send_to_all_reliable(self, message):
+    # state_messages: state of every entity (e.g. PlayerStateUpdate). Sent delta compressed, separately for each client
+    def send_snapshot_to_all(self, state_messages: list):
         for player in list(self.connected_players.values()):
-            self.socket.send_to_reliable(message, player.address, self.unconfirmed_message_storage)
+            self.send_snapshot(state_messages, player)
+
+        if self.hosting_client != None:
+            for message in state_messages:
+                self.hosting_client.handle_message(message)
+
+    # the hosting client runs in the same process
+    def is_local_player(self, player_id: ObjectId):
+        return self.hosting_client != None and self.hosting_client.id == player_id
+
+    # false once the player has been removed. A message polled after that mustn't add the player back to the game
+    def is_player_connected(self, player_id: ObjectId):
+        return player_id in self.connected_players or self.is_local_player(player_id)
+
+    # state_messages: the entities this player should have. Others are removed on the client.
+    # held_entity_ids: entities that aren't updated this time (see snapshot.SnapshotSender)
+    # priorities: priority of each entity id (see the bandwidth budget comment at the top). Default 1.
+    # Also sends the player's scheduled reliable messages, that fit into the budget.
+    # Multicast subscribers get only the scheduled messages, their snapshots are sent by send_multicast_snapshot
+    def send_snapshot_to(self, state_messages: list, player_id: ObjectId, held_entity_ids: set[ObjectId] = set(), priorities: dict[ObjectId, float] = {}):
+        if self.hosting_client != None and self.is_local_player(player_id):
+            for message in state_messages:
+                self.hosting_client.handle_message(message)
+
+            # the same removals remote clients get from their snapshots
+            entity_ids = {snapshot.get_entity_id(message) for message in state_messages} | held_entity_ids
+            for entity_id in self.local_player_entity_ids - entity_ids:
+                self.hosting_client.handle_message(messages.EntityRemovedNotification(entity_id))
+            self.local_player_entity_ids = entity_ids
+            return
+
+        player = self.connected_players.get(player_id)
+        if player == None:
+            return
+        sends_snapshot = not player.is_multicast_subscriber
+        if sends_snapshot and not player.congestion_controller.should_send_snapshot():
+            return
+
+        items = []
+        for state_message in state_messages if sends_snapshot else []:
+            entity_id = snapshot.get_entity_id(state_message)
+            if entity_id not in held_entity_ids:
+                items.append(ScheduledItem(entity_id, priorities.get(entity_id, 1.0), player.snapshot_sender.get_delta_size(state_message)))
+        candidate_entity_ids = {item.key for item in items}
+        # while the client is behind, scheduled messages wait (and coalesce)
+        if not self.is_saturated(player_id):
+            items += [ScheduledItem(key, priority, len(message.data) + RELIABLE_MESSAGE_OVERHEAD) for key, (message, priority) in player.scheduled_messages.items()]
+
+        byte_budget = player.tick_byte_budget - snapshot.get_encoded_size_without_deltas([])
+        selected_keys = {item.key for item in player.priority_scheduler.schedule(items, byte_budget)}
+
+        if sends_snapshot:
+            deferred_entity_ids = candidate_entity_ids - selected_keys
+            self.send_snapshot(state_messages, player, held_entity_ids | deferred_entity_ids)
+
+        for key in selected_keys & player.scheduled_messages.keys():
+            message, _ = player.scheduled_messages.pop(key)
+            self.socket.send_to_reliable(message, player, self.unconfirmed_message_storage, player.outgoing_batch, supersede_key=key, is_compressed=True)
+
+    def send_snapshot(self, state_messages: list, player: "ServerSidePlayerHandle", held_entity_ids: set[ObjectId] = set()):
+        deltas = player.snapshot_sender.get_delta_messages(state_messages, MAX_PACKET_DATA_SIZE, held_entity_ids)
+        for delta in deltas:
+            player.outgoing_batch.add(wirecodec.encode_message(delta))
+        player.congestion_controller.on_snapshot_sent(deltas[0].snapshot_id)
+
+    # state_messages: state of every entity. Published once to the multicast group, if there are subscribers.
+    # Call this once per tick, in addition to send_snapshot_to
+    def send_multicast_snapshot(self, state_messages: list):
+        if self.multicast_address == None:
+            return
+
+        for player in list(self.connected_players.values()):
+            if player.is_multicast_subscriber and time() - player.last_multicast_ack_time > MULTICAST_ACK_TIMEOUT / 1000:
+                print(f"WARNING: Player {player.id} hasn't acked multicast snapshots, sending its snapshots over unicast.")
+                self.unsubscribe_from_multicast(player)
+        if not self.multicast_snapshot_sender.has_receivers():
+            return
+
+        batch = OutgoingPacketBatch()
+        for delta in self.multicast_snapshot_sender.get_delta_messages(state_messages, MAX_PACKET_DATA_SIZE):
+            batch.add(wirecodec.encode_message(delta))
+        for message_data, _ in batch.take_packets():
+            packet = wirecodec.encode_packet(message_data) # no acks, they are per connection
+            self.multicast_statistics.on_packet_sent(len(packet))
+            self.socket.send_datagram(packet, self.multicast_address)
+
+    def get_multicast_subscribers(self) -> list[ObjectId]:
+        return [id for id, player in list(self.connected_players.items()) if player.is_multicast_subscriber]
+
+    def get_statistics(self) -> dict:
+        statistics = super().get_statistics()
+        statistics["rate_limited_messages"] = sum(player.rate_limiter.get_dropped_count() for player in list(self.connected_players.values()))
+        if self.multicast_address != None:
+            statistics["multicast"] = {
+                "subscribers": len(self.get_multicast_subscribers()),
+                "sent_packets_per_s": self.multicast_statistics.sent_packets.get_count() / networkstatistics.STATISTICS_WINDOW,
+                "sent_bytes_per_s": self.multicast_statistics.sent_packets.get_rate(),
+                "total_sent_bytes": self.multicast_statistics.total_sent_bytes
+            }
+        return statistics
+
+    # snapshots per second each client currently gets
+    def get_snapshot_rates(self) -> dict[ObjectId, float]:
+        return {id: player.congestion_controller.snapshot_rate for id, player in list(self.connected_players.items())}
+
+    # the payload is compressed and encoded once. Only the sequence number differs between players.
+    # supersede_key: see UncofirmedMessageStorage.add_message
+    def send_to_all_reliable(self, message, supersede_key = None):
+        encoded_payload = wirecodec.EncodedMessage(wirecodec.encode_message(self.socket.compress(message)))
+        for player in list(self.connected_players.values()):
+            self.socket.send_to_reliable(encoded_payload, player, self.unconfirmed_message_storage, player.outgoing_batch, supersede_key, is_compressed=True)
+
+        if self.hosting_client != None:
+            self.hosting_client.handle_message(message)
+
+    # sent reliably when the player's bandwidth budget allows (see send_snapshot_to).
+    # A message replaces the unsent message with the same key (e.g. an older state of the same wall).
+    # Keys must not collide with entity ids. The message is compressed and encoded once
+    def send_to_all_reliable_scheduled(self, message, key, priority: float):
+        encoded_message = wirecodec.EncodedMessage(wirecodec.encode_message(self.socket.compress(message)))
+        for player in list(self.connected_players.values()):
+            player.scheduled_messages[key] = (encoded_message, priority)
 
         if self.hosting_client != None:
             self.hosting_client.handle_message(message)
@@ -257,21 +1544,48 @@ class CommunicationServer(CommunicationEndpoint):
             return
         
         client = self.connected_players[player_id]
-        self.socket.send_to(message, client.address)
+        client.outgoing_batch.add(wirecodec.encode_message(message))
 
-    def send_reliable_to(self, message, player_id: ObjectId):
+    def send_reliable_to(self, message, player_id: ObjectId, supersede_key = None):
         if self.hosting_client != None and self.hosting_client.id == player_id:
             self.hosting_client.handle_message(message)
             return
         
         client = self.connected_players[player_id]
-        self.socket.send_to_reliable(message, client.address, self.unconfirmed_message_storage)
+        self.socket.send_to_reliable(message, client, self.unconfirmed_message_storage, client.outgoing_batch, supersede_key)
+
+    # true if the player has so many unconfirmed reliable messages, that anything skippable should be skipped
+    def is_saturated(self, player_id: ObjectId):
+        player = self.connected_players.get(player_id)
+        return player != None and self.unconfirmed_message_storage.is_saturated(player.address)
+
+    def get_saturated_players(self) -> list[ObjectId]:
+        return [id for id in list(self.connected_players) if self.is_saturated(id)]
+
+    # sends everything queued since the last flush, call this at the end of every tick
+    def flush(self):
+        for player in list(self.connected_players.values()):
+            self.socket.send_batch(player.outgoing_batch, player)
+
+    def flush_stale_batches(self):
+        for player in list(self.connected_players.values()):
+            if player.outgoing_batch.is_stale():
+                self.socket.send_batch(player.outgoing_batch, player)
+
+    def has_pending_batches(self):
+        return any(len(player.outgoing_batch.packets) > 0 for player in list(self.connected_players.values()))
+
+    def get_connections(self) -> list[Connection]:
+        return list(self.connected_players.values())
+
+    def find_connection(self, address) -> Optional[Connection]:
+        return self.players_by_address.get(address)
 
     def poll_messages(self, type_to_poll: type = object) -> list[messages.MessageToServerWithId]:
-        return self.message_storage.poll(lambda message: isinstance(message.payload, type_to_poll))
+        return self.message_storage.poll(type_to_poll)
     
     def remove_messages_of_other_types(self, valid_type: type = object):
-        self.message_storage.remove_non_matching(lambda message: isinstance(message.payload, valid_type))
+        self.message_storage.remove_non_matching(valid_type)
 
 class CommunicationClient(ABC):
 
@@ -282,8 +1596,9 @@ class CommunicationClient(ABC):
     def send(self, message):
         pass
 
+    # supersede_key: see UncofirmedMessageStorage.add_message
     @abstractmethod
-    def send_reliable(self, message):
+    def send_reliable(self, message, supersede_key = None):
         pass
 
     @abstractmethod
@@ -294,48 +1609,146 @@ class CommunicationClient(ABC):
     def remove_messages_of_other_types(self, valid_type: type = object):
         pass
 
+    # true once the server has been silent for CONNECTION_TIMEOUT (see connection lifecycle). Never for the hosting client
+    def has_lost_connection(self):
+        return False
+
+    # see CommunicationEndpoint.get_statistics
+    @abstractmethod
+    def get_statistics(self) -> dict:
+        pass
+
 class InternetCommunicationClient(CommunicationEndpoint, CommunicationClient):
 
-    def __init__(self, own_address, server_address, start = False):
+    # by default, a UDP socket bound to own_address is used as the transport
+    def __init__(self, own_address, server_address, start = False, transport: Optional[Transport] = None):
         CommunicationClient.__init__(self)
-        self.reliable_message_id_storage = ConstSizeQueue(RELIABLE_MESSAGE_ID_STORAGE_SIZE) #ids of received reliable messages
+        self.server_connection = Connection(server_address)
+        self.snapshot_receiver = snapshot.SnapshotReceiver()
+        self.multicast_snapshot_receiver = snapshot.SnapshotReceiver() # the multicast snapshots are numbered separately
+        self.multicast_socket: Optional[HighLevelSocket] = None
         self.server_address = server_address
 
-        message_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-        message_socket.bind(own_address)
-        CommunicationEndpoint.__init__(self, message_socket, "inet-comm-client-resend")
+        if transport == None:
+            transport = create_udp_socket(own_address)
+        CommunicationEndpoint.__init__(self, transport, "inet-comm-client-resend")
         self.add_thread(threading.Thread(target=self.inwards_message_mainloop, daemon=True), "inet-comm-client")
 
         if start:
             self.start()
 
-    def inwards_message_mainloop(self):
+    # anyone can send to the client's port, only the server is listened to
+    def handle_packet(self, packet: bytes, address):
+        if address != self.server_address:
+            return
+        CommunicationEndpoint.handle_packet(self, packet, address)
+
+    def handle_received_message(self, message, address):
+        if isinstance(message, ReliableMessage):
+            message = self.handle_reliable_message(message, self.server_connection)
+            if message == None:
+                return
+
+            message = self.unwrap_message(message, self.server_connection)
+            if message == None:
+                return
+
+        if isinstance(message, snapshot.WorldSnapshotDelta):
+            self.handle_snapshot_delta(message, self.snapshot_receiver, snapshot.SnapshotAck)
+            return
+        if isinstance(message, MulticastChannelNotification):
+            self.join_multicast_group((message.group, message.port))
+            return
+
+        if not isinstance(message, messages.MessageToClient):
+            print(f"WARNING: Dropped an unexpected {type(message).__name__} from the server.")
+            return
+        self.enqueue_message(message)
+
+    # the reconstructed state messages are enqueued like any other message
+    def handle_snapshot_delta(self, delta: snapshot.WorldSnapshotDelta, snapshot_receiver: snapshot.SnapshotReceiver, ack_type: type):
+        try:
+            state_messages, removed_entity_ids, completed_snapshot_id = snapshot_receiver.receive(delta)
+        except wirecodec.WireFormatError as exception:
+            print(f"WARNING: Dropped an invalid snapshot part. {exception}")
+            return
+
+        for state_message in state_messages:
+            self.enqueue_message(state_message)
+        for entity_id in removed_entity_ids:
+            self.enqueue_message(messages.EntityRemovedNotification(entity_id))
+
+        if completed_snapshot_id != None:
+            self.send(ack_type(completed_snapshot_id))
+
+    # see LAN multicast at the top. If the group can't be joined, the snapshots keep coming over unicast
+    def join_multicast_group(self, group_address: tuple[str, int]):
+        if self.multicast_socket != None:
+            return
+        if self.message_socket == None:
+            print("WARNING: Multicast needs a UDP transport, snapshots are received over unicast.")
+            return
+        if group_address[1] == self.message_socket.getsockname()[1]:
+            print(f"WARNING: The multicast port {group_address[1]} is the client's own port, snapshots are received over unicast.")
+            return
+
+        try:
+            self.multicast_socket = create_multicast_socket(group_address, self.message_socket.getsockname()[0])
+        except OSError as exception:
+            print(f"WARNING: Couldn't join multicast group {group_address[0]}:{group_address[1]}, snapshots are received over unicast. {exception}")
+            return
+
+        self.add_thread(threading.Thread(target=self.multicast_mainloop, daemon=True), "inet-comm-client-multicast")
+        self.send_reliable(MulticastSubscribed())
+
+    def multicast_mainloop(self):
+        assert self.multicast_socket != None
         while self.running:
-            message, address = self.socket.receive_message()
+            packets = self.multicast_socket.receive_packets()
+            with self.enqueueing_in_batch():
+                for packet, address in packets:
+                    self.handle_multicast_packet(packet, address)
+        self.multicast_socket.socket.close()
+
+    # only snapshots from the server are accepted from the group
+    def handle_multicast_packet(self, packet: bytes, address):
+        if address != self.server_address:
+            return
+        self.server_connection.statistics.on_packet_received(len(packet))
 
-            if isinstance(message, MessageConfirmation):
-                self.unconfirmed_message_storage.recieve_confirmation(message)
-                continue
+        try:
+            _, _, message_data = wirecodec.decode_packet_header(packet)
+            received_messages = wirecodec.decode_messages(message_data)
+        except wirecodec.WireFormatError as exception:
+            print(f"WARNING: Dropped a malformed multicast packet. {exception}")
+            return
 
-            if isinstance(message, ReliableMessage):
-                message = self.handle_reliable_message(message, address, self.reliable_message_id_storage)
-                if message == None:
-                    continue
+        for message in received_messages:
+            if isinstance(message, snapshot.WorldSnapshotDelta):
+                self.handle_snapshot_delta(message, self.multicast_snapshot_receiver, MulticastSnapshotAck)
+
+    def get_connections(self) -> list[Connection]:
+        return [self.server_connection]
 
-            assert(isinstance(message, messages.MessageToClient))
-            self.enqueue_message(message)
+    def has_lost_connection(self):
+        return self.server_connection.has_timed_out()
+
+    def stop(self, asyncronous = False):
+        for _ in range(DISCONNECT_MESSAGE_SEND_COUNT):
+            self.send(DisconnectMessage())
+        CommunicationEndpoint.stop(self, asyncronous)
 
     def send(self, message):
-        self.socket.send_to(messages.MessageToServerWithId(self.id, message), self.server_address)
+        self.socket.send_to(messages.MessageToServerWithId(self.id, message), self.server_connection)
 
-    def send_reliable(self, message):
-        self.socket.send_to_reliable(messages.MessageToServerWithId(self.id, message), self.server_address, self.unconfirmed_message_storage)
+    def send_reliable(self, message, supersede_key = None):
+        self.socket.send_to_reliable(messages.MessageToServerWithId(self.id, message), self.server_connection, self.unconfirmed_message_storage, supersede_key=supersede_key)
 
     def poll_messages(self, type_to_poll: type = object) -> list:
-        return self.message_storage.poll(lambda message: isinstance(message, type_to_poll))
+        return self.message_storage.poll(type_to_poll)
 
     def remove_messages_of_other_types(self, valid_type: type = object):
-        self.message_storage.remove_non_matching(lambda message: isinstance(message, valid_type))
+        self.message_storage.remove_non_matching(valid_type)
 
 # on the same machine as server, doesn't need internet
 class HostingCommunicationClient(CommunicationClient):
@@ -343,7 +1756,7 @@ class HostingCommunicationClient(CommunicationClient):
     def __init__(self, server: CommunicationServer):
         CommunicationClient.__init__(self)
         self.server = server
-        self.message_storage = ReceivedMessageStorage()
+        self.message_storage = ReceivedMessageStorage(get_slot_key=get_latest_value_slot_key)
 
     def handle_message(self, message: messages.MessageToClient):
         self.message_storage.add(message)
@@ -352,18 +1765,84 @@ class HostingCommunicationClient(CommunicationClient):
         message = messages.MessageToServerWithId(self.id, message)
         self.server.handle_message(message, ("direct", 0))
 
-    def send_reliable(self, message):
+    def send_reliable(self, message, supersede_key = None):
         self.send(message)
 
+    # the host has no connection of its own, so it sees the server's connections
+    def get_statistics(self) -> dict:
+        return self.server.get_statistics()
+
     def poll_messages(self, type_to_poll: type = object) -> list:
-        return self.message_storage.poll(lambda message: isinstance(message, type_to_poll))
+        return self.message_storage.poll(type_to_poll)
     
     def remove_messages_of_other_types(self, valid_type: type = object):
-        self.message_storage.remove_non_matching(lambda message: isinstance(message, valid_type))
+        self.message_storage.remove_non_matching(valid_type)
 
-class ServerSidePlayerHandle:
+class ServerSidePlayerHandle(Connection):
 
     def __init__(self, player_id: messages.ObjectId, address: tuple[str, int]):
+        Connection.__init__(self, address)
         self.id = player_id
-        self.address = address
-        self.reliable_message_id_storage = ConstSizeQueue(RELIABLE_MESSAGE_ID_STORAGE_SIZE)
+        self.outgoing_batch = OutgoingPacketBatch()
+        self.snapshot_sender = snapshot.SnapshotSender()
+        self.congestion_controller = CongestionController(self)
+        self.tick_byte_budget = DEFAULT_TICK_BYTE_BUDGET
+        self.priority_scheduler = PriorityScheduler()
+        self.scheduled_messages: dict[object, tuple[wirecodec.EncodedMessage, float]] = {} # keys are given by the sender, values are (message, priority)
+        self.is_multicast_subscriber = False
+        self.last_multicast_ack_time = 0.0
+        self.rate_limiter = ratelimiting.RateLimiter() # of the messages to the game
+
+    def get_retransmission_timeout(self, resend_count: int = 0):
+        timeout = Connection.get_retransmission_timeout(self, resend_count) * self.congestion_controller.get_retransmission_backoff()
+        return min(MAX_RETRANSMISSION_TIMEOUT / 1000, timeout)
+
+    def get_initial_send_count(self):
+        return 1 if self.congestion_controller.is_congested() else super().get_initial_send_count()
+
+    def get_name(self):
+        return f"player {self.id}"
+
+    def get_statistics(self) -> dict:
+        statistics = Connection.get_statistics(self)
+        statistics["snapshot_rate"] = self.congestion_controller.snapshot_rate
+        statistics["snapshot_loss_fraction"] = self.congestion_controller.last_loss_fraction
+        statistics["outgoing_batch_packets"] = len(self.outgoing_batch.packets)
+        statistics["scheduled_messages"] = len(self.scheduled_messages)
+        statistics["deferred_items"] = self.priority_scheduler.deferred_item_count
+        statistics["max_starved_ticks"] = self.priority_scheduler.max_starved_ticks
+        statistics["multicast_subscriber"] = self.is_multicast_subscriber
+        statistics["rate_limited_messages"] = dict(self.rate_limiter.dropped_counts)
+        return statistics
+
+# polling latency of ReceivedMessageStorage with many queued messages: polling a family with a few messages
+# should cost the same however many messages of other types wait, and draining should cost the same per message
+if __name__ == "__main__":
+    import sys
+    from time import perf_counter
+
+    REPEATS = 200
+    UNHANDLED_MESSAGE_WARNING_THRESHOLD = sys.maxsize # the messages are left unhandled on purpose
+    queued_counts = [int(a) for a in sys.argv[1:]] if len(sys.argv) > 1 else [0, 1000, 10_000, 100_000]
+    game_messages = [messages.NewPlayerNotification(i, "player") for i in range(max(queued_counts))]
+    lobby_messages = [messages.LobbyStateUpdate(["player"], None) for _ in range(10)]
+
+    for queued_count in queued_counts:
+        storage = ReceivedMessageStorage(get_slot_key=get_latest_value_slot_key)
+        storage.add_all(game_messages[:queued_count])
+
+        poll_time = 0.0
+        for _ in range(REPEATS):
+            storage.add_all(lobby_messages)
+            start_time = perf_counter()
+            polled = storage.poll(messages.LobbyMessage)
+            poll_time += perf_counter() - start_time
+            assert len(polled) == len(lobby_messages)
+
+        start_time = perf_counter()
+        drained = storage.poll(messages.GameMessage)
+        drain_time = perf_counter() - start_time
+        assert len(drained) == queued_count
+
+        drain_text = f", draining them {1e9 * drain_time / queued_count:.0f} ns per message" if queued_count > 0 else ""
+        print(f"{queued_count} game messages queued: polling {len(lobby_messages)} lobby messages {1e6 * poll_time / REPEATS:.1f} us{drain_text}")
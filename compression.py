@@ -0,0 +1,204 @@
+import os
+import zlib
+import struct
+import threading
+import sys
+from collections import Counter
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Optional
+import messages
+import wirecodec
+
+COMPRESSION_ENABLED = True
+COMPRESSION_THRESHOLD = 200 # in bytes, smaller encoded messages aren't worth compressing
+COMPRESSION_LEVEL = 6
+MAX_DECOMPRESSED_SIZE = 1 << 19 # in bytes, bigger messages are dropped (decompression bombs)
+DICTIONARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "compression-dictionary.bin") # not relative to the working directory
+DICTIONARY_SIZE = 4096 # in bytes
+TRAINING_SEGMENT_SIZE = 32 # in bytes
+RECORD_TRAFFIC = False # if true, the messages that are compressed are also appended to TRAFFIC_RECORDING_PATH, for training
+TRAFFIC_RECORDING_PATH = "traffic-recording.bin"
+RECORD_LENGTH = struct.Struct("<I")
+
+# compression of big reliable messages (see communication.Transport.compress):
+# a message whose encoding is at least COMPRESSION_THRESHOLD bytes is deflated with a preset dictionary, and sent
+# wrapped in a CompressedMessage (its tag is the flag telling the receiver to inflate). If it doesn't get smaller,
+# it's sent as is. The dictionary holds byte sequences common in Pyshooter traffic (e.g. the boundary walls),
+# which deflate can refer to even in the first message. It's trained from recorded traffic: set RECORD_TRAFFIC, play, and run
+# "python compression.py", which writes DICTIONARY_PATH and prints how much each message type compresses.
+# Both ends must have the same dictionary, the id in every CompressedMessage makes sure of that. A new dictionary
+# should come with a new wirecodec.CODEC_VERSION, so that mismatched peers drop each other's packets before acking them.
+# Today only ArenaUpdates reach the threshold (a LobbyStateUpdate of 8 long names is about 150 bytes), so the shipped
+# dictionary is trained from ArenaUpdates only: full arenas sent to joining players, and the damaged walls sent during
+# a game. It takes them from 0.65 to 0.64 (full) and from 0.93 to 0.91 (damage) of their size, over deflate without one.
+# Other types that grow past the threshold are compressed too, but their savings haven't been measured
+
+@dataclass
+class CompressedMessage(messages.MessageToServer):
+    dictionary_id: int # adler32 of the dictionary, 1 if there is none
+    data: bytes # raw deflate stream of the encoded message
+
+wirecodec.register_message_type(CompressedMessage, 24, [
+    ("dictionary_id", wirecodec.UINT32),
+    ("data", wirecodec.BYTES)
+])
+
+# a peer without the same dictionary can't decompress anything, so a missing one is an error
+def load_dictionary(path: str = DICTIONARY_PATH) -> bytes:
+    try:
+        with open(path, "rb") as file:
+            return file.read()
+    except OSError as exception:
+        raise Exception(f"Can't read the compression dictionary {path}. Train one with \"python compression.py\", or set COMPRESSION_ENABLED to False.") from exception
+
+# builds a dictionary from encoded messages: the segments that occur in the most samples, the most common
+# last (deflate reaches the end of the dictionary with the shortest distances)
+def train_dictionary(samples: list[bytes], size: int = DICTIONARY_SIZE) -> bytes:
+    counts = Counter()
+    for sample in samples:
+        counts.update({sample[i:i + TRAINING_SEGMENT_SIZE] for i in range(len(sample) - TRAINING_SEGMENT_SIZE + 1)})
+
+    segments = [segment for segment, count in counts.most_common(size // TRAINING_SEGMENT_SIZE) if count > 1]
+    return b"".join(reversed(segments))
+
+def read_recording(path: str = TRAFFIC_RECORDING_PATH) -> list[bytes]:
+    with open(path, "rb") as file:
+        data = file.read()
+
+    samples = []
+    offset = 0
+    while offset + RECORD_LENGTH.size <= len(data):
+        (length,) = RECORD_LENGTH.unpack_from(data, offset)
+        offset += RECORD_LENGTH.size
+        samples.append(data[offset:offset + length])
+        offset += length
+    return samples
+
+def get_type_name(message) -> str:
+    if isinstance(message, wirecodec.EncodedMessage):
+        schema = wirecodec.schemas_by_tag.get(message.data[0])
+        return "?" if schema == None else schema.body.data_type.__name__
+    return type(message).__name__
+
+@dataclass
+class TypeStatistics:
+    compressed_count: int = 0
+    skipped_count: int = 0 # didn't get smaller
+    original_bytes: int = 0
+    compressed_bytes: int = 0
+    compression_time: float = 0 # in seconds, total
+    decompressed_count: int = 0
+    decompression_time: float = 0
+
+# compression ratio and CPU time by message type
+class CompressionStatistics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_type: dict[str, TypeStatistics] = {}
+
+    def get(self, type_name: str) -> TypeStatistics:
+        statistics = self.by_type.get(type_name)
+        if statistics == None:
+            statistics = TypeStatistics()
+            self.by_type[type_name] = statistics
+        return statistics
+
+    def on_compressed(self, type_name: str, original_size: int, compressed_size: int, seconds: float):
+        with self.lock:
+            statistics = self.get(type_name)
+            if compressed_size < original_size:
+                statistics.compressed_count += 1
+            else:
+                statistics.skipped_count += 1
+            statistics.original_bytes += original_size
+            statistics.compressed_bytes += min(original_size, compressed_size)
+            statistics.compression_time += seconds
+
+    def on_decompressed(self, type_name: str, seconds: float):
+        with self.lock:
+            statistics = self.get(type_name)
+            statistics.decompressed_count += 1
+            statistics.decompression_time += seconds
+
+    # ratio is compressed / original, times in micro seconds per message
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {type_name: {
+                "compressed": s.compressed_count,
+                "skipped": s.skipped_count,
+                "ratio": s.compressed_bytes / s.original_bytes if s.original_bytes > 0 else None,
+                "compression_us": 1e6 * s.compression_time / max(1, s.compressed_count + s.skipped_count),
+                "decompressed": s.decompressed_count,
+                "decompression_us": 1e6 * s.decompression_time / max(1, s.decompressed_count)
+            } for type_name, s in self.by_type.items()}
+
+class Compressor:
+
+    # dictionary: None for the one at DICTIONARY_PATH
+    def __init__(self, dictionary: Optional[bytes] = None):
+        self.dictionary = load_dictionary() if dictionary == None else dictionary
+        self.dictionary_id = zlib.adler32(self.dictionary)
+        self.statistics = CompressionStatistics()
+        self.recording_lock = threading.Lock()
+
+    def get_zlib_arguments(self) -> dict:
+        return {"zdict": self.dictionary} if len(self.dictionary) > 0 else {}
+
+    # returns the CompressedMessage to send in place of the encoded message, or None if it doesn't get smaller
+    def compress(self, encoded_message: bytes, type_name: str) -> Optional[CompressedMessage]:
+        if RECORD_TRAFFIC:
+            self.record(encoded_message)
+
+        start_time = perf_counter()
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, **self.get_zlib_arguments())
+        data = compressor.compress(encoded_message) + compressor.flush()
+        compressed_message = CompressedMessage(self.dictionary_id, data)
+        compressed_size = len(wirecodec.encode_message(compressed_message))
+        self.statistics.on_compressed(type_name, len(encoded_message), compressed_size, perf_counter() - start_time)
+
+        return compressed_message if compressed_size < len(encoded_message) else None
+
+    # returns the decoded message. Raises WireFormatError if it can't be decompressed
+    def decompress(self, compressed_message: CompressedMessage):
+        if compressed_message.dictionary_id != self.dictionary_id:
+            raise wirecodec.WireFormatError("The message was compressed with a different dictionary.")
+
+        start_time = perf_counter()
+        try:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS, **self.get_zlib_arguments())
+            data = decompressor.decompress(compressed_message.data, MAX_DECOMPRESSED_SIZE)
+        except zlib.error as exception:
+            raise wirecodec.WireFormatError(f"Invalid compressed data: {exception}") from exception
+        if not decompressor.eof:
+            raise wirecodec.WireFormatError(f"Compressed data is truncated, or decompresses to over {MAX_DECOMPRESSED_SIZE} bytes.")
+
+        message = wirecodec.decode_complete_message(data)
+        self.statistics.on_decompressed(type(message).__name__, perf_counter() - start_time)
+        return message
+
+    def record(self, encoded_message: bytes):
+        with self.recording_lock:
+            with open(TRAFFIC_RECORDING_PATH, "ab") as file:
+                file.write(RECORD_LENGTH.pack(len(encoded_message)))
+                file.write(encoded_message)
+
+# trains the dictionary from a recording, and compares it to compressing without one
+if __name__ == "__main__":
+    recording_path = sys.argv[1] if len(sys.argv) > 1 else TRAFFIC_RECORDING_PATH
+    samples = read_recording(recording_path)
+    dictionary = train_dictionary(samples)
+    with open(DICTIONARY_PATH, "wb") as file:
+        file.write(dictionary)
+    print(f"Trained a {len(dictionary)} byte dictionary from {len(samples)} messages, wrote {DICTIONARY_PATH}")
+
+    for name, compressor in (("no dictionary", Compressor(b"")), ("dictionary", Compressor(dictionary))):
+        for sample in samples:
+            compressed_message = compressor.compress(sample, get_type_name(wirecodec.EncodedMessage(sample)))
+            if compressed_message != None:
+                compressor.decompress(compressed_message)
+
+        print(f"{name}:")
+        for type_name, statistics in compressor.statistics.to_dict().items():
+            print(f"  {type_name}: ratio {statistics['ratio']:.2f}, compression {statistics['compression_us']:.0f} us, decompression {statistics['decompression_us']:.0f} us")
@@ -0,0 +1,149 @@
+import struct
+import threading
+from dataclasses import dataclass, field
+from random import randrange
+from time import time
+from typing import Optional
+import wirecodec
+
+FEC_GROUP_SIZE = 4 # data packets per parity packet
+MAX_FEC_GROUP_DELAY = 20 # in milli seconds, an incomplete group gets its parity packet after this
+RECEIVED_GROUP_MEMORY = 64 # how many groups per connection the receiver keeps, for late parity packets
+LENGTH = struct.Struct("<H")
+
+# forward error correction of reliable messages (optional, see communication.RELIABLE_FEC_ENABLED):
+# instead of sending every reliable message twice, packets carrying reliable messages are sent once, in groups of up to
+# FEC_GROUP_SIZE packets. After each group, a parity packet is sent: the XOR of the message data of the group's packets
+# (each prefixed with its length, and padded to the longest). If one packet of the group is lost, the receiver gets its
+# message data by XORing the parity with the packets it did get, without waiting for a resend.
+# Only the reliable messages of a recovered packet are handled, anything else in it would be stale by now.
+# Losing two packets of a group falls back to the normal resends.
+# The headers and parities come from the network, so the decoder checks them against the group size and the packet size,
+# and raises WireFormatError for anything that can't come from a FecEncoder
+
+# XOR of the length prefixed message data, padded to the longest
+def get_parity(message_datas: list[bytes]) -> bytes:
+    size = LENGTH.size + max(len(message_data) for message_data in message_datas)
+    parity = 0
+    for message_data in message_datas:
+        parity ^= int.from_bytes(LENGTH.pack(len(message_data)) + message_data, "little")
+    return parity.to_bytes(size, "little")
+
+# returns the message data of the only packet of the group, that isn't in message_datas.
+# Raises WireFormatError if the parity doesn't match the packets
+def recover(parity: bytes, message_datas: list[bytes]) -> bytes:
+    if len(parity) < LENGTH.size or any(LENGTH.size + len(message_data) > len(parity) for message_data in message_datas):
+        raise wirecodec.WireFormatError("The parity is shorter than the packets of its group.")
+
+    recovered = int.from_bytes(parity, "little")
+    for message_data in message_datas:
+        recovered ^= int.from_bytes(LENGTH.pack(len(message_data)) + message_data, "little")
+    recovered_bytes = recovered.to_bytes(len(parity), "little")
+
+    (length,) = LENGTH.unpack_from(recovered_bytes)
+    if LENGTH.size + length > len(recovered_bytes):
+        raise wirecodec.WireFormatError("Recovered packet exceeds the parity.")
+    return recovered_bytes[LENGTH.size:LENGTH.size + length]
+
+# the group being sent to one connection. Multiple threads may send
+class FecEncoder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.group_id = randrange(2**32)
+        self.message_datas: list[bytes] = []
+        self.group_start_time = 0.0
+
+    # adds a data packet to the group, returns its header
+    def add(self, message_data: bytes) -> wirecodec.FecHeader:
+        with self.lock:
+            if len(self.message_datas) == 0:
+                self.group_start_time = time()
+            self.message_datas.append(message_data)
+            return wirecodec.FecHeader(self.group_id, len(self.message_datas) - 1)
+
+    def is_full(self):
+        return len(self.message_datas) >= FEC_GROUP_SIZE
+
+    def is_stale(self):
+        return len(self.message_datas) > 0 and time() - self.group_start_time > MAX_FEC_GROUP_DELAY / 1000
+
+    def has_pending_group(self):
+        return len(self.message_datas) > 0
+
+    # ends the group. Returns (header, parity) of its parity packet, or None if the group is empty
+    def take_parity(self) -> Optional[tuple[wirecodec.FecHeader, bytes]]:
+        with self.lock:
+            if len(self.message_datas) == 0:
+                return None
+
+            header = wirecodec.FecHeader(self.group_id, len(self.message_datas), is_parity=True)
+            parity = get_parity(self.message_datas)
+            self.group_id = (self.group_id + 1) % 2**32
+            self.message_datas = []
+            return header, parity
+
+@dataclass
+class ReceivedGroup:
+    message_datas: dict[int, bytes] = field(default_factory=dict) # by index
+    parity: Optional[bytes] = None
+    packet_count: int = 0 # known when the parity has arrived
+    is_done: bool = False
+
+# the groups received from one connection. Used by the receiving thread only
+class FecDecoder:
+
+    # max_message_data_size: of the packets the peer sends, bounds the size of a parity
+    def __init__(self, max_message_data_size: int):
+        self.max_parity_size = LENGTH.size + max_message_data_size
+        self.groups: dict[int, ReceivedGroup] = {} # by group id, oldest first
+        self.recovered_packet_count = 0
+
+    # returns the message data of a recovered packet, if the packet completes a group with one lost packet.
+    # Raises WireFormatError if the packet doesn't fit the group
+    def add(self, header: wirecodec.FecHeader, message_data: bytes) -> Optional[bytes]:
+        if header.is_parity and not (1 <= header.index <= FEC_GROUP_SIZE):
+            raise wirecodec.WireFormatError(f"Parity of a group of {header.index} packets.")
+        if header.is_parity and not (LENGTH.size <= len(message_data) <= self.max_parity_size):
+            raise wirecodec.WireFormatError(f"Parity of {len(message_data)} bytes.")
+        if not header.is_parity and header.index >= FEC_GROUP_SIZE:
+            raise wirecodec.WireFormatError(f"Packet {header.index} of a group.")
+
+        group = self.groups.get(header.group_id)
+        if group == None:
+            if len(self.groups) >= RECEIVED_GROUP_MEMORY:
+                del self.groups[next(iter(self.groups))]
+            group = ReceivedGroup()
+            self.groups[header.group_id] = group
+
+        if group.is_done:
+            return None
+        if header.is_parity:
+            if group.parity != None:
+                return None # duplicate
+            if any(index >= header.index for index in group.message_datas):
+                group.is_done = True
+                raise wirecodec.WireFormatError("Parity doesn't match the packets of its group.")
+            group.parity = message_data
+            group.packet_count = header.index
+        else:
+            if group.parity != None and header.index >= group.packet_count:
+                group.is_done = True
+                raise wirecodec.WireFormatError("Packet doesn't fit the parity of its group.")
+            group.message_datas[header.index] = message_data
+
+        return self.try_recover(group)
+
+    def try_recover(self, group: ReceivedGroup) -> Optional[bytes]:
+        if group.parity == None:
+            return None
+        if len(group.message_datas) >= group.packet_count:
+            group.is_done = True # nothing was lost
+            return None
+        if len(group.message_datas) < group.packet_count - 1:
+            return None # wait for more, or leave it to the resends
+
+        group.is_done = True
+        recovered_message_data = recover(group.parity, list(group.message_datas.values()))
+        self.recovered_packet_count += 1
+        return recovered_message_data
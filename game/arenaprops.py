@@ -1,6 +1,8 @@
 from pygame import Color
+import messages
 
 ARENA_RADIUS = 20
+assert 2 * ARENA_RADIUS <= messages.MAX_WIRE_COORDINATE, "Positions in the arena (and the mouse near it) must fit into the wire format"
 WALL_WIDTH = .8
 WALL_MIN_LENGTH = 2
 WALL_MAX_LENGTH = 10
@@ -2,7 +2,7 @@ from dataclasses import dataclass, field
 import pygame
 from pymunk import Vec2d, BB
 import mymath
-from typing import Sequence
+from typing import Sequence, Optional
 from statistics import mean
 from . import arenaprops
 from functools import reduce
@@ -51,6 +51,7 @@ class Camera:
     window_container: WindowContainer
     position: Vec2d = field(default_factory=Vec2d.zero)
     height: float = 25
+    view_bounds: Optional[BB] = None # what the camera frames, in world space
 
     def update(self, owning_player_pos: Vec2d, other_players_pos: Sequence[Vec2d]):
         player_BBs = [get_player_bounding_box(owning_player_pos, is_us=True)]
@@ -60,6 +61,7 @@ class Camera:
 
         self.position = camera_BB.center()
         self.height = camera_BB.top - camera_BB.bottom
+        self.view_bounds = camera_BB
 
     # scale factor to convert between world units and pixels
     def get_graphical_scale_factor(self):
@@ -12,11 +12,14 @@ from . import sprite
 from pymunk import Vec2d
 from collections import Counter
 from pygame import freetype
+import networkstatistics
 
 RELOAD_TIME = 0.7 # in seconds
 HUD_ICON_WIDTH = 20
 WIN_MESSAGE_FONT = freetype.SysFont("verdana", 100)
 GO_TO_LOBBY_MESSAGE_FONT = freetype.SysFont("calibri", 15, bold=True)
+NETWORK_STATISTICS_FONT = freetype.SysFont("consolas", 13)
+NETWORK_STATISTICS_UPDATE_INTERVAL = 0.5 # in seconds
 
 class GameClient(scene.Scene):
 
@@ -41,6 +44,11 @@ class GameClient(scene.Scene):
         self.damage_icon_sprite = sprite.Sprite("assets/sword.png",  HUD_ICON_WIDTH, transparent=True, screen_space=True, pivot="tl-corner")
         self.recoil_icon_sprite = sprite.Sprite("assets/recoil.png", HUD_ICON_WIDTH, transparent=True, screen_space=True, pivot="tl-corner")
 
+        # toggled with F3, F4 prints all of the statistics as JSON
+        self.network_statistics_visible = False
+        self.network_statistics_lines: list[str] = []
+        self.time_of_network_statistics_update = 0.0
+
         self.communication_client.send_reliable(messages.JoinGameMessage(self.name))
 
     def handle_events(self, events: list[pygame.event.Event]):
@@ -55,8 +63,17 @@ class GameClient(scene.Scene):
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN:
                 if self.has_game_ended():
                     self.communication_client.send_reliable(messages.GoToLobbyRequest())
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                self.network_statistics_visible = not self.network_statistics_visible
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+                print(networkstatistics.to_json(self.communication_client.get_statistics()))
 
     def update(self):
+        if self.communication_client.has_lost_connection():
+            print("Lost the connection to the server.")
+            self.scene_to_switch_to = scene.SCENE_STARTMENU
+            return
+
         self.handle_messages()
         self.update_camera()
         self.send_post_frame_messages()
@@ -84,6 +101,12 @@ class GameClient(scene.Scene):
             elif isinstance(message, messages.BulletDestroyMessage):
                 if message.bullet_id in self.bullets:
                     self.bullets.pop(message.bullet_id)
+            elif isinstance(message, messages.EntityRemovedNotification):
+                # bullets leave with the area of interest, players when they disconnect
+                if message.entity_id in self.bullets:
+                    self.bullets.pop(message.entity_id)
+                elif message.entity_id in self.players and message.entity_id != self.communication_client.id:
+                    self.players.pop(message.entity_id)
             elif isinstance(message, messages.ArenaUpdate):
                 self.arena.handle_arena_update(message)
             elif isinstance(message, messages.GoToLobbyNotification):
@@ -100,6 +123,13 @@ class GameClient(scene.Scene):
     def send_post_frame_messages(self):
         self.communication_client.send(messages.MousePositionUpdate(self.get_own_avatar().mouse_position_world_space))
 
+        view_bounds = self.camera.view_bounds
+        if view_bounds != None:
+            self.communication_client.send(messages.ViewBoundsUpdate(
+                bottom_left = Vec2d(view_bounds.left, view_bounds.bottom),
+                top_right = Vec2d(view_bounds.right, view_bounds.top)
+            ))
+
     def render(self):
         self.background.render(self.camera)
 
@@ -112,9 +142,45 @@ class GameClient(scene.Scene):
 
         if self.has_game_ended():
             self.render_end_screen()
+        if self.network_statistics_visible:
+            self.render_network_statistics()
 
         pygame.display.flip()
 
+    def get_caption_details(self):
+        if not self.network_statistics_visible or len(self.network_statistics_lines) == 0:
+            return ""
+        return f" | {self.network_statistics_lines[0]}"
+
+    # one line per connection (the host sees every client), updated every NETWORK_STATISTICS_UPDATE_INTERVAL
+    def update_network_statistics(self):
+        now = time()
+        if now - self.time_of_network_statistics_update < NETWORK_STATISTICS_UPDATE_INTERVAL:
+            return
+        self.time_of_network_statistics_update = now
+
+        statistics = self.communication_client.get_statistics()
+        self.network_statistics_lines = [
+            f"{name}: {networkstatistics.get_summary(connection_statistics)}"
+            for name, connection_statistics in statistics["connections"].items()
+        ]
+        self.network_statistics_lines.append(f"queued: {statistics['received_queue_depth']} received, {statistics['unconfirmed_messages']} unconfirmed")
+
+    def render_network_statistics(self):
+        self.update_network_statistics()
+
+        window = self.camera.window_container.window
+        padding = 5
+        line_height = NETWORK_STATISTICS_FONT.get_sized_height() + 2
+        for i, line in enumerate(self.network_statistics_lines):
+            text_rect = NETWORK_STATISTICS_FONT.get_rect(line)
+            NETWORK_STATISTICS_FONT.render_to(
+                window,
+                (window.get_width() - text_rect.width - padding, padding + i * line_height),
+                line,
+                fgcolor=pygame.Color("white")
+            )
+
     def shoot(self):
         bullet_relative_size = self.get_bullet_relative_size()
         self.time_of_last_shoot = time()
@@ -1,15 +1,17 @@
-import pygame
 import pymunk
 from pymunk import Vec2d
 from threading import Thread
 from thread_owner import ThreadOwner
 from communication import CommunicationServer
+from asynccommunication import AsyncioEndpoint
 import messages
 from .player import ServerPlayer
 from .bullet import ServerBullet, HEAL_PROPORTION
 from itertools import permutations
 from . import arena
+from .interest import InterestFilter, WALL_PRIORITY
 from objectid import ObjectId
+from tickscheduler import TickScheduler
 
 MAX_TPS = 50
 
@@ -25,20 +27,41 @@ class GameServer(ThreadOwner):
         self.arena = arena.ServerArena(self.physics_world)
         self.players: dict[messages.ObjectId, ServerPlayer] = {}
         self.bullets: dict[messages.ObjectId, ServerBullet] = {}
+        self.tick_count = 0
+        self.tick_scheduler = TickScheduler(MAX_TPS, self.tick)
 
-        ThreadOwner.__init__(self, start_immediately=start)
-        self.add_thread(Thread(target=self.mainloop), "game-server")
+        # an asyncio based communication server runs the ticks on its own event loop, no extra thread needed
+        self.is_event_loop_driven = isinstance(communication_server, AsyncioEndpoint)
+
+        ThreadOwner.__init__(self)
+        if not self.is_event_loop_driven:
+            self.add_thread(Thread(target=self.mainloop), "game-server")
+
+        if start:
+            self.start()
+
+    def start(self):
+        ThreadOwner.start(self)
+        if self.is_event_loop_driven:
+            assert(isinstance(self.communication_server, AsyncioEndpoint))
+            self.communication_server.run_tick_scheduler(self.tick_scheduler, lambda: self.running)
 
     def mainloop(self):
-        clock = pygame.time.Clock()
-        while self.running:
-            clock.tick(MAX_TPS)
-            delta_time = 1/MAX_TPS
+        self.tick_scheduler.run(lambda: self.running)
+
+    # tick durations, lateness, overruns and skipped ticks (see tickscheduler.py)
+    def get_tick_statistics(self) -> dict:
+        return self.tick_scheduler.get_statistics()
+
+    def tick(self):
+        delta_time = 1/MAX_TPS
 
-            self.handle_messages()
-            self.physics_world.step(delta_time)
-            self.update_bullets(delta_time)
-            self.send_post_frame_messages()
+        self.handle_messages()
+        self.remove_disconnected_players()
+        self.physics_world.step(delta_time)
+        self.update_bullets(delta_time)
+        self.send_post_frame_messages()
+        self.tick_count += 1
 
     def handle_messages(self):
         for message_with_id in self.communication_server.poll_messages(type_to_poll=messages.GameMessage):
@@ -46,10 +69,14 @@ class GameServer(ThreadOwner):
             sender_id = message_with_id.sender_id
 
             if sender_id not in self.players:
+                if not self.communication_server.is_player_connected(sender_id):
+                    continue # disconnected after the message was polled, adding it would leave a ghost player
                 self.add_player(sender_id)
 
             if isinstance(message, messages.MousePositionUpdate):
                 self.players[sender_id].mouse_position_world_space = message.mouse_position_world_space
+            elif isinstance(message, messages.ViewBoundsUpdate):
+                self.players[sender_id].view_bounds = pymunk.BB(message.bottom_left.x, message.bottom_left.y, message.top_right.x, message.top_right.y)
             elif isinstance(message, messages.ShootMessage):
                 new_bullet = ServerBullet(message, sender_id, self.physics_world)
                 self.bullets[new_bullet.id] = new_bullet
@@ -81,6 +108,13 @@ class GameServer(ThreadOwner):
                     player_id
                 )
 
+    # their avatars disappear from the clients with the next snapshot
+    def remove_disconnected_players(self):
+        for player_id in self.communication_server.poll_disconnected_players():
+            player = self.players.pop(player_id, None)
+            if player != None:
+                player.remove_from_world(self.physics_world)
+
     def update_bullets(self, delta_time: float):
         bullet_ids_to_destroy = []
         for bullet in self.bullets.values():
@@ -103,14 +137,27 @@ class GameServer(ThreadOwner):
         return True
 
     def send_post_frame_messages(self):
+        state_messages = [player.get_position_update_message() for player in self.players.values()]
+        state_messages += [bullet.get_state_update_message() for bullet in self.bullets.values()]
+
+        # on a LAN, the whole world is published once for the clients on multicast
+        self.communication_server.send_multicast_snapshot(state_messages)
+
+        # every client gets only the part of the world around its view
+        interest_filter = InterestFilter(state_messages, self.tick_count)
         for player in self.players.values():
-            self.communication_server.send_to_all(player.get_position_update_message())
-        for bullet in self.bullets.values():
-            self.communication_server.send_to_all(bullet.get_state_update_message())
+            # the local player shares the server's world, filtering would save nothing
+            view_bounds = None if self.communication_server.is_local_player(player.id) else player.view_bounds
+            interesting = interest_filter.get_interesting_states(player.id, view_bounds)
+            self.communication_server.send_snapshot_to(interesting.state_messages, player.id, interesting.held_entity_ids, interesting.priorities)
         
+        # walls are sent one by one, when the clients' bandwidth budget allows
         arena_update = self.arena.try_get_arena_update_message()
         if arena_update != None:
-            self.communication_server.send_to_all_reliable(arena_update)
+            for wall_id, wall_update in arena_update.wall_updates.items():
+                self.communication_server.send_to_all_reliable_scheduled(messages.ArenaUpdate({wall_id: wall_update}), ("wall", wall_id), WALL_PRIORITY)
+
+        self.communication_server.flush()
 
     def on_collision(self, arbiter: pymunk.Arbiter, space: pymunk.Space, data):
         for colliderA, colliderB in permutations(arbiter.shapes):
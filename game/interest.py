@@ -0,0 +1,92 @@
+from pymunk import Vec2d, BB
+from dataclasses import dataclass
+from collections import defaultdict
+from typing import Optional
+import math
+import messages
+from objectid import ObjectId
+
+GRID_CELL_SIZE = 5 # in world units
+VIEW_MARGIN = 4 # entities this close to the view are still replicated every tick (in world units)
+FAR_PLAYER_UPDATE_INTERVAL = 10 # players outside the view are updated every nth tick
+
+# bandwidth priorities, see communication.PriorityScheduler
+OWN_AVATAR_PRIORITY = 16
+NEARBY_PLAYER_PRIORITY = 8
+NEARBY_BULLET_PRIORITY = 4
+FAR_ENTITY_PRIORITY = 1
+WALL_PRIORITY = 0.5
+
+# area of interest: each client reports the bounds of its camera (ViewBoundsUpdate). Entities near those bounds
+# are replicated every tick. Bullets elsewhere are not replicated at all (they are removed from the client's world,
+# and come back with a full state when they get near again). Far players are held at the state the client has,
+# and updated only every FAR_PLAYER_UPDATE_INTERVAL ticks, so the client still knows where everyone is
+
+# uniform grid of entity positions, rebuilt every tick
+class SpatialGrid:
+
+    def __init__(self, cell_size: float = GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells: defaultdict[tuple[int, int], list[tuple[ObjectId, Vec2d]]] = defaultdict(list)
+
+    def get_cell(self, position: Vec2d):
+        return (math.floor(position.x / self.cell_size), math.floor(position.y / self.cell_size))
+
+    def insert(self, entity_id: ObjectId, position: Vec2d):
+        self.cells[self.get_cell(position)].append((entity_id, position))
+
+    # ids of the entities inside bounds
+    def query(self, bounds: BB) -> set[ObjectId]:
+        left, bottom = self.get_cell(Vec2d(bounds.left, bounds.bottom))
+        right, top = self.get_cell(Vec2d(bounds.right, bounds.top))
+
+        found = set()
+        for x in range(left, right + 1):
+            for y in range(bottom, top + 1):
+                for entity_id, position in self.cells.get((x, y), []):
+                    if bounds.contains_vect(position):
+                        found.add(entity_id)
+        return found
+
+@dataclass
+class InterestingStates:
+    state_messages: list # what the client should have
+    held_entity_ids: set[ObjectId] # not updated this tick
+    priorities: dict[ObjectId, float]
+
+class InterestFilter:
+
+    def __init__(self, state_messages: list, tick: int):
+        self.players = [m for m in state_messages if isinstance(m, messages.PlayerStateUpdate)]
+        self.bullets = [m for m in state_messages if isinstance(m, messages.BulletStateUpdate)]
+        self.is_far_player_update_tick = tick % FAR_PLAYER_UPDATE_INTERVAL == 0
+
+        self.grid = SpatialGrid()
+        for player in self.players:
+            self.grid.insert(player.player_id, player.head_position)
+        for bullet in self.bullets:
+            self.grid.insert(bullet.bullet_id, bullet.position)
+
+    # view_bounds == None: the client hasn't reported its view yet, so it gets everything
+    def get_interesting_states(self, player_id: ObjectId, view_bounds: Optional[BB]) -> InterestingStates:
+        if view_bounds == None:
+            nearby_ids = {p.player_id for p in self.players} | {b.bullet_id for b in self.bullets}
+        else:
+            nearby_ids = self.grid.query(BB(
+                left = view_bounds.left - VIEW_MARGIN,
+                bottom = view_bounds.bottom - VIEW_MARGIN,
+                right = view_bounds.right + VIEW_MARGIN,
+                top = view_bounds.top + VIEW_MARGIN
+            ))
+            nearby_ids.add(player_id)
+
+        held_ids = set()
+        if not self.is_far_player_update_tick:
+            held_ids = {p.player_id for p in self.players if p.player_id not in nearby_ids}
+
+        priorities = {p.player_id: NEARBY_PLAYER_PRIORITY if p.player_id in nearby_ids else FAR_ENTITY_PRIORITY for p in self.players}
+        priorities[player_id] = OWN_AVATAR_PRIORITY
+        nearby_bullets = [b for b in self.bullets if b.bullet_id in nearby_ids]
+        priorities.update((b.bullet_id, NEARBY_BULLET_PRIORITY) for b in nearby_bullets)
+
+        return InterestingStates(self.players + nearby_bullets, held_ids, priorities)
@@ -12,6 +12,7 @@ from pygame import freetype
 from . import playercolor
 from .sprite import Sprite
 from objectid import ObjectId
+from typing import Optional
 
 RECOIL_STRENGTH = 26
 RECOIL_EXPONENT = 1.2
@@ -59,6 +60,7 @@ class ServerPlayer:
         self.name = ""
         self.mouse_position_world_space = Vec2d.zero()
         self.health = MAX_HEALTH
+        self.view_bounds: Optional[pymunk.BB] = None # what the client's camera frames, see interest.py
 
         angle = random.random() * math.tau
         spawn_position = Vec2d(arenaprops.PLAYER_SPAWN_RADIUS, 0).rotated(angle)
@@ -107,6 +109,11 @@ class ServerPlayer:
         self.health += health_change
         self.health = mymath.clampf(self.health, -1e6, MAX_HEALTH)
 
+    def remove_from_world(self, physics_world: pymunk.Space):
+        for part in (self.head, self.left_leg, self.right_leg, self.left_arm, self.right_arm):
+            physics_world.remove(part.body, part.collider)
+        physics_world.remove(self.left_leg_spring, self.right_leg_spring, self.left_arm_spring, self.right_arm_spring)
+
 @dataclass
 class ClientPlayer:
     is_owned_by_client: bool # true if this is the avatar of the client of this machine
@@ -282,6 +282,11 @@ class LobbyClient(scene.Scene):
             self.gui_manager.process_events(event)
 
     def update(self):
+        if self.communication_client.has_lost_connection():
+            print("Lost the connection to the server.")
+            self.scene_to_switch_to = scene.SCENE_STARTMENU
+            return
+
         self.gui_manager.update(self.delta_time)
         self.handle_messages()
 
@@ -340,6 +345,7 @@ class LobbyServer(ThreadOwner):
             clock.tick(self.max_fps)
 
             self.handle_messages()
+            self.remove_disconnected_players()
             self.send_post_frame_messages()
 
     def handle_messages(self):
@@ -348,14 +354,21 @@ class LobbyServer(ThreadOwner):
             sender_id = message_with_id.sender_id
 
             if isinstance(message, messages.EnterLobbyMessage):
-                self.players[sender_id] = message.player_name
+                if self.communication_server.is_player_connected(sender_id):
+                    self.players[sender_id] = message.player_name
             elif isinstance(message, messages.GameStartRequest):
                 self.game_start_time = time.time() + GAME_START_DELAY_SECONDS
             else:
                 raise Exception(f"LobbyServer can't handle a {type(message)}")
             
+    def remove_disconnected_players(self):
+        for player_id in self.communication_server.poll_disconnected_players():
+            self.players.pop(player_id, None)
+
     def send_post_frame_messages(self):
+        # only the newest lobby state matters, older ones aren't resent
         self.communication_server.send_to_all_reliable(messages.LobbyStateUpdate(
             connected_player_names = list(self.players.values()),
             time_to_game_start = None if self.game_start_time == None else self.game_start_time - time.time()
-        ))
+        ), supersede_key=messages.LobbyStateUpdate)
+        self.communication_server.flush()
@@ -1,8 +1,9 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from abc import ABC
 from pymunk import Vec2d
 from objectid import ObjectId
 from typing import Optional
+import math
 
 class MessageToServer(ABC):
     pass
@@ -16,6 +17,41 @@ class LobbyMessage(ABC):
 class GameMessage(ABC):
     pass
 
+# values are sent as integers of the given size. The largest value that can be sent is max_value - step, values outside the range are clamped
+@dataclass
+class QuantizationProfile:
+    min_value: float
+    max_value: float
+    bits: int # 8, 16 or 32
+    is_periodic: bool = False # if true, values are wrapped into the range instead of clamped (e.g. angles)
+    round_up: bool = False # if true, the reconstructed value is never smaller than the original
+    step: float = field(init=False)
+
+    def __post_init__(self):
+        assert self.bits in (8, 16, 32)
+        self.max_index = 2**self.bits - 1
+        self.step = (self.max_value - self.min_value) / 2**self.bits
+
+    def quantize(self, value: float) -> int:
+        if self.is_periodic:
+            value = self.min_value + (value - self.min_value) % (self.max_value - self.min_value)
+
+        scaled = (value - self.min_value) / self.step
+        index = math.ceil(scaled) if self.round_up else round(scaled)
+        if self.is_periodic:
+            return index % 2**self.bits
+        return max(0, min(self.max_index, index))
+
+    def dequantize(self, index: int) -> float:
+        return self.min_value + index * self.step
+
+# quantization of the messages on the wire. The maximum reconstruction error is half a step (a full step if round_up)
+MAX_WIRE_COORDINATE = 80 # in world units, positions on the wire are clamped to +-this. 4 times the arena radius, the margin is for the mouse
+POSITION_QUANTIZATION = QuantizationProfile(-MAX_WIRE_COORDINATE, MAX_WIRE_COORDINATE, 16)
+ANGLE_QUANTIZATION = QuantizationProfile(0, math.tau, 16, is_periodic=True)
+HEALTH_QUANTIZATION = QuantizationProfile(-8, 8, 16, round_up=True) # 0 is exact, and a living player is never rounded to dead
+RADIUS_QUANTIZATION = QuantizationProfile(0, 1, 8)
+
 @dataclass
 class MessageToServerWithId:
     sender_id: ObjectId
@@ -82,6 +118,18 @@ class GoToLobbyRequest(MessageToServer, GameMessage):
 class GoToLobbyNotification(MessageToClient, GameMessage):
     pass
 
+# what the client's camera frames. The server only replicates entities near it every tick
+@dataclass
+class ViewBoundsUpdate(MessageToServer, GameMessage):
+    bottom_left: Vec2d
+    top_right: Vec2d
+
+# the entity is no longer replicated to this client (e.g. a bullet left the view, or a player disconnected).
+# Not sent over the network, the client's endpoint creates these from snapshot removals
+@dataclass
+class EntityRemovedNotification(MessageToClient, GameMessage):
+    entity_id: ObjectId
+
 @dataclass
 class EnterLobbyMessage(MessageToServer, LobbyMessage):
     player_name: str
@@ -0,0 +1,256 @@
+import threading
+import heapq
+import itertools
+import random
+from dataclasses import dataclass, asdict
+from time import time, sleep
+from typing import Optional
+import communication
+import messages
+
+RECEIVE_TIMEOUT = 0.1 # in seconds, how long receive_packet waits before giving up (so that stopping endpoints works)
+
+# in-process network for testing and benchmarking endpoints under bad conditions, without sockets:
+# every SimulatedTransport has an address on a SimulatedNetwork. A packet from one address to another goes through
+# the link between them, which can lose, delay, duplicate and reorder it, and limit the bandwidth.
+# Every link has its own random generator seeded from the network's seed, and draws the same amount of random numbers
+# for every packet, so the same traffic gets the same treatment on every run.
+# Endpoints can run their threads as usual, or be created with start=False and driven from one thread with pump
+
+@dataclass
+class LinkConditions:
+    latency: float = 0 # in milli seconds, one way
+    jitter: float = 0 # in milli seconds, every packet gets a random extra delay of up to this much
+    loss: float = 0 # probability of losing a packet
+    burst_start: float = 0 # probability of a loss burst starting after a packet (Gilbert-Elliott model)
+    burst_end: float = 1 # probability of a loss burst ending after a packet
+    burst_loss: float = 1 # probability of losing a packet during a burst
+    reordering: float = 0 # probability of holding a packet back, so that the packets after it overtake it
+    reordering_delay: float = 20 # in milli seconds
+    duplication: float = 0 # probability of delivering a packet twice
+    bandwidth: Optional[float] = None # in bytes per second, packets queue behind each other. None is unlimited
+    max_queue_delay: float = 500 # in milli seconds, packets that would wait longer than this in the queue are dropped
+
+PERFECT_LINK = LinkConditions()
+DSL_LINK = LinkConditions(latency=15, jitter=2, loss=0.001, bandwidth=2_000_000)
+WIFI_LINK = LinkConditions(latency=25, jitter=15, loss=0.01, burst_start=0.005, burst_end=0.2, reordering=0.01, duplication=0.002, bandwidth=1_000_000)
+MOBILE_LINK = LinkConditions(latency=60, jitter=40, loss=0.02, burst_start=0.01, burst_end=0.1, reordering=0.02, duplication=0.005, bandwidth=250_000)
+
+@dataclass
+class LinkStatistics:
+    sent_packets: int = 0
+    sent_bytes: int = 0
+    lost_packets: int = 0 # includes packets to addresses nobody listens on
+    queue_dropped_packets: int = 0
+    duplicated_packets: int = 0
+    reordered_packets: int = 0
+
+# the direction from one address to another
+class SimulatedLink:
+
+    def __init__(self, seed: str):
+        self.random = random.Random(seed)
+        self.is_in_burst = False
+        self.queue_free_time = 0.0 # when the previous packet has been transmitted, with a bandwidth limit
+        self.statistics = LinkStatistics()
+
+    # returns the arrival times (as time()) of the copies of the packet. Empty if it's lost
+    def get_arrival_times(self, size: int, now: float, conditions: LinkConditions) -> list[float]:
+        loss_draw, burst_draw, reordering_draw, duplication_draw = (self.random.random() for _ in range(4))
+        jitter_draws = (self.random.random(), self.random.random())
+        self.statistics.sent_packets += 1
+        self.statistics.sent_bytes += size
+
+        loss = conditions.burst_loss if self.is_in_burst else conditions.loss
+        if self.is_in_burst:
+            self.is_in_burst = burst_draw >= conditions.burst_end
+        else:
+            self.is_in_burst = burst_draw < conditions.burst_start
+        if loss_draw < loss:
+            self.statistics.lost_packets += 1
+            return []
+
+        departure_time = now
+        if conditions.bandwidth != None:
+            departure_time = max(now, self.queue_free_time)
+            if departure_time - now > conditions.max_queue_delay / 1000:
+                self.statistics.queue_dropped_packets += 1
+                return []
+            departure_time += size / conditions.bandwidth
+            self.queue_free_time = departure_time
+
+        delay = conditions.latency / 1000
+        if reordering_draw < conditions.reordering:
+            delay += conditions.reordering_delay / 1000
+            self.statistics.reordered_packets += 1
+
+        copy_count = 1
+        if duplication_draw < conditions.duplication:
+            copy_count = 2
+            self.statistics.duplicated_packets += 1
+
+        return [departure_time + delay + jitter_draws[i] * conditions.jitter / 1000 for i in range(copy_count)]
+
+class SimulatedNetwork:
+
+    def __init__(self, default_conditions: LinkConditions = PERFECT_LINK, seed: int = 0):
+        self.default_conditions = default_conditions
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.transports: dict[tuple, SimulatedTransport] = {}
+        self.links: dict[tuple[tuple, tuple], SimulatedLink] = {} # by (source, destination)
+        self.link_conditions: dict[tuple[tuple, tuple], LinkConditions] = {} # overrides of default_conditions
+        self.address_counter = itertools.count(1)
+
+    # address: anything hashable, that looks like a (host, port) pair. By default, a new one is made up
+    def create_transport(self, address: Optional[tuple] = None) -> "SimulatedTransport":
+        with self.lock:
+            if address == None:
+                address = ("simulated", next(self.address_counter))
+            assert address not in self.transports, f"{address} is already in use"
+
+            transport = SimulatedTransport(self, address)
+            self.transports[address] = transport
+            return transport
+
+    # can be changed at any time, e.g. to simulate a connection getting worse in the middle of a game
+    def set_link_conditions(self, source: tuple, destination: tuple, conditions: LinkConditions, both_directions = True):
+        with self.lock:
+            self.link_conditions[(source, destination)] = conditions
+            if both_directions:
+                self.link_conditions[(destination, source)] = conditions
+
+    def send(self, packet: bytes, source: tuple, destination: tuple):
+        with self.lock:
+            link = self.links.get((source, destination))
+            if link == None:
+                link = SimulatedLink(f"{self.seed}:{source}:{destination}")
+                self.links[(source, destination)] = link
+
+            conditions = self.link_conditions.get((source, destination), self.default_conditions)
+            arrival_times = link.get_arrival_times(len(packet), time(), conditions)
+            receiver = self.transports.get(destination)
+            if receiver == None:
+                link.statistics.lost_packets += len(arrival_times)
+                return
+
+        for arrival_time in arrival_times:
+            receiver.add_incoming_packet(arrival_time, packet, source)
+
+    def get_sent_bytes(self, source: tuple, destination: tuple) -> int:
+        with self.lock:
+            link = self.links.get((source, destination))
+            return 0 if link == None else link.statistics.sent_bytes
+
+    # by link, e.g. "simulated:1 -> simulated:2"
+    def get_statistics(self) -> dict:
+        with self.lock:
+            return {f"{source[0]}:{source[1]} -> {destination[0]}:{destination[1]}": asdict(link.statistics) for (source, destination), link in self.links.items()}
+
+class SimulatedTransport(communication.Transport):
+
+    def __init__(self, network: SimulatedNetwork, address: tuple):
+        super().__init__()
+        self.network = network
+        self.address = address
+        self.condition = threading.Condition()
+        self.incoming_packets: list[tuple[float, int, bytes, tuple]] = [] # heap of (arrival time, order, packet, sender)
+        self.order_counter = itertools.count()
+
+    def send_datagram(self, packet: bytes, address):
+        self.network.send(packet, self.address, address)
+
+    def add_incoming_packet(self, arrival_time: float, packet: bytes, sender: tuple):
+        with self.condition:
+            heapq.heappush(self.incoming_packets, (arrival_time, next(self.order_counter), packet, sender))
+            self.condition.notify()
+
+    def receive_packet(self):
+        deadline = time() + RECEIVE_TIMEOUT
+        with self.condition:
+            while True:
+                now = time()
+                if len(self.incoming_packets) > 0 and self.incoming_packets[0][0] <= now:
+                    _, _, packet, sender = heapq.heappop(self.incoming_packets)
+                    return packet, sender
+                if now >= deadline:
+                    return None
+
+                wake_time = deadline
+                if len(self.incoming_packets) > 0:
+                    wake_time = min(wake_time, self.incoming_packets[0][0])
+                self.condition.wait(wake_time - now)
+
+    def receive_packets(self):
+        received = self.receive_packet()
+        return [] if received == None else [received] + self.take_arrived_packets()
+
+    # returns the packets that have arrived by now, without waiting
+    def take_arrived_packets(self) -> list[tuple[bytes, tuple]]:
+        now = time()
+        arrived_packets = []
+        with self.condition:
+            while len(self.incoming_packets) > 0 and self.incoming_packets[0][0] <= now:
+                _, _, packet, sender = heapq.heappop(self.incoming_packets)
+                arrived_packets.append((packet, sender))
+        return arrived_packets
+
+# drives endpoints, that were created with start=False and a SimulatedTransport, from the calling thread:
+# handles the packets that have arrived, and sends everything that is due. Call it regularly, e.g. every tick
+def pump(endpoints: list[communication.CommunicationEndpoint]):
+    for endpoint in endpoints:
+        assert isinstance(endpoint.socket, SimulatedTransport)
+        for packet, sender in endpoint.socket.take_arrived_packets():
+            endpoint.handle_packet(packet, sender)
+        endpoint.run_resend_iteration()
+
+# sends message_count reliable messages (of about message_size bytes) from a server to a client, burst_size per tick,
+# and returns the delivery latencies (in seconds, sorted) and how many bytes the server sent. Runs on the calling thread, with pump
+def benchmark_reliable_delivery(conditions: LinkConditions, fec_enabled: bool, message_count = 400, burst_size = 1, message_size = 10, tick_interval = 1/60, seed = 0):
+    was_fec_enabled = communication.RELIABLE_FEC_ENABLED
+    communication.RELIABLE_FEC_ENABLED = fec_enabled
+    network = SimulatedNetwork(conditions, seed)
+    server_transport = network.create_transport()
+    client_transport = network.create_transport()
+    server = communication.CommunicationServer(server_transport.address, transport=server_transport)
+    client = communication.InternetCommunicationClient(client_transport.address, server_transport.address, transport=client_transport)
+
+    client.send_reliable(messages.JoinGameMessage("benchmark"))
+    while len(server.poll_messages()) == 0:
+        pump([client, server])
+        sleep(0.001)
+    communication.RELIABLE_FEC_ENABLED = was_fec_enabled # the server side connection exists by now
+    start_bytes = network.get_sent_bytes(server_transport.address, client_transport.address)
+
+    name_random = random.Random(seed)
+    send_times = {}
+    latencies = []
+    next_tick_time = time()
+    while len(latencies) < message_count:
+        now = time()
+        if now >= next_tick_time and len(send_times) < message_count:
+            for _ in range(burst_size):
+                message_id = len(send_times)
+                send_times[message_id] = now
+                name = "".join(name_random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(message_size))
+                server.send_reliable_to(messages.NewPlayerNotification(message_id, name), client.id)
+            server.flush()
+            next_tick_time += tick_interval
+
+        pump([server, client])
+        for message in client.poll_messages():
+            latencies.append(time() - send_times[message.player_id])
+        sleep(0.001)
+
+    sent_bytes = network.get_sent_bytes(server_transport.address, client_transport.address) - start_bytes
+    return sorted(latencies), sent_bytes
+
+# compares forward error correction to sending every reliable message twice
+if __name__ == "__main__":
+    for scenario, burst_size, message_size in (("1 small message per tick", 1, 10), ("bursts of 4 x 1 kB", 4, 1000)):
+        print(f"{scenario}:")
+        for name, conditions in (("perfect", PERFECT_LINK), ("wifi", WIFI_LINK), ("mobile", MOBILE_LINK), ("5 % loss", LinkConditions(latency=30, loss=0.05))):
+            for fec_enabled in (False, True):
+                latencies, sent_bytes = benchmark_reliable_delivery(conditions, fec_enabled, burst_size=burst_size, message_size=message_size)
+                percentiles = " ".join(f"p{p} {1000 * latencies[min(len(latencies) - 1, len(latencies) * p // 100)]:.0f} ms" for p in (50, 95, 99))
+                print(f"  {name}, {'fec' if fec_enabled else 'duplicates'}: {percentiles}, {sent_bytes} bytes")
@@ -0,0 +1,123 @@
+import threading
+import json
+from collections import deque
+from time import time
+from typing import Optional
+
+STATISTICS_WINDOW = 5 # in seconds, rates and percentiles are computed over this long
+PERCENTILES = (50, 95, 99)
+
+# timestamped samples of the last STATISTICS_WINDOW seconds
+class RollingWindow:
+
+    def __init__(self, window: float = STATISTICS_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples: deque[tuple[float, float]] = deque() # (time, value)
+
+    def add(self, value: float = 1.0):
+        now = time()
+        with self.lock:
+            self.samples.append((now, value))
+            self.remove_old(now)
+
+    def remove_old(self, now: float):
+        while len(self.samples) > 0 and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+    def get_values(self) -> list[float]:
+        with self.lock:
+            self.remove_old(time())
+            return [value for _, value in self.samples]
+
+    def get_count(self):
+        return len(self.get_values())
+
+    # sum of the values per second
+    def get_rate(self):
+        return sum(self.get_values()) / self.window
+
+    # nearest rank percentiles, None if there are no samples
+    def get_percentiles(self, percentiles = PERCENTILES) -> dict[int, Optional[float]]:
+        values = sorted(self.get_values())
+        if len(values) == 0:
+            return {p: None for p in percentiles}
+        return {p: values[min(len(values) - 1, int(p / 100 * len(values)))] for p in percentiles}
+
+# traffic of one connection
+class ConnectionStatistics:
+
+    def __init__(self):
+        self.sent_packets = RollingWindow() # values are sizes in bytes
+        self.received_packets = RollingWindow()
+        self.sent_reliable_messages = RollingWindow()
+        self.retransmissions = RollingWindow()
+        self.round_trip_times = RollingWindow() # in seconds
+
+        # totals since the connection was created
+        self.lock = threading.Lock()
+        self.total_sent_bytes = 0
+        self.total_received_bytes = 0
+        self.total_retransmissions = 0
+        self.total_dropped_reliable_messages = 0 # given up on
+
+    def on_packet_sent(self, size: int):
+        self.sent_packets.add(size)
+        with self.lock:
+            self.total_sent_bytes += size
+
+    def on_packet_received(self, size: int):
+        self.received_packets.add(size)
+        with self.lock:
+            self.total_received_bytes += size
+
+    def on_reliable_message_sent(self):
+        self.sent_reliable_messages.add()
+
+    def on_retransmission(self):
+        self.retransmissions.add()
+        with self.lock:
+            self.total_retransmissions += 1
+
+    def on_reliable_message_dropped(self):
+        with self.lock:
+            self.total_dropped_reliable_messages += 1
+
+    def on_round_trip_time_sample(self, rtt: float):
+        self.round_trip_times.add(rtt)
+
+    # fraction of the reliable messages, that had to be resent. Estimates the packet loss
+    def get_retransmission_ratio(self) -> Optional[float]:
+        sent_count = self.sent_reliable_messages.get_count()
+        return min(1.0, self.retransmissions.get_count() / sent_count) if sent_count > 0 else None
+
+    # times are in milli seconds, rates per second
+    def to_dict(self) -> dict:
+        rtt_percentiles = self.round_trip_times.get_percentiles()
+        return {
+            "rtt_ms": {f"p{p}": None if rtt == None else 1000 * rtt for p, rtt in rtt_percentiles.items()},
+            "sent_packets_per_s": self.sent_packets.get_count() / STATISTICS_WINDOW,
+            "received_packets_per_s": self.received_packets.get_count() / STATISTICS_WINDOW,
+            "sent_bytes_per_s": self.sent_packets.get_rate(),
+            "received_bytes_per_s": self.received_packets.get_rate(),
+            "sent_packet_size": {f"p{p}": size for p, size in self.sent_packets.get_percentiles().items()},
+            "retransmissions_per_s": self.retransmissions.get_count() / STATISTICS_WINDOW,
+            "retransmission_ratio": self.get_retransmission_ratio(),
+            "total_sent_bytes": self.total_sent_bytes,
+            "total_received_bytes": self.total_received_bytes,
+            "total_retransmissions": self.total_retransmissions,
+            "total_dropped_reliable_messages": self.total_dropped_reliable_messages
+        }
+
+def to_json(statistics: dict) -> str:
+    return json.dumps(statistics, indent=2, default=str)
+
+# short one line summary, e.g. for a window caption
+def get_summary(connection_statistics: dict) -> str:
+    rtt = connection_statistics["rtt_ms"]["p50"]
+    rtt_str = "-" if rtt == None else f"{rtt:.0f}"
+    loss = connection_statistics["retransmission_ratio"]
+    loss_str = "-" if loss == None else f"{100 * loss:.0f}"
+    down = connection_statistics["received_bytes_per_s"] / 1000
+    up = connection_statistics["sent_bytes_per_s"] / 1000
+    return f"RTT {rtt_str} ms, loss {loss_str} %, down {down:.1f} kB/s, up {up:.1f} kB/s"
@@ -0,0 +1,62 @@
+from collections import Counter
+from time import time
+import messages
+
+# (messages per second, burst) a client may send to the game, by type. The game client sends far less
+MESSAGE_RATE_LIMITS = {
+    messages.MousePositionUpdate: (90, 60), # every frame
+    messages.ViewBoundsUpdate: (90, 60), # every frame
+    messages.ShootMessage: (15, 10), # every click
+    messages.JoinGameMessage: (2, 5),
+    messages.GoToLobbyRequest: (2, 5),
+    messages.EnterLobbyMessage: (2, 5),
+    messages.GameStartRequest: (2, 5)
+}
+DEFAULT_MESSAGE_RATE_LIMIT = (30, 30) # for the types not in MESSAGE_RATE_LIMITS
+
+# inbound rate limiting (see CommunicationServer.is_within_limits):
+# the server has a token bucket per client and message type. A bucket fills at the rate of the type, up to its burst,
+# and every message takes a token. A message that finds its bucket empty is dropped before it reaches the game, so a
+# flooding client can't make the ticks slower for everyone (e.g. every ShootMessage creates a physics body).
+# Reliable messages are checked before they're acked, so a throttled one isn't lost: the client sends it again after
+# its retransmission timeout, like a lost one. The limits are high enough that this doesn't happen to a well behaving client
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.last_update_time = time()
+
+    def try_take(self) -> bool:
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_update_time) * self.rate)
+        self.last_update_time = now
+
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+# the buckets of one client. Used by the receiving thread only
+class RateLimiter:
+
+    def __init__(self):
+        self.buckets: dict[type, TokenBucket] = {}
+        self.dropped_counts: Counter[str] = Counter() # by type name
+
+    # returns false if the message should be dropped
+    def allow(self, message_type: type) -> bool:
+        bucket = self.buckets.get(message_type)
+        if bucket == None:
+            bucket = TokenBucket(*MESSAGE_RATE_LIMITS.get(message_type, DEFAULT_MESSAGE_RATE_LIMIT))
+            self.buckets[message_type] = bucket
+
+        if bucket.try_take():
+            return True
+        self.dropped_counts[message_type.__name__] += 1
+        return False
+
+    def get_dropped_count(self) -> int:
+        return sum(self.dropped_counts.values())
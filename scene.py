@@ -45,7 +45,7 @@ class Scene(ABC):
             self.update()
             self.render()
             fps = self.FPS_calculator.get_FPS_str(self.delta_time)
-            pygame.display.set_caption(f"Pyshooter {fps} FPS")
+            pygame.display.set_caption(f"Pyshooter {fps} FPS{self.get_caption_details()}")
                     
     @abstractmethod
     def handle_events(self, events: list[pygame.event.Event]):
@@ -59,6 +59,10 @@ class Scene(ABC):
     def render(self):
         pass
 
+    # shown after the FPS in the window caption
+    def get_caption_details(self) -> str:
+        return ""
+
     def save_screenshot(self):
         file_name = f"{datetime.datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}_{random.randrange(10**10, 10**11)}.png"
         save_folder = pathlib.Path.home() / "Pictures" / "Screenshots" / "Pyshooter"
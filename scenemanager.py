@@ -1,6 +1,7 @@
 from game.gameserver import GameServer
 from game.gameclient import GameClient
 import communication
+import asynccommunication
 import pygame
 from typing import Optional
 import scene
@@ -10,6 +11,10 @@ from game.gameclient import GameClient
 import connectioncode
 from windowcontainer import WindowContainer
 
+USE_ASYNCIO_COMMUNICATION = False # run the network endpoints on an asyncio event loop instead of threads
+USE_LAN_MULTICAST = False # in LAN games, publish snapshots to a multicast group instead of sending them to every client
+MULTICAST_PORT_OFFSET = -1 # from the server port. Clients bind the ports above the server port (see main.py), so the group uses one below
+
 class SceneManager:
 
     def __init__(self, window_container: WindowContainer, server_port: int, client_port: int):
@@ -97,12 +102,15 @@ class SceneManager:
         if not self.communication_active:
             if self.game_parameters.is_host:
                 external_address = (self.game_parameters.own_external_ip, self.server_port) if self.game_parameters.is_public_host else None
-                self.communication_server = communication.CommunicationServer((self.game_parameters.own_local_ip, self.server_port), external_address=external_address, start=True)
+                multicast_address = (communication.DEFAULT_MULTICAST_GROUP, self.server_port + MULTICAST_PORT_OFFSET) if USE_LAN_MULTICAST and not self.game_parameters.is_public_host else None
+                server_type = asynccommunication.AsyncioCommunicationServer if USE_ASYNCIO_COMMUNICATION else communication.CommunicationServer
+                self.communication_server = server_type((self.game_parameters.own_local_ip, self.server_port), external_address=external_address, start=True, multicast_address=multicast_address)
 
                 self.hosting_communication_client = communication.HostingCommunicationClient(self.communication_server)
                 self.communication_server.hosting_client = self.hosting_communication_client
             else:
-                self.internet_communication_client = communication.InternetCommunicationClient(
+                client_type = asynccommunication.AsyncioInternetCommunicationClient if USE_ASYNCIO_COMMUNICATION else communication.InternetCommunicationClient
+                self.internet_communication_client = client_type(
                     (self.game_parameters.own_local_ip, self.client_port),
                     (self.game_parameters.remote_server_ip, self.server_port),
                     start=True
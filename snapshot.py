@@ -0,0 +1,372 @@
+import threading
+from dataclasses import dataclass, fields
+from collections import OrderedDict
+from typing import Optional
+from pymunk import Vec2d
+import messages
+import wirecodec
+from objectid import ObjectId
+
+SNAPSHOT_BUFFER_SIZE = 32 # how many recent snapshots are remembered (both ends)
+CHANGE_THRESHOLD = 1e-4 # smaller changes to floats and vectors are not sent
+
+# delta compressed world snapshots:
+# a world state is a set of state messages (e.g. PlayerStateUpdate), the first field of which is the entity id
+# the server remembers the snapshots it has sent to a client, and encodes each new snapshot as a delta
+# against the newest snapshot the client has acknowledged (SnapshotAck), or against an empty world if there is none
+# only the changed fields of each entity are sent. The server stores the snapshot as the client will reconstruct it
+# (including quantization), so that changes below CHANGE_THRESHOLD can't accumulate
+# a snapshot may be split into multiple WorldSnapshotDelta messages. Each part can be applied on its own,
+# but only complete snapshots are acknowledged and used as baselines
+# entities can be left out of a client's snapshots (area of interest). They are then removed on the client.
+# Held entities stay in the snapshot with their baseline state, so they are updated at a lower rate for free.
+# Held entities the client doesn't have yet are left out until they aren't held
+# the receiver gives the game what differs from the state it has already given it. A part only carries the entities
+# that changed against the baseline, so once a snapshot is complete, its entities carried over from the baseline
+# are compared too (the game may have a newer value from a snapshot that was never acked), and entities that
+# aren't in it anymore are removed
+
+@dataclass
+class EntityDelta:
+    state_type: type
+    entity_id: ObjectId
+    changed_fields: int # bitmask, bit i is set if field i (not counting the id) has changed
+    values: list # values of the changed fields
+
+@dataclass
+class WorldSnapshotDelta(messages.MessageToClient):
+    snapshot_id: int
+    baseline_id: Optional[int] # None = delta against an empty world
+    part_index: int
+    part_count: int
+    entity_deltas: list[EntityDelta]
+    removed_entity_ids: list[ObjectId]
+
+@dataclass
+class SnapshotAck(messages.MessageToServer):
+    snapshot_id: int
+
+def get_entity_id(state_message) -> ObjectId:
+    return getattr(state_message, fields(state_message)[0].name)
+
+def get_state_field_names(state_type: type) -> list[str]:
+    return [f.name for f in fields(state_type)][1:]
+
+# returns the values as the client will receive them (e.g. quantized)
+def get_state_values(state_message) -> tuple:
+    schema = wirecodec.schemas_by_type[type(state_message)]
+    return tuple(
+        field.get_received_value(getattr(state_message, name)) if isinstance(field, wirecodec.FixedField) else getattr(state_message, name)
+        for name, field in schema.body.fields[1:]
+    )
+
+def has_changed(old, new):
+    if isinstance(new, Vec2d):
+        return abs(new.x - old.x) > CHANGE_THRESHOLD or abs(new.y - old.y) > CHANGE_THRESHOLD
+    elif isinstance(new, float):
+        return abs(new - old) > CHANGE_THRESHOLD
+    else:
+        return new != old
+
+@dataclass
+class EntityState:
+    state_type: type
+    values: tuple
+
+    def to_message(self, entity_id: ObjectId):
+        return self.state_type(entity_id, *self.values)
+
+WorldState = dict[ObjectId, EntityState]
+
+class SnapshotSender:
+
+    def __init__(self):
+        self.sent_snapshots: OrderedDict[int, WorldState] = OrderedDict()
+        self.next_snapshot_id = 0
+        self.acked_snapshot_id: Optional[int] = None
+
+    def receive_ack(self, snapshot_id: int):
+        if snapshot_id in self.sent_snapshots and (self.acked_snapshot_id == None or snapshot_id > self.acked_snapshot_id):
+            self.acked_snapshot_id = snapshot_id
+
+    # returns (id of the baseline, its state). The baseline is the newest acked snapshot, or an empty world
+    def get_baseline(self) -> tuple[Optional[int], WorldState]:
+        if self.acked_snapshot_id in self.sent_snapshots:
+            return self.acked_snapshot_id, self.sent_snapshots[self.acked_snapshot_id]
+        return None, {}
+
+    # encoded size of the entity's delta in the next snapshot. 0 if nothing has changed
+    def get_delta_size(self, state_message) -> int:
+        entity_id = get_entity_id(state_message)
+        delta, _ = get_entity_delta(self.get_baseline()[1].get(entity_id), state_message, entity_id)
+        return ENTITY_DELTA.get_encoded_size(delta) if delta.changed_fields != 0 else 0
+
+    # state_messages: the current state of every entity the client should have
+    # held_entity_ids: entities that keep the state the client already has, instead of being updated
+    def get_delta_messages(self, state_messages: list, max_message_size: int, held_entity_ids: set[ObjectId] = set()) -> list[WorldSnapshotDelta]:
+        baseline_id, baseline = self.get_baseline()
+
+        snapshot: WorldState = {}
+        entity_deltas = []
+        for state_message in state_messages:
+            entity_id = get_entity_id(state_message)
+            if entity_id in held_entity_ids:
+                if entity_id in baseline:
+                    snapshot[entity_id] = baseline[entity_id]
+                continue
+
+            delta, state = get_entity_delta(baseline.get(entity_id), state_message, entity_id)
+            snapshot[entity_id] = state
+            if delta.changed_fields != 0:
+                entity_deltas.append(delta)
+        removed_entity_ids = [id for id in baseline if id not in snapshot]
+
+        snapshot_id = self.next_snapshot_id
+        self.next_snapshot_id += 1
+        self.sent_snapshots[snapshot_id] = snapshot
+        while len(self.sent_snapshots) > SNAPSHOT_BUFFER_SIZE:
+            self.sent_snapshots.popitem(last=False)
+
+        parts = split_entity_deltas(entity_deltas, max_message_size - get_encoded_size_without_deltas(removed_entity_ids))
+        return [
+            WorldSnapshotDelta(snapshot_id, baseline_id, i, len(parts), part, removed_entity_ids if i == 0 else [])
+            for i, part in enumerate(parts)
+        ]
+
+# sends the same snapshots to many receivers (e.g. a multicast group). The baseline is the newest snapshot,
+# that every receiver has acked, so a receiver that falls behind makes the deltas bigger for everyone
+class SharedSnapshotSender(SnapshotSender):
+
+    def __init__(self):
+        SnapshotSender.__init__(self)
+        self.lock = threading.Lock() # acks arrive on the receiving thread
+        self.acked_snapshot_ids_by_receiver: dict[ObjectId, set[int]] = {}
+
+    def add_receiver(self, receiver_id: ObjectId):
+        with self.lock:
+            self.acked_snapshot_ids_by_receiver.setdefault(receiver_id, set())
+
+    def remove_receiver(self, receiver_id: ObjectId):
+        with self.lock:
+            self.acked_snapshot_ids_by_receiver.pop(receiver_id, None)
+
+    def has_receivers(self):
+        return len(self.acked_snapshot_ids_by_receiver) > 0
+
+    def receive_ack_from(self, receiver_id: ObjectId, snapshot_id: int):
+        with self.lock:
+            acked_snapshot_ids = self.acked_snapshot_ids_by_receiver.get(receiver_id)
+            if acked_snapshot_ids != None and snapshot_id in self.sent_snapshots:
+                acked_snapshot_ids.add(snapshot_id)
+
+    def get_baseline(self) -> tuple[Optional[int], WorldState]:
+        with self.lock:
+            common_snapshot_ids = set(self.sent_snapshots)
+            for acked_snapshot_ids in self.acked_snapshot_ids_by_receiver.values():
+                acked_snapshot_ids &= self.sent_snapshots.keys() # forget the snapshots that can't be baselines anymore
+                common_snapshot_ids &= acked_snapshot_ids
+
+            if len(self.acked_snapshot_ids_by_receiver) == 0 or len(common_snapshot_ids) == 0:
+                return None, {}
+            baseline_id = max(common_snapshot_ids)
+            return baseline_id, self.sent_snapshots[baseline_id]
+
+# returns (delta, state as the client will reconstruct it)
+def get_entity_delta(baseline: Optional[EntityState], state_message, entity_id: ObjectId):
+    state_type = type(state_message)
+    new_values = get_state_values(state_message)
+    if baseline == None or baseline.state_type != state_type:
+        all_fields = (1 << len(new_values)) - 1
+        return EntityDelta(state_type, entity_id, all_fields, list(new_values)), EntityState(state_type, new_values)
+
+    changed_fields = 0
+    changed_values = []
+    reconstructed_values = []
+    for i, (old, new) in enumerate(zip(baseline.values, new_values)):
+        if has_changed(old, new):
+            changed_fields |= 1 << i
+            changed_values.append(new)
+            reconstructed_values.append(new)
+        else:
+            reconstructed_values.append(old)
+
+    return EntityDelta(state_type, entity_id, changed_fields, changed_values), EntityState(state_type, tuple(reconstructed_values))
+
+# upper bound for the encoded size of a WorldSnapshotDelta without any entity deltas
+def get_encoded_size_without_deltas(removed_entity_ids: list):
+    return 32 + wirecodec.UINT32.struct.size * len(removed_entity_ids)
+
+# splits into parts that fit into max_size when encoded. Always returns at least one part
+def split_entity_deltas(entity_deltas: list[EntityDelta], max_size: int) -> list[list[EntityDelta]]:
+    parts = [[]]
+    part_size = 0
+    for delta in entity_deltas:
+        size = ENTITY_DELTA.get_encoded_size(delta)
+        if part_size + size > max_size and len(parts[-1]) > 0:
+            parts.append([])
+            part_size = 0
+        parts[-1].append(delta)
+        part_size += size
+    return parts
+
+@dataclass
+class PartialSnapshot:
+    baseline_id: Optional[int]
+    world_state: WorldState
+    received_parts: set[int]
+    part_count: int
+    removed_entity_ids: list[ObjectId]
+
+class SnapshotReceiver:
+
+    def __init__(self):
+        self.complete_snapshots: OrderedDict[int, WorldState] = OrderedDict()
+        self.partial_snapshots: dict[int, PartialSnapshot] = {}
+        self.newest_applied_snapshot_id = -1
+        self.delivered_state: WorldState = {} # what the game has been given
+
+    # returns the state messages of the entities, that the game doesn't have the reconstructed state of yet (see the
+    # comment at the top), ids of the entities to remove, and the id of the snapshot, if it was completed and should
+    # be acknowledged. Raises WireFormatError if the part is invalid
+    def receive(self, delta: WorldSnapshotDelta) -> tuple[list, list[ObjectId], Optional[int]]:
+        if delta.baseline_id != None and delta.baseline_id not in self.complete_snapshots:
+            return [], [], None # baseline has been forgotten, wait for a newer snapshot
+        if delta.snapshot_id in self.complete_snapshots:
+            return [], [], None # duplicate
+        if delta.part_index >= delta.part_count:
+            raise wirecodec.WireFormatError(f"Part {delta.part_index} of a snapshot with {delta.part_count} parts.")
+
+        # applied before anything is stored, so that an invalid part changes nothing
+        baseline = self.complete_snapshots[delta.baseline_id] if delta.baseline_id != None else {}
+        reconstructed = {}
+        for entity_delta in delta.entity_deltas:
+            reconstructed[entity_delta.entity_id] = apply_entity_delta(baseline.get(entity_delta.entity_id), entity_delta)
+
+        partial = self.partial_snapshots.get(delta.snapshot_id)
+        if partial == None:
+            partial = PartialSnapshot(delta.baseline_id, {}, set(), delta.part_count, [])
+            self.partial_snapshots[delta.snapshot_id] = partial
+            while len(self.partial_snapshots) > SNAPSHOT_BUFFER_SIZE:
+                self.partial_snapshots.pop(min(self.partial_snapshots))
+        if delta.part_index in partial.received_parts or delta.part_count != partial.part_count:
+            return [], [], None
+        partial.received_parts.add(delta.part_index)
+        partial.removed_entity_ids += delta.removed_entity_ids
+        partial.world_state.update(reconstructed)
+
+        is_newest = delta.snapshot_id >= self.newest_applied_snapshot_id
+        completed_snapshot_id = None
+        if len(partial.received_parts) == partial.part_count:
+            self.complete(delta.snapshot_id, partial, baseline)
+            completed_snapshot_id = delta.snapshot_id
+        if not is_newest:
+            return [], [], completed_snapshot_id # older than what the game already has
+
+        self.newest_applied_snapshot_id = delta.snapshot_id
+        if completed_snapshot_id != None:
+            world_state = self.complete_snapshots[completed_snapshot_id]
+            removed_entity_ids = [id for id in self.delivered_state if id not in world_state]
+        else:
+            world_state = reconstructed
+            removed_entity_ids = delta.removed_entity_ids
+        return self.deliver(world_state, removed_entity_ids), removed_entity_ids, completed_snapshot_id
+
+    # returns the state messages of the entities, that differ from what the game has
+    def deliver(self, world_state: WorldState, removed_entity_ids: list[ObjectId]) -> list:
+        state_messages = []
+        for id, state in world_state.items():
+            if self.delivered_state.get(id) != state:
+                self.delivered_state[id] = state
+                state_messages.append(state.to_message(id))
+        for id in removed_entity_ids:
+            self.delivered_state.pop(id, None)
+        return state_messages
+
+    def complete(self, snapshot_id: int, partial: PartialSnapshot, baseline: WorldState):
+        self.partial_snapshots.pop(snapshot_id)
+        removed = set(partial.removed_entity_ids)
+
+        # unchanged entities are carried over from the baseline
+        world_state = {id: state for id, state in baseline.items() if id not in removed}
+        world_state.update(partial.world_state)
+        self.complete_snapshots[snapshot_id] = world_state
+        while len(self.complete_snapshots) > SNAPSHOT_BUFFER_SIZE:
+            self.complete_snapshots.popitem(last=False)
+
+        # forget partial snapshots, that are too old to ever be completed
+        oldest_id = next(iter(self.complete_snapshots))
+        self.partial_snapshots = {id: p for id, p in self.partial_snapshots.items() if id > oldest_id}
+
+# raises WireFormatError if the delta doesn't fit the baseline (the delta comes from the network)
+def apply_entity_delta(baseline: Optional[EntityState], delta: EntityDelta) -> EntityState:
+    field_count = len(get_state_field_names(delta.state_type))
+    if baseline == None or baseline.state_type != delta.state_type:
+        if delta.changed_fields != (1 << field_count) - 1:
+            raise wirecodec.WireFormatError(f"Delta of missing entity {delta.entity_id} doesn't contain every field.")
+        return EntityState(delta.state_type, tuple(delta.values))
+
+    changed_values = iter(delta.values)
+    values = tuple(
+        next(changed_values) if delta.changed_fields & (1 << i) else old
+        for i, old in enumerate(baseline.values)
+    )
+    return EntityState(delta.state_type, values)
+
+# [tag of the state type: u8][entity id: u32][changed fields: u16][changed field values]
+class EntityDeltaField(wirecodec.FieldType):
+    HEADER = wirecodec.struct.Struct(wirecodec.BYTE_ORDER + "BIH")
+
+    def get_value_fields(self, state_type: type) -> list[wirecodec.FieldType]:
+        schema = wirecodec.schemas_by_type[state_type]
+        return [field for _, field in schema.body.fields[1:]]
+
+    def encode(self, value: EntityDelta, buffer: bytearray):
+        buffer += self.HEADER.pack(wirecodec.schemas_by_type[value.state_type].tag, value.entity_id, value.changed_fields)
+        changed_values = iter(value.values)
+        for i, field in enumerate(self.get_value_fields(value.state_type)):
+            if value.changed_fields & (1 << i):
+                field.encode(next(changed_values), buffer)
+
+    def decode(self, data, offset: int):
+        tag, entity_id, changed_fields = self.HEADER.unpack_from(data, offset)
+        offset += self.HEADER.size
+        schema = wirecodec.schemas_by_tag.get(tag)
+        if schema == None or schema.body.data_type not in STATE_TYPES:
+            raise wirecodec.WireFormatError(f"Tag {tag} is not a state message.")
+
+        value_fields = self.get_value_fields(schema.body.data_type)
+        if changed_fields >> len(value_fields) != 0:
+            raise wirecodec.WireFormatError(f"Invalid changed field mask {changed_fields}.")
+
+        values = []
+        for i, field in enumerate(value_fields):
+            if changed_fields & (1 << i):
+                value, offset = field.decode(data, offset)
+                values.append(value)
+        return EntityDelta(schema.body.data_type, entity_id, changed_fields, values), offset
+
+    def get_encoded_size(self, value: EntityDelta):
+        size = self.HEADER.size
+        for i, field in enumerate(self.get_value_fields(value.state_type)):
+            if value.changed_fields & (1 << i):
+                assert isinstance(field, wirecodec.FixedField)
+                size += field.struct.size
+        return size
+
+STATE_TYPES = (messages.PlayerStateUpdate, messages.BulletStateUpdate)
+for state_type in STATE_TYPES:
+    schema_field_names = [name for name, _ in wirecodec.schemas_by_type[state_type].body.fields]
+    assert schema_field_names == [f.name for f in fields(state_type)], f"Schema of {state_type} must follow the field order of the dataclass"
+
+ENTITY_DELTA = EntityDeltaField()
+wirecodec.register_message_type(WorldSnapshotDelta, 30, [
+    ("snapshot_id", wirecodec.UINT32),
+    ("baseline_id", wirecodec.OptionalField(wirecodec.UINT32)),
+    ("part_index", wirecodec.UINT8),
+    ("part_count", wirecodec.UINT8),
+    ("entity_deltas", wirecodec.ListField(ENTITY_DELTA)),
+    ("removed_entity_ids", wirecodec.ListField(wirecodec.UINT32))
+])
+wirecodec.register_message_type(SnapshotAck, 31, [
+    ("snapshot_id", wirecodec.UINT32)
+])
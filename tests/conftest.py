@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules are at the top of the repository, not in a package
+sys.path.insert(0, str(Path(__file__).parent.parent))
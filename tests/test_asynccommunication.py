@@ -0,0 +1,36 @@
+import threading
+import asynccommunication
+import communication
+from tickscheduler import TickScheduler
+
+def test_ticks_continue_after_a_tick_raises():
+    server = asynccommunication.AsyncioCommunicationServer(("127.0.0.1", 0), start=True)
+    tick_count = 0
+    enough_ticks = threading.Event()
+
+    def tick():
+        nonlocal tick_count
+        tick_count += 1
+        if tick_count >= 5:
+            enough_ticks.set()
+        if tick_count == 2:
+            raise RuntimeError("tick failed")
+
+    try:
+        server.run_tick_scheduler(TickScheduler(100, tick), lambda: True)
+        assert enough_ticks.wait(timeout=5)
+    finally:
+        server.stop(asyncronous=True)
+
+# a non-blocking socket, the send buffer of which is full
+class FullSocket:
+
+    def sendto(self, packet: bytes, address):
+        raise BlockingIOError()
+
+def test_full_send_buffer_loses_the_datagram():
+    transport = communication.HighLevelSocket(FullSocket())
+
+    transport.send_datagram(b"packet", ("127.0.0.1", 1))
+
+    assert transport.dropped_send_count == 1
@@ -0,0 +1,44 @@
+import messages
+import networksimulator
+import wirecodec
+from communication import CommunicationServer, InternetCommunicationClient
+
+def create_connected_pair():
+    network = networksimulator.SimulatedNetwork()
+    server_transport = network.create_transport()
+    client_transport = network.create_transport()
+    server = CommunicationServer(server_transport.address, transport=server_transport)
+    client = InternetCommunicationClient(client_transport.address, server_transport.address, transport=client_transport)
+
+    client.send_reliable(messages.JoinGameMessage("test"))
+    networksimulator.pump([client, server])
+    networksimulator.pump([server, client])
+    assert client.id in server.connected_players
+    return network, server, client
+
+def test_packets_from_other_addresses_are_ignored():
+    network, server, client = create_connected_pair()
+    packet = wirecodec.encode_packet(wirecodec.encode_message(messages.GoToLobbyNotification()))
+
+    client.handle_packet(packet, ("somebody", 1))
+
+    assert client.poll_messages() == []
+
+def test_unexpected_message_types_from_the_server_are_dropped():
+    network, server, client = create_connected_pair()
+    packet = wirecodec.encode_packet(wirecodec.encode_message(messages.MousePositionUpdate(messages.Vec2d(0, 0))))
+
+    client.handle_packet(packet, server.socket.address)
+
+    assert client.poll_messages() == []
+
+def test_client_keeps_receiving_after_an_unexpected_message():
+    network, server, client = create_connected_pair()
+    packet = wirecodec.encode_packet(wirecodec.encode_message(messages.MousePositionUpdate(messages.Vec2d(0, 0))))
+    client.handle_packet(packet, server.socket.address)
+
+    server.send_to_all_reliable(messages.GoToLobbyNotification())
+    server.flush()
+    networksimulator.pump([client])
+
+    assert [type(message) for message in client.poll_messages()] == [messages.GoToLobbyNotification]
@@ -0,0 +1,33 @@
+import os
+import pytest
+import compression
+import messages
+import wirecodec
+from messages import Vec2d
+
+def test_dictionary_is_found_from_any_working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    assert len(compression.Compressor().dictionary) > 0
+
+def test_missing_dictionary_is_an_error(tmp_path):
+    with pytest.raises(Exception):
+        compression.load_dictionary(os.path.join(tmp_path, "missing.bin"))
+
+def test_round_trip():
+    compressor = compression.Compressor()
+    arena_update = messages.ArenaUpdate({i: messages.WallUpdate(Vec2d(i, 0), Vec2d(0.5, 4), 100.0, 100.0) for i in range(20)})
+    encoded_message = wirecodec.encode_message(arena_update)
+
+    compressed_message = compressor.compress(encoded_message, "ArenaUpdate")
+
+    assert compressed_message != None
+    assert compressor.decompress(compressed_message) == wirecodec.decode_complete_message(encoded_message)
+
+def test_different_dictionary_is_rejected():
+    encoded_message = wirecodec.encode_message(messages.LobbyStateUpdate(["player"] * 40, None))
+    compressed_message = compression.Compressor(b"").compress(encoded_message, "LobbyStateUpdate")
+    assert compressed_message != None
+
+    with pytest.raises(wirecodec.WireFormatError):
+        compression.Compressor().decompress(compressed_message)
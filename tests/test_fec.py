@@ -0,0 +1,125 @@
+from time import time, sleep
+import pytest
+import communication
+import fec
+import messages
+import networksimulator
+import wirecodec
+from wirecodec import FecHeader
+
+MAX_MESSAGE_DATA_SIZE = 100
+TIMEOUT = 5 # in seconds
+
+def encode_group(message_datas: list[bytes]) -> tuple[list[FecHeader], FecHeader, bytes]:
+    encoder = fec.FecEncoder()
+    headers = [encoder.add(message_data) for message_data in message_datas]
+    parity_header, parity = encoder.take_parity()
+    return headers, parity_header, parity
+
+def test_lost_packet_is_recovered():
+    message_datas = [b"first", b"the second one", b"", b"4th"]
+    for lost_index in range(len(message_datas)):
+        headers, parity_header, parity = encode_group(message_datas)
+        decoder = fec.FecDecoder(MAX_MESSAGE_DATA_SIZE)
+
+        for index, message_data in enumerate(message_datas):
+            if index != lost_index:
+                assert decoder.add(headers[index], message_data) == None
+        assert decoder.add(parity_header, parity) == message_datas[lost_index]
+        assert decoder.recovered_packet_count == 1
+
+def test_parity_arriving_first_recovers_the_last_missing_packet():
+    message_datas = [b"a", b"bb", b"ccc"]
+    headers, parity_header, parity = encode_group(message_datas)
+    decoder = fec.FecDecoder(MAX_MESSAGE_DATA_SIZE)
+
+    assert decoder.add(parity_header, parity) == None
+    assert decoder.add(headers[2], message_datas[2]) == None
+    assert decoder.add(headers[0], message_datas[0]) == message_datas[1]
+    assert decoder.add(headers[1], message_datas[1]) == None # arrived after all
+
+def test_complete_group_recovers_nothing():
+    message_datas = [b"a", b"bb"]
+    headers, parity_header, parity = encode_group(message_datas)
+    decoder = fec.FecDecoder(MAX_MESSAGE_DATA_SIZE)
+
+    for header, message_data in zip(headers, message_datas):
+        decoder.add(header, message_data)
+
+    assert decoder.add(parity_header, parity) == None
+    assert decoder.add(parity_header, parity) == None # duplicate
+    assert decoder.recovered_packet_count == 0
+
+def test_two_lost_packets_are_left_to_the_resends():
+    message_datas = [b"a", b"bb", b"ccc"]
+    headers, parity_header, parity = encode_group(message_datas)
+    decoder = fec.FecDecoder(MAX_MESSAGE_DATA_SIZE)
+
+    assert decoder.add(headers[0], message_datas[0]) == None
+    assert decoder.add(parity_header, parity) == None
+    assert decoder.recovered_packet_count == 0
+
+@pytest.mark.parametrize("header, message_data", [
+    (FecHeader(0, 0, is_parity=True), b"\0\0"), # no packets in the group
+    (FecHeader(0, fec.FEC_GROUP_SIZE + 1, is_parity=True), b"\0\0"),
+    (FecHeader(0, 1, is_parity=True), b"\0"), # shorter than a length
+    (FecHeader(0, 1, is_parity=True), bytes(fec.LENGTH.size + MAX_MESSAGE_DATA_SIZE + 1)), # longer than a packet
+    (FecHeader(0, fec.FEC_GROUP_SIZE), b"data")
+])
+def test_malformed_header_is_rejected(header, message_data):
+    decoder = fec.FecDecoder(MAX_MESSAGE_DATA_SIZE)
+
+    with pytest.raises(wirecodec.WireFormatError):
+        decoder.add(header, message_data)
+
+def test_packet_outside_its_parity_group_is_rejected():
+    headers, parity_header, parity = encode_group([b"a", b"bb"])
+    decoder = fec.FecDecoder(MAX_MESSAGE_DATA_SIZE)
+    decoder.add(parity_header, parity)
+
+    with pytest.raises(wirecodec.WireFormatError):
+        decoder.add(FecHeader(parity_header.group_id, 2), b"ccc")
+    assert decoder.add(headers[0], b"a") == None # the group is given up on
+
+def test_parity_not_matching_its_group_is_rejected():
+    decoder = fec.FecDecoder(MAX_MESSAGE_DATA_SIZE)
+    decoder.add(FecHeader(0, 3), b"data")
+
+    with pytest.raises(wirecodec.WireFormatError):
+        decoder.add(FecHeader(0, 2, is_parity=True), b"\0\0\0\0\0\0")
+
+def test_parity_shorter_than_its_packets_is_rejected():
+    decoder = fec.FecDecoder(MAX_MESSAGE_DATA_SIZE)
+    decoder.add(FecHeader(0, 0), b"long packet")
+    decoder.add(FecHeader(0, 1), b"another long packet")
+
+    with pytest.raises(wirecodec.WireFormatError):
+        decoder.add(FecHeader(0, 3, is_parity=True), b"\0\0\0")
+
+def test_lossy_link_is_recovered_without_resends(monkeypatch):
+    monkeypatch.setattr(communication, "RELIABLE_FEC_ENABLED", True)
+    network = networksimulator.SimulatedNetwork(seed=1)
+    server_transport = network.create_transport()
+    client_transport = network.create_transport()
+    server = communication.CommunicationServer(server_transport.address, transport=server_transport)
+    client = communication.InternetCommunicationClient(client_transport.address, server_transport.address, transport=client_transport)
+    client.send_reliable(messages.JoinGameMessage("test"))
+    deadline = time() + TIMEOUT
+    while client.id not in server.connected_players and time() < deadline:
+        networksimulator.pump([client, server])
+        sleep(0.002)
+
+    network.set_link_conditions(server_transport.address, client_transport.address, networksimulator.LinkConditions(loss=0.1))
+    received = []
+    for i in range(200):
+        server.send_reliable_to(messages.NewPlayerNotification(i, "player"), client.id)
+        server.flush()
+        networksimulator.pump([server, client])
+        received += client.poll_messages(messages.NewPlayerNotification)
+    while len(received) < 200 and time() < deadline + TIMEOUT:
+        networksimulator.pump([server, client])
+        received += client.poll_messages(messages.NewPlayerNotification)
+        sleep(0.002)
+
+    assert sorted(message.player_id for message in received) == list(range(200))
+    assert client.server_connection.fec_decoder.recovered_packet_count > 0
@@ -0,0 +1,81 @@
+import random
+from time import time, sleep
+import communication
+import messages
+import networksimulator
+import wirecodec
+
+TIMEOUT = 5 # in seconds
+
+# too big for one packet, and random, so that compression doesn't make it fit
+def create_big_message(seed = 0) -> messages.NewPlayerNotification:
+    generator = random.Random(seed)
+    name = "".join(generator.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(5 * communication.MAX_UNFRAGMENTED_MESSAGE_SIZE))
+    return messages.NewPlayerNotification(1, name)
+
+def pump_until(condition, server, client) -> bool:
+    deadline = time() + TIMEOUT
+    while time() < deadline:
+        networksimulator.pump([client, server])
+        if condition():
+            return True
+        sleep(0.002)
+    return False
+
+def test_reordered_and_duplicated_fragments_are_reassembled():
+    message = create_big_message()
+    fragments = communication.split_into_fragments(message, 0)
+    assert len(fragments) > 2
+    reassembler = communication.FragmentReassembler()
+
+    arrival_order = list(reversed(fragments)) + fragments[:-1]
+    reassembled = [reassembler.add(fragment) for fragment in arrival_order]
+
+    assert reassembled[:len(fragments) - 1] == [None] * (len(fragments) - 1)
+    assert wirecodec.decode_complete_message(reassembled[len(fragments) - 1]) == message
+    assert reassembled[len(fragments):] == [None] * (len(fragments) - 1) # late duplicates start a message that never completes
+
+def test_interleaved_messages_are_reassembled_separately():
+    first, second = create_big_message(0), create_big_message(1)
+    first_fragments = communication.split_into_fragments(first, 0)
+    second_fragments = communication.split_into_fragments(second, 1)
+    reassembler = communication.FragmentReassembler()
+
+    reassembled = []
+    for first_fragment, second_fragment in zip(first_fragments, second_fragments):
+        reassembled += [reassembler.add(second_fragment), reassembler.add(first_fragment)]
+
+    complete = [wirecodec.decode_complete_message(data) for data in reassembled if data != None]
+    assert complete == [second, first]
+    assert reassembler.partial_messages == {}
+
+def test_invalid_fragments_are_dropped():
+    reassembler = communication.FragmentReassembler()
+    fragment = communication.MessageFragment(0, 0, 2, b"data")
+
+    assert reassembler.add(communication.MessageFragment(0, 2, 2, b"data")) == None # index out of range
+    assert reassembler.add(communication.MessageFragment(0, 0, communication.MAX_FRAGMENT_COUNT + 1, b"data")) == None
+    assert reassembler.add(fragment) == None
+    assert reassembler.add(communication.MessageFragment(0, 1, 3, b"data")) == None # inconsistent fragment count
+    assert reassembler.add(communication.MessageFragment(0, 1, 2, b"more")) == b"datamore"
+
+def test_big_message_arrives_over_a_bad_link():
+    network = networksimulator.SimulatedNetwork()
+    server_transport = network.create_transport()
+    client_transport = network.create_transport()
+    server = communication.CommunicationServer(server_transport.address, transport=server_transport)
+    client = communication.InternetCommunicationClient(client_transport.address, server_transport.address, transport=client_transport)
+    client.send_reliable(messages.JoinGameMessage("test"))
+    assert pump_until(lambda: client.id in server.connected_players, server, client)
+
+    network.set_link_conditions(server_transport.address, client_transport.address, networksimulator.LinkConditions(loss=0.2, reordering=0.3, duplication=0.2))
+    message = create_big_message()
+    server.send_reliable_to(message, client.id)
+    server.flush()
+
+    received = []
+    def receive():
+        received.extend(client.poll_messages(messages.NewPlayerNotification))
+        return len(received) > 0
+    assert pump_until(receive, server, client)
+    assert received == [message]
@@ -0,0 +1,70 @@
+import socket
+from time import time, sleep
+import pytest
+import communication
+import messages
+from messages import Vec2d
+
+LOOPBACK_IP = "127.0.0.1"
+TIMEOUT = 5 # in seconds
+
+def get_free_port() -> int:
+    with socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM) as probe:
+        probe.bind((LOOPBACK_IP, 0))
+        return probe.getsockname()[1]
+
+def wait_until(condition, step) -> bool:
+    deadline = time() + TIMEOUT
+    while time() < deadline:
+        step()
+        if condition():
+            return True
+        sleep(0.01)
+    return False
+
+@pytest.fixture
+def group_address():
+    address = (communication.DEFAULT_MULTICAST_GROUP, get_free_port())
+    try:
+        communication.create_multicast_socket(address, LOOPBACK_IP).socket.close()
+    except OSError as exception:
+        pytest.skip(f"no multicast on loopback: {exception}")
+    return address
+
+# one server publishing to the group, two clients subscribed to it
+def test_loopback_multicast_reaches_every_subscriber(group_address):
+    server = communication.CommunicationServer((LOOPBACK_IP, 0), start=True, multicast_address=group_address)
+    server_address = server.socket.socket.getsockname()
+    clients = [communication.InternetCommunicationClient((LOOPBACK_IP, 0), server_address, start=True) for _ in range(2)]
+
+    try:
+        for client in clients:
+            client.send_reliable(messages.JoinGameMessage("test"))
+        assert wait_until(lambda: len(server.get_multicast_subscribers()) == 2, server.flush), "the clients didn't subscribe"
+
+        bullet = messages.BulletStateUpdate(1, Vec2d(1, 2), 0.1)
+        received = {client.id: [] for client in clients}
+        def publish():
+            server.send_multicast_snapshot([bullet])
+            server.flush()
+            for client in clients:
+                received[client.id] += client.poll_messages(messages.BulletStateUpdate)
+        assert wait_until(lambda: all(len(client_messages) > 0 for client_messages in received.values()), publish), "a subscriber didn't get the snapshot"
+
+        for client in clients:
+            assert received[client.id][0].bullet_id == 1
+            assert server.connected_players[client.id].is_multicast_subscriber # still subscribed, so it acks the multicast snapshots
+            assert server.connected_players[client.id].snapshot_sender.next_snapshot_id == 0 # nothing over unicast
+    finally:
+        for client in clients:
+            client.stop(asyncronous=True)
+        server.stop(asyncronous=True)
+
+def test_group_on_the_client_port_is_not_joined():
+    client_port = get_free_port()
+    client = communication.InternetCommunicationClient((LOOPBACK_IP, client_port), (LOOPBACK_IP, get_free_port()))
+
+    client.join_multicast_group((communication.DEFAULT_MULTICAST_GROUP, client_port))
+
+    assert client.multicast_socket == None
+    client.socket.socket.close()
@@ -0,0 +1,83 @@
+import math
+import pytest
+from pymunk import Vec2d
+import messages
+import wirecodec
+from game import arenaprops
+from game.camera import OWNING_PLAYER_BB_RADIUS
+
+MAX_WINDOW_HEIGHT = 2160 # in pixels, a 4K screen
+MIN_VIEW_HEIGHT = 2 * OWNING_PLAYER_BB_RADIUS # in world units, the camera never zooms in further than this
+MAX_PIXELS_PER_UNIT = MAX_WINDOW_HEIGHT / MIN_VIEW_HEIGHT
+
+PROFILES = {
+    "position": messages.POSITION_QUANTIZATION,
+    "angle": messages.ANGLE_QUANTIZATION,
+    "health": messages.HEALTH_QUANTIZATION,
+    "radius": messages.RADIUS_QUANTIZATION
+}
+
+def get_error(profile: messages.QuantizationProfile, value: float) -> float:
+    error = abs(profile.dequantize(profile.quantize(value)) - value)
+    if profile.is_periodic:
+        error = min(error, profile.max_value - profile.min_value - error)
+    return error
+
+def get_max_error(profile: messages.QuantizationProfile) -> float:
+    return profile.step if profile.round_up else profile.step / 2
+
+# the ends of the range, and the values right next to them and halfway between steps
+def get_extreme_values(profile: messages.QuantizationProfile) -> list[float]:
+    top = profile.max_value if profile.is_periodic else profile.max_value - profile.step
+    values = [profile.min_value, top, (profile.min_value + top) / 2]
+    for offset in (1e-9, profile.step / 2, profile.step * 0.499, profile.step * 0.501):
+        values += [profile.min_value + offset, top - offset]
+    return values
+
+@pytest.mark.parametrize("name", PROFILES)
+def test_round_trip_error_at_extremes(name):
+    profile = PROFILES[name]
+    for value in get_extreme_values(profile):
+        assert get_error(profile, value) <= get_max_error(profile) + 1e-12, f"{name} {value}"
+
+@pytest.mark.parametrize("name", PROFILES)
+def test_quantize_stays_in_index_range(name):
+    profile = PROFILES[name]
+    for value in get_extreme_values(profile) + [profile.min_value - 1e6, profile.max_value + 1e6]:
+        assert 0 <= profile.quantize(value) <= profile.max_index
+
+def test_values_outside_range_are_clamped():
+    profile = messages.POSITION_QUANTIZATION
+    assert profile.dequantize(profile.quantize(1e6)) == profile.dequantize(profile.max_index)
+    assert profile.dequantize(profile.quantize(-1e6)) == profile.min_value
+
+def test_angles_wrap_around():
+    profile = messages.ANGLE_QUANTIZATION
+    for angle in (-math.pi, 3 * math.pi, math.tau - 1e-9, 100.0):
+        received = profile.dequantize(profile.quantize(angle))
+        difference = (received - angle) % math.tau
+        assert min(difference, math.tau - difference) <= profile.step / 2
+
+def test_health_is_never_rounded_down():
+    profile = messages.HEALTH_QUANTIZATION
+    assert profile.dequantize(profile.quantize(0)) == 0
+    for health in (1e-9, profile.step / 2, 0.5, 1, -0.5, -1e-9):
+        assert profile.dequantize(profile.quantize(health)) >= health
+
+def test_position_error_is_below_a_pixel_at_max_zoom():
+    profile = messages.POSITION_QUANTIZATION
+    worst_error = max(get_error(profile, value) for value in get_extreme_values(profile))
+    assert worst_error * MAX_PIXELS_PER_UNIT < 1
+
+    # through the codec, anywhere in the arena
+    steps = 50
+    for i in range(steps + 1):
+        for j in range(steps + 1):
+            position = Vec2d(-arenaprops.ARENA_RADIUS, -arenaprops.ARENA_RADIUS) + 2 * arenaprops.ARENA_RADIUS * Vec2d(i, j) / steps + Vec2d(1e-3, 7e-4)
+            received = wirecodec.decode_complete_message(wirecodec.encode_message(messages.MousePositionUpdate(position)))
+            assert (received.mouse_position_world_space - position).length * MAX_PIXELS_PER_UNIT < 1
+
+def test_mouse_outside_arena_is_not_clamped():
+    position = Vec2d(2 * arenaprops.ARENA_RADIUS, -2 * arenaprops.ARENA_RADIUS)
+    received = wirecodec.decode_complete_message(wirecodec.encode_message(messages.MousePositionUpdate(position)))
+    assert (received.mouse_position_world_space - position).length < messages.POSITION_QUANTIZATION.step
@@ -0,0 +1,55 @@
+from time import time, sleep
+import communication
+import messages
+import networksimulator
+import ratelimiting
+
+TIMEOUT = 5 # in seconds
+
+def create_pair():
+    network = networksimulator.SimulatedNetwork()
+    server_transport = network.create_transport()
+    client_transport = network.create_transport()
+    server = communication.CommunicationServer(server_transport.address, transport=server_transport)
+    client = communication.InternetCommunicationClient(client_transport.address, server_transport.address, transport=client_transport)
+    return server, client
+
+# pumps until the server's game has got message_count messages, and returns them
+def receive_all(server, client, message_count: int) -> list:
+    received = []
+    deadline = time() + TIMEOUT
+    while len(received) < message_count and time() < deadline:
+        networksimulator.pump([client, server])
+        received += server.poll_messages(messages.LobbyMessage)
+        sleep(0.005)
+    return received
+
+def test_token_bucket_refills():
+    bucket = ratelimiting.TokenBucket(rate=1000, burst=2)
+    assert bucket.try_take() and bucket.try_take()
+    assert not bucket.try_take()
+    sleep(0.01)
+    assert bucket.try_take()
+
+def test_throttled_reliable_messages_are_resent(monkeypatch):
+    monkeypatch.setitem(ratelimiting.MESSAGE_RATE_LIMITS, messages.EnterLobbyMessage, (20, 2))
+    server, client = create_pair()
+    for i in range(6):
+        client.send_reliable(messages.EnterLobbyMessage(f"player {i}"))
+
+    received = receive_all(server, client, 6)
+
+    assert sorted(message.payload.player_name for message in received) == [f"player {i}" for i in range(6)]
+    assert server.connected_players[client.id].rate_limiter.get_dropped_count() > 0
+
+def test_capped_reliable_messages_are_resent(monkeypatch):
+    monkeypatch.setattr(communication, "MAX_QUEUED_MESSAGES_PER_PLAYER", 2)
+    server, client = create_pair()
+    for i in range(5):
+        client.send_reliable(messages.EnterLobbyMessage(f"player {i}"))
+
+    networksimulator.pump([client, server])
+    assert len(server.poll_messages(messages.LobbyMessage)) <= 2 # more didn't fit
+
+    received = receive_all(server, client, 3)
+    assert len(received) == 3
@@ -0,0 +1,151 @@
+import threading
+from time import time, sleep
+import communication
+import messages
+import networksimulator
+import wirecodec
+from communication import ReceivedSequenceWindow, RECEIVED_SEQUENCE_WINDOW_SIZE
+
+TIMEOUT = 5 # in seconds
+
+# a server and a connected client on a simulated network, driven with networksimulator.pump
+def create_pair(conditions = networksimulator.PERFECT_LINK):
+    network = networksimulator.SimulatedNetwork(conditions)
+    server_transport = network.create_transport()
+    client_transport = network.create_transport()
+    server = communication.CommunicationServer(server_transport.address, transport=server_transport)
+    client = communication.InternetCommunicationClient(client_transport.address, server_transport.address, transport=client_transport)
+
+    client.send_reliable(messages.JoinGameMessage("test"))
+    assert pump_until(lambda: client.id in server.connected_players, server, client)
+    server.poll_messages()
+    return network, server, client
+
+def pump_until(condition, server, client) -> bool:
+    deadline = time() + TIMEOUT
+    while time() < deadline:
+        networksimulator.pump([client, server])
+        if condition():
+            return True
+        sleep(0.002)
+    return False
+
+def test_window_accepts_each_sequence_once():
+    window = ReceivedSequenceWindow()
+
+    assert window.add(0)
+    assert window.add(1)
+    assert not window.add(1)
+    assert not window.add(0)
+
+def test_window_accepts_reordered_sequences():
+    window = ReceivedSequenceWindow()
+    assert window.add(5)
+
+    assert window.add(3)
+    assert window.add(4)
+    assert not window.add(3)
+    assert window.contains(5) and window.contains(4) and window.contains(3)
+    assert not window.contains(2)
+    assert not window.contains(6)
+
+def test_window_slides_past_its_size():
+    window = ReceivedSequenceWindow()
+    for sequence in range(3 * RECEIVED_SEQUENCE_WINDOW_SIZE):
+        if sequence != 2 * RECEIVED_SEQUENCE_WINDOW_SIZE:
+            assert window.add(sequence)
+
+    newest = 3 * RECEIVED_SEQUENCE_WINDOW_SIZE - 1
+    assert window.add(2 * RECEIVED_SEQUENCE_WINDOW_SIZE) # the gap is still in the window
+    assert not window.add(newest - RECEIVED_SEQUENCE_WINDOW_SIZE + 1) # the oldest one in the window
+    assert not window.add(newest - RECEIVED_SEQUENCE_WINDOW_SIZE) # too old to tell, taken as a duplicate
+    assert window.received_mask < 1 << RECEIVED_SEQUENCE_WINDOW_SIZE
+
+def test_jump_over_the_window_forgets_older_sequences():
+    window = ReceivedSequenceWindow()
+    window.add(0)
+    window.add(2)
+
+    assert window.add(2 + RECEIVED_SEQUENCE_WINDOW_SIZE)
+    assert window.received_mask == 1
+    assert not window.add(1) # too old to tell
+
+def test_duplicated_packets_deliver_each_message_once():
+    network, server, client = create_pair(networksimulator.LinkConditions(duplication=1))
+    for i in range(20):
+        server.send_reliable_to(messages.NewPlayerNotification(i, "player"), client.id)
+    server.flush()
+
+    received = []
+    def receive():
+        received.extend(client.poll_messages(messages.NewPlayerNotification))
+        return server.unconfirmed_message_storage.get_count(client.socket.address) == 0
+    assert pump_until(receive, server, client)
+
+    assert sorted(message.player_id for message in received) == list(range(20))
+
+def test_ack_header_round_trip():
+    ack_header = wirecodec.AckHeader(1000, 1 | 1 << 31, [5, 900])
+    packet = wirecodec.encode_packet(b"data", ack_header)
+
+    decoded_ack_header, fec_header, message_data = wirecodec.decode_packet_header(packet)
+
+    assert decoded_ack_header == ack_header
+    assert fec_header == None
+    assert message_data == b"data"
+    assert sorted(decoded_ack_header.get_acked_sequences()) == [5, 900, 968, 999, 1000]
+
+def test_ack_bitfield_covers_the_received_sequences():
+    connection = communication.Connection(("peer", 1))
+    for sequence in (100, 99, 97, 68, 67):
+        connection.receive_reliable_sequence(sequence)
+
+    ack_header = connection.take_ack_header()
+
+    assert ack_header.newest_sequence == 100
+    assert ack_header.previous_sequences == 1 << 0 | 1 << 2 | 1 << 31 # 99, 97 and 68
+    assert ack_header.extra_sequences == [67]
+    assert connection.take_ack_header().extra_sequences == [] # extra acks are sent once
+
+def test_acks_confirm_the_messages():
+    storage = communication.UncofirmedMessageStorage()
+    connection = communication.Connection(("peer", 1))
+    for sequence in range(40):
+        storage.add_message(sequence, b"message", connection)
+
+    storage.receive_acks(wirecodec.AckHeader(39, (1 << 32) - 1, [3]), connection.address)
+
+    assert storage.get_count(connection.address) == 40 - 34
+
+def test_lossy_link_delivers_every_message():
+    network, server, client = create_pair()
+    network.set_link_conditions(server.socket.address, client.socket.address, networksimulator.LinkConditions(loss=0.3, reordering=0.2))
+    for i in range(50):
+        server.send_reliable_to(messages.NewPlayerNotification(i, "player"), client.id)
+    server.flush()
+
+    received = []
+    def receive():
+        received.extend(client.poll_messages(messages.NewPlayerNotification))
+        return server.unconfirmed_message_storage.get_count(client.socket.address) == 0
+    assert pump_until(receive, server, client)
+
+    assert sorted(message.player_id for message in received) == list(range(50))
+
+def test_added_message_wakes_the_resend_thread():
+    storage = communication.UncofirmedMessageStorage()
+    connection = communication.Connection(("peer", 1))
+    woken = threading.Event()
+
+    def wait():
+        storage.wait_for_next_deadline(max_sleep=10)
+        woken.set()
+
+    thread = threading.Thread(target=wait, daemon=True)
+    thread.start()
+    sleep(0.05)
+    start_time = time()
+    storage.add_message(0, b"message", connection)
+
+    assert woken.wait(timeout=5)
+    assert time() - start_time < 1
@@ -0,0 +1,82 @@
+import messages
+import snapshot
+from messages import Vec2d
+
+MAX_MESSAGE_SIZE = 1200
+
+def bullet(bullet_id: int, x: float):
+    return messages.BulletStateUpdate(bullet_id, Vec2d(x, 0), 0.1)
+
+# sends the state to the receiver, and returns what the game gets: ({entity id: x}, removed entity ids, completed snapshot id)
+def transmit(sender: snapshot.SnapshotSender, receiver: snapshot.SnapshotReceiver, state_messages: list, ack = True, max_message_size = MAX_MESSAGE_SIZE):
+    positions = {}
+    removed_entity_ids = []
+    completed_snapshot_id = None
+    for delta in sender.get_delta_messages(state_messages, max_message_size):
+        part_messages, part_removed_entity_ids, part_completed_snapshot_id = receiver.receive(delta)
+        positions.update({message.bullet_id: message.position.x for message in part_messages})
+        removed_entity_ids += part_removed_entity_ids
+        if part_completed_snapshot_id != None:
+            completed_snapshot_id = part_completed_snapshot_id
+
+    if ack and completed_snapshot_id != None:
+        sender.receive_ack(completed_snapshot_id)
+    return positions, removed_entity_ids, completed_snapshot_id
+
+def test_only_changes_are_delivered():
+    sender, receiver = snapshot.SnapshotSender(), snapshot.SnapshotReceiver()
+    transmit(sender, receiver, [bullet(1, 1.0), bullet(2, 2.0)])
+
+    positions, removed_entity_ids, _ = transmit(sender, receiver, [bullet(1, 1.0), bullet(2, 3.0)])
+
+    assert positions.keys() == {2}
+    assert removed_entity_ids == []
+
+def test_change_in_unacked_snapshot_is_undone():
+    sender, receiver = snapshot.SnapshotSender(), snapshot.SnapshotReceiver()
+    transmit(sender, receiver, [bullet(1, 1.0)])
+    positions, _, _ = transmit(sender, receiver, [bullet(1, 2.0)], ack=False)
+    assert positions[1] > 1.9
+
+    # no change against the acked baseline, but the game has the value of the unacked snapshot
+    positions, _, _ = transmit(sender, receiver, [bullet(1, 1.0)])
+
+    assert abs(positions[1] - 1.0) < messages.POSITION_QUANTIZATION.step
+
+def test_entity_of_unacked_snapshot_is_removed():
+    sender, receiver = snapshot.SnapshotSender(), snapshot.SnapshotReceiver()
+    transmit(sender, receiver, [bullet(1, 1.0)])
+    transmit(sender, receiver, [bullet(1, 1.0), bullet(2, 2.0)], ack=False)
+
+    positions, removed_entity_ids, _ = transmit(sender, receiver, [bullet(1, 1.0)])
+
+    assert positions == {}
+    assert removed_entity_ids == [2]
+
+def test_carried_over_entities_are_delivered_when_the_snapshot_completes():
+    sender, receiver = snapshot.SnapshotSender(), snapshot.SnapshotReceiver()
+    bullets = [bullet(id, 1.0) for id in range(100)]
+    transmit(sender, receiver, bullets)
+    transmit(sender, receiver, [bullet(0, 2.0)] + bullets[1:], ack=False)
+
+    moved_bullets = [bullet(id, 1.0 if id == 0 else 3.0) for id in range(100)]
+    deltas = sender.get_delta_messages(moved_bullets, MAX_MESSAGE_SIZE // 2)
+    assert len(deltas) > 1
+    delivered_ids = []
+    for delta in deltas:
+        part_messages, _, _ = receiver.receive(delta)
+        delivered_ids += [message.bullet_id for message in part_messages]
+
+    assert sorted(delivered_ids) == list(range(100))
+
+def test_older_snapshot_delivers_nothing():
+    sender, receiver = snapshot.SnapshotSender(), snapshot.SnapshotReceiver()
+    transmit(sender, receiver, [bullet(1, 1.0)])
+    older = sender.get_delta_messages([bullet(1, 2.0)], MAX_MESSAGE_SIZE)
+    newer = sender.get_delta_messages([bullet(1, 3.0)], MAX_MESSAGE_SIZE)
+
+    receiver.receive(newer[0])
+    part_messages, _, completed_snapshot_id = receiver.receive(older[0])
+
+    assert part_messages == []
+    assert completed_snapshot_id == older[0].snapshot_id
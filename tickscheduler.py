@@ -0,0 +1,112 @@
+import threading
+from time import perf_counter, sleep
+from typing import Callable, Optional
+import networkstatistics
+
+MAX_CATCH_UP_TICKS = 5 # how many late ticks are run back to back at most, a longer backlog is skipped
+SPIN_TIME = 0.002 # in seconds, the end of a wait polls the clock instead of sleeping, because sleep can overshoot
+SKIP_WARNING_INTERVAL = 5 # in seconds, at most one warning about skipped ticks per this long
+
+# fixed timestep tick scheduling:
+# tick i is due at start time + i * interval (perf_counter). After every wait, all the ticks that are due by now are run,
+# so a late tick doesn't shift the schedule, and the simulated time (ticks * interval) keeps up with the wall time.
+# If more than MAX_CATCH_UP_TICKS are due, the rest are skipped: the simulated time falls behind, and the statistics
+# (and a warning) tell how much. Every tick's duration and lateness is recorded, a tick that takes longer than the interval
+# is an overrun. A wait sleeps until SPIN_TIME before the deadline, and yields in a loop for the rest.
+# Doesn't depend on pygame, so the server can run headless
+
+class TickStatistics:
+
+    def __init__(self):
+        self.durations = networkstatistics.RollingWindow() # in seconds
+        self.lateness = networkstatistics.RollingWindow() # in seconds, how long after its due time a tick started
+
+        # totals since the start
+        self.lock = threading.Lock()
+        self.tick_count = 0
+        self.overrun_count = 0 # took longer than the interval
+        self.caught_up_count = 0 # run right after the previous tick, to catch up
+        self.skipped_count = 0
+
+    def on_tick(self, duration: float, lateness: float, interval: float, was_caught_up: bool):
+        self.durations.add(duration)
+        self.lateness.add(lateness)
+        with self.lock:
+            self.tick_count += 1
+            if duration > interval:
+                self.overrun_count += 1
+            if was_caught_up:
+                self.caught_up_count += 1
+
+    def on_skipped(self, count: int):
+        with self.lock:
+            self.skipped_count += count
+
+    # times are in milli seconds. Drift is how far the simulated time is behind the wall time
+    def to_dict(self, interval: float) -> dict:
+        return {
+            "tick_ms": {f"p{p}": None if d == None else 1000 * d for p, d in self.durations.get_percentiles().items()},
+            "lateness_ms": {f"p{p}": None if l == None else 1000 * l for p, l in self.lateness.get_percentiles().items()},
+            "ticks_per_s": self.durations.get_count() / networkstatistics.STATISTICS_WINDOW,
+            "total_ticks": self.tick_count,
+            "total_overruns": self.overrun_count,
+            "total_caught_up_ticks": self.caught_up_count,
+            "total_skipped_ticks": self.skipped_count,
+            "drift_ms": 1000 * self.skipped_count * interval
+        }
+
+class TickScheduler:
+
+    def __init__(self, tick_rate: float, tick: Callable[[], None], max_catch_up_ticks = MAX_CATCH_UP_TICKS):
+        self.interval = 1 / tick_rate
+        self.tick = tick
+        self.max_catch_up_ticks = max_catch_up_ticks
+        self.next_tick_time: Optional[float] = None # perf_counter time, set by the first call
+        self.last_skip_warning_time = -SKIP_WARNING_INTERVAL
+        self.statistics = TickStatistics()
+
+    # runs ticks on the calling thread, until is_running returns false
+    def run(self, is_running: Callable[[], bool]):
+        while is_running():
+            delay = self.run_due_ticks()
+            wait(delay)
+
+    # runs the ticks that are due. Returns how long (in seconds) until the next one is due.
+    # Can also be called from an event loop instead of run
+    def run_due_ticks(self) -> float:
+        now = perf_counter()
+        if self.next_tick_time == None:
+            self.next_tick_time = now
+
+        due_count = int((now - self.next_tick_time) / self.interval) + 1 if now >= self.next_tick_time else 0
+        if due_count > self.max_catch_up_ticks:
+            self.skip(due_count - self.max_catch_up_ticks, now)
+            due_count = self.max_catch_up_ticks
+
+        for i in range(due_count):
+            start_time = perf_counter()
+            lateness = start_time - self.next_tick_time
+            self.next_tick_time += self.interval # before the tick, so that a tick that raises isn't run again
+            self.tick()
+            self.statistics.on_tick(perf_counter() - start_time, lateness, self.interval, was_caught_up=i > 0)
+
+        return max(0.0, self.next_tick_time - perf_counter())
+
+    def skip(self, count: int, now: float):
+        self.next_tick_time += count * self.interval
+        self.statistics.on_skipped(count)
+
+        if now - self.last_skip_warning_time >= SKIP_WARNING_INTERVAL:
+            self.last_skip_warning_time = now
+            print(f"WARNING: Ticks take too long, skipped {count} (total {self.statistics.skipped_count}).")
+
+    def get_statistics(self) -> dict:
+        return self.statistics.to_dict(self.interval)
+
+# sleeps for duration seconds, more precisely than a plain sleep
+def wait(duration: float):
+    deadline = perf_counter() + duration
+    if duration > SPIN_TIME:
+        sleep(duration - SPIN_TIME)
+    while perf_counter() < deadline:
+        sleep(0) # lets other threads (e.g. receiving) run
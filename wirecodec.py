@@ -0,0 +1,559 @@
+import struct
+import pickle
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+from pymunk import Vec2d
+import messages
+
+# binary wire format:
+# packet = [CODEC_VERSION: u8][flags: u8][ack header, if FLAG_ACKS is set][fec header, if FLAG_FEC is set][message][message]...
+# ack header = [newest received reliable sequence: u32][previous 32 sequences, bit i = newest - 1 - i: u32][extra count: u8][extra sequences: u32]...
+# fec header = [group id: u32][index in the group, or the packet count of the group if FLAG_FEC_PARITY is set: u8]
+# a parity packet has the parity of its group in place of messages (see fec.py)
+# message = [type tag: u8][fields of the message, in schema order]
+# every message type must be registered with a schema, which lists its fields and how they are encoded.
+# fixed size fields next to each other are packed with a single struct call.
+# decoding never executes code from the packet, unless the pickle fallback is explicitly enabled.
+
+CODEC_VERSION = 6
+BYTE_ORDER = "<"
+
+PICKLE_FALLBACK_ENABLED = False # debug only: unregistered types are pickled. Allows remote code execution, never enable in a release!
+PICKLE_TAG = 255
+
+class WireFormatError(Exception):
+    pass
+
+class FieldType(ABC):
+
+    @abstractmethod
+    def encode(self, value, buffer: bytearray):
+        pass
+
+    # returns (value, offset after the field)
+    @abstractmethod
+    def decode(self, data, offset: int) -> tuple[Any, int]:
+        pass
+
+# field that maps to a fixed number of struct primitives
+class FixedField(FieldType):
+
+    def __init__(self, struct_format: str, to_primitives: Callable[[Any], tuple], from_primitives: Callable[..., Any]):
+        self.struct_format = struct_format
+        self.struct = struct.Struct(BYTE_ORDER + struct_format)
+        self.primitive_count = len(self.struct.unpack(bytes(self.struct.size)))
+        self.to_primitives = to_primitives
+        self.from_primitives = from_primitives
+
+    def encode(self, value, buffer: bytearray):
+        buffer += self.struct.pack(*self.to_primitives(value))
+
+    def decode(self, data, offset: int):
+        primitives = self.struct.unpack_from(data, offset)
+        return self.from_primitives(*primitives), offset + self.struct.size
+
+    # returns the value the receiver will get
+    def get_received_value(self, value):
+        return self.from_primitives(*self.to_primitives(value))
+
+UINT8   = FixedField("B",  lambda v: (v,), lambda v: v)
+UINT16  = FixedField("H",  lambda v: (v,), lambda v: v)
+UINT32  = FixedField("I",  lambda v: (v,), lambda v: v)
+FLOAT64 = FixedField("d",  lambda v: (v,), lambda v: v)
+VEC2D   = FixedField("dd", lambda v: (v.x, v.y), Vec2d)
+
+INTEGER_FORMATS = {8: "B", 16: "H", 32: "I"}
+
+def quantized_float(profile: messages.QuantizationProfile):
+    return FixedField(
+        INTEGER_FORMATS[profile.bits],
+        lambda v: (profile.quantize(v),),
+        profile.dequantize
+    )
+
+def quantized_vec2d(profile: messages.QuantizationProfile):
+    return FixedField(
+        2 * INTEGER_FORMATS[profile.bits],
+        lambda v: (profile.quantize(v.x), profile.quantize(v.y)),
+        lambda x, y: Vec2d(profile.dequantize(x), profile.dequantize(y))
+    )
+
+POSITION = quantized_vec2d(messages.POSITION_QUANTIZATION)
+ANGLE    = quantized_float(messages.ANGLE_QUANTIZATION)
+HEALTH   = quantized_float(messages.HEALTH_QUANTIZATION)
+RADIUS   = quantized_float(messages.RADIUS_QUANTIZATION)
+
+LENGTH = struct.Struct(BYTE_ORDER + "H")
+
+class StringField(FieldType):
+
+    def encode(self, value: str, buffer: bytearray):
+        encoded = value.encode("utf-8")
+        buffer += LENGTH.pack(len(encoded))
+        buffer += encoded
+
+    def decode(self, data, offset: int):
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        if offset + length > len(data):
+            raise WireFormatError("String exceeds packet.")
+        return bytes(data[offset:offset + length]).decode("utf-8"), offset + length
+
+class BytesField(FieldType):
+
+    def encode(self, value: bytes, buffer: bytearray):
+        buffer += LENGTH.pack(len(value))
+        buffer += value
+
+    def decode(self, data, offset: int):
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        if offset + length > len(data):
+            raise WireFormatError("Bytes exceed packet.")
+        return bytes(data[offset:offset + length]), offset + length
+
+class OptionalField(FieldType):
+
+    def __init__(self, inner: FieldType):
+        self.inner = inner
+
+    def encode(self, value, buffer: bytearray):
+        if value == None:
+            buffer.append(0)
+        else:
+            buffer.append(1)
+            self.inner.encode(value, buffer)
+
+    def decode(self, data, offset: int):
+        is_present = data[offset]
+        if is_present:
+            return self.inner.decode(data, offset + 1)
+        else:
+            return None, offset + 1
+
+class ListField(FieldType):
+
+    def __init__(self, item: FieldType):
+        self.item = item
+
+    def encode(self, value: list, buffer: bytearray):
+        buffer += LENGTH.pack(len(value))
+        for item in value:
+            self.item.encode(item, buffer)
+
+    def decode(self, data, offset: int):
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        output = []
+        for _ in range(length):
+            item, offset = self.item.decode(data, offset)
+            output.append(item)
+        return output, offset
+
+class DictField(FieldType):
+
+    def __init__(self, key: FieldType, value: FieldType):
+        self.key = key
+        self.value = value
+
+    def encode(self, value: dict, buffer: bytearray):
+        buffer += LENGTH.pack(len(value))
+        for k, v in value.items():
+            self.key.encode(k, buffer)
+            self.value.encode(v, buffer)
+
+    def decode(self, data, offset: int):
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        output = {}
+        for _ in range(length):
+            k, offset = self.key.decode(data, offset)
+            v, offset = self.value.decode(data, offset)
+            output[k] = v
+        return output, offset
+
+# encodes a dataclass (without a type tag), field by field
+class StructField(FieldType):
+
+    def __init__(self, data_type: type, fields: list[tuple[str, FieldType]]):
+        self.data_type = data_type
+        self.fields = fields
+        self.segments = compile_segments(fields)
+
+    def encode(self, value, buffer: bytearray):
+        for segment in self.segments:
+            segment.encode(value, buffer)
+
+    def decode(self, data, offset: int):
+        output = self.data_type.__new__(self.data_type) # bypass __init__, so that e.g. ids aren't regenerated
+        for segment in self.segments:
+            offset = segment.decode(data, offset, output)
+        return output, offset
+
+# any registered message, prefixed with its type tag
+class MessageField(FieldType):
+
+    def encode(self, value, buffer: bytearray):
+        encode_message_into(value, buffer)
+
+    def decode(self, data, offset: int):
+        return decode_message(data, offset)
+
+STRING = StringField()
+BYTES = BytesField()
+MESSAGE = MessageField()
+
+class FixedSegment:
+
+    def __init__(self, fields: list[tuple[str, FixedField]]):
+        self.fields = fields
+        self.struct = struct.Struct(BYTE_ORDER + "".join(f.struct_format for _, f in fields))
+
+    def encode(self, value, buffer: bytearray):
+        primitives = []
+        for name, field in self.fields:
+            primitives.extend(field.to_primitives(getattr(value, name)))
+        buffer += self.struct.pack(*primitives)
+
+    def decode(self, data, offset: int, output) -> int:
+        primitives = self.struct.unpack_from(data, offset)
+        i = 0
+        for name, field in self.fields:
+            setattr(output, name, field.from_primitives(*primitives[i:i + field.primitive_count]))
+            i += field.primitive_count
+        return offset + self.struct.size
+
+class VariableSegment:
+
+    def __init__(self, name: str, field: FieldType):
+        self.name = name
+        self.field = field
+
+    def encode(self, value, buffer: bytearray):
+        self.field.encode(getattr(value, self.name), buffer)
+
+    def decode(self, data, offset: int, output) -> int:
+        value, offset = self.field.decode(data, offset)
+        setattr(output, self.name, value)
+        return offset
+
+# merges consecutive fixed size fields, so that they can be packed with one struct call
+def compile_segments(fields: list[tuple[str, FieldType]]):
+    segments = []
+    fixed_run = []
+    for name, field in fields:
+        if isinstance(field, FixedField):
+            fixed_run.append((name, field))
+        else:
+            if len(fixed_run) > 0:
+                segments.append(FixedSegment(fixed_run))
+                fixed_run = []
+            segments.append(VariableSegment(name, field))
+
+    if len(fixed_run) > 0:
+        segments.append(FixedSegment(fixed_run))
+    return segments
+
+@dataclass
+class MessageSchema:
+    tag: int
+    body: StructField
+
+# a message that has already been encoded, e.g. once for all recipients of a broadcast.
+# Can be used in place of any message (also inside MessageFields), and is copied as is
+@dataclass(frozen=True)
+class EncodedMessage:
+    data: bytes
+
+schemas_by_type: dict[type, MessageSchema] = {}
+schemas_by_tag: dict[int, MessageSchema] = {}
+
+def register_message_type(message_type: type, tag: int, fields: list[tuple[str, FieldType]]):
+    assert 0 <= tag < PICKLE_TAG, f"Invalid tag {tag}"
+    assert tag not in schemas_by_tag, f"Tag {tag} is already used by {schemas_by_tag[tag].body.data_type}"
+    assert message_type not in schemas_by_type, f"{message_type} is already registered"
+
+    schema = MessageSchema(tag, StructField(message_type, fields))
+    schemas_by_type[message_type] = schema
+    schemas_by_tag[tag] = schema
+
+def encode_message_into(message, buffer: bytearray):
+    schema = schemas_by_type.get(type(message))
+    if schema != None:
+        buffer.append(schema.tag)
+        schema.body.encode(message, buffer)
+    elif isinstance(message, EncodedMessage):
+        buffer += message.data
+    elif PICKLE_FALLBACK_ENABLED:
+        pickled = pickle.dumps(message)
+        buffer.append(PICKLE_TAG)
+        buffer += struct.pack(BYTE_ORDER + "I", len(pickled))
+        buffer += pickled
+    else:
+        raise WireFormatError(f"{type(message)} has no registered schema.")
+
+def encode_message(message) -> bytes:
+    if isinstance(message, EncodedMessage):
+        return message.data
+    buffer = bytearray()
+    encode_message_into(message, buffer)
+    return bytes(buffer)
+
+# returns (message, offset after the message)
+def decode_message(data, offset: int = 0):
+    tag = data[offset]
+    offset += 1
+
+    schema = schemas_by_tag.get(tag)
+    if schema != None:
+        return schema.body.decode(data, offset)
+    elif tag == PICKLE_TAG and PICKLE_FALLBACK_ENABLED:
+        (length,) = struct.unpack_from(BYTE_ORDER + "I", data, offset)
+        offset += 4
+        return pickle.loads(data[offset:offset + length]), offset + length
+    else:
+        raise WireFormatError(f"Unknown message tag {tag}.")
+
+FLAG_ACKS = 1
+FLAG_FEC = 2
+FLAG_FEC_PARITY = 4
+ACK_BITFIELD_SIZE = 32
+ACK_HEADER = struct.Struct(BYTE_ORDER + "IIB")
+EXTRA_ACK = struct.Struct(BYTE_ORDER + "I")
+FEC_HEADER = struct.Struct(BYTE_ORDER + "IB")
+
+# acknowledges received reliable messages (by sequence number)
+@dataclass
+class AckHeader:
+    newest_sequence: int
+    previous_sequences: int # bitfield, bit i is set if (newest_sequence - 1 - i) has been received
+    extra_sequences: list[int] # acks for sequences older than the bitfield covers
+
+    def get_acked_sequences(self) -> list[int]:
+        output = [self.newest_sequence]
+        output += [self.newest_sequence - 1 - i for i in range(ACK_BITFIELD_SIZE) if (self.previous_sequences >> i) & 1]
+        output += self.extra_sequences
+        return output
+
+# forward error correction group of a packet
+@dataclass
+class FecHeader:
+    group_id: int
+    index: int # of a data packet in the group. For a parity packet, the number of data packets in the group
+    is_parity: bool = False
+
+# message_data: encoded messages, concatenated (or the parity, see FecHeader)
+def encode_packet(message_data: bytes, ack_header: Optional[AckHeader] = None, fec_header: Optional[FecHeader] = None) -> bytes:
+    if ack_header == None and fec_header == None:
+        return bytes((CODEC_VERSION, 0)) + message_data
+
+    flags = 0
+    header = bytearray((CODEC_VERSION, 0))
+    if ack_header != None:
+        flags |= FLAG_ACKS
+        header += ACK_HEADER.pack(ack_header.newest_sequence, ack_header.previous_sequences, len(ack_header.extra_sequences))
+        for sequence in ack_header.extra_sequences:
+            header += EXTRA_ACK.pack(sequence)
+    if fec_header != None:
+        flags |= FLAG_FEC | (FLAG_FEC_PARITY if fec_header.is_parity else 0)
+        header += FEC_HEADER.pack(fec_header.group_id, fec_header.index)
+    header[1] = flags
+    return bytes(header) + message_data
+
+DECODING_ERRORS = (struct.error, IndexError, UnicodeDecodeError, RecursionError)
+
+# data must contain exactly one message, e.g. a reassembled one. Raises WireFormatError if it's malformed
+def decode_complete_message(data):
+    try:
+        message, offset = decode_message(data)
+    except DECODING_ERRORS as exception:
+        raise WireFormatError(f"Malformed message: {exception}") from exception
+    if offset != len(data):
+        raise WireFormatError(f"{len(data) - offset} extra bytes after the message.")
+    return message
+
+# returns (ack header or None, fec header or None, message data). Raises WireFormatError if the header is malformed.
+# If data is a memoryview, so is the message data (no copy)
+def decode_packet_header(data) -> tuple[Optional[AckHeader], Optional[FecHeader], bytes]:
+    try:
+        if len(data) < 2 or data[0] != CODEC_VERSION:
+            raise WireFormatError(f"Unsupported codec version {data[0] if len(data) > 0 else None}.")
+
+        flags = data[1]
+        offset = 2
+        ack_header = None
+        if flags & FLAG_ACKS:
+            newest_sequence, previous_sequences, extra_count = ACK_HEADER.unpack_from(data, offset)
+            offset += ACK_HEADER.size
+            extra_sequences = []
+            for _ in range(extra_count):
+                extra_sequences.append(EXTRA_ACK.unpack_from(data, offset)[0])
+                offset += EXTRA_ACK.size
+            ack_header = AckHeader(newest_sequence, previous_sequences, extra_sequences)
+
+        fec_header = None
+        if flags & FLAG_FEC:
+            group_id, index = FEC_HEADER.unpack_from(data, offset)
+            offset += FEC_HEADER.size
+            fec_header = FecHeader(group_id, index, bool(flags & FLAG_FEC_PARITY))
+
+        return ack_header, fec_header, data[offset:]
+    except DECODING_ERRORS as exception:
+        raise WireFormatError(f"Malformed packet header: {exception}") from exception
+
+# returns the messages of the message data of a packet. Raises WireFormatError if they are malformed
+def decode_messages(message_data) -> list:
+    try:
+        output = []
+        offset = 0
+        while offset < len(message_data):
+            message, offset = decode_message(message_data, offset)
+            output.append(message)
+        return output
+    except DECODING_ERRORS as exception:
+        raise WireFormatError(f"Malformed packet: {exception}") from exception
+
+# returns (ack header or None, all messages of the packet). Raises WireFormatError if the packet is malformed
+def decode_packet(data) -> tuple[Optional[AckHeader], list]:
+    ack_header, fec_header, message_data = decode_packet_header(data)
+    if fec_header != None and fec_header.is_parity:
+        return ack_header, []
+    return ack_header, decode_messages(message_data)
+
+# message schemas (tags must never be reused for a different message)
+
+register_message_type(messages.MessageToServerWithId, 1, [
+    ("sender_id", UINT32),
+    ("payload", MESSAGE)
+])
+register_message_type(messages.MousePositionUpdate, 2, [
+    ("mouse_position_world_space", POSITION)
+])
+register_message_type(messages.PlayerStateUpdate, 3, [
+    ("player_id", UINT32),
+    ("health", HEALTH),
+    ("mouse_position_world_space", POSITION),
+    ("head_orientation", ANGLE),
+    ("head_position", POSITION),
+    ("left_leg_position", POSITION),
+    ("right_leg_position", POSITION),
+    ("left_arm_position", POSITION),
+    ("right_arm_position", POSITION)
+])
+register_message_type(messages.ShootMessage, 4, [
+    ("initial_bullet_position", VEC2D),
+    ("mouse_position_world_space", VEC2D),
+    ("relative_size", FLOAT64)
+])
+register_message_type(messages.BulletStateUpdate, 5, [
+    ("bullet_id", UINT32),
+    ("position", POSITION),
+    ("radius", RADIUS)
+])
+register_message_type(messages.BulletDestroyMessage, 6, [
+    ("bullet_id", UINT32)
+])
+WALL_UPDATE = StructField(messages.WallUpdate, [
+    ("position", POSITION),
+    ("dimensions", VEC2D),
+    ("health", FLOAT64),
+    ("max_health", FLOAT64)
+])
+register_message_type(messages.ArenaUpdate, 7, [
+    ("wall_updates", DictField(UINT32, WALL_UPDATE))
+])
+register_message_type(messages.JoinGameMessage, 8, [
+    ("player_name", STRING)
+])
+register_message_type(messages.NewPlayerNotification, 9, [
+    ("player_id", UINT32),
+    ("player_name", STRING)
+])
+register_message_type(messages.GoToLobbyRequest, 10, [])
+register_message_type(messages.GoToLobbyNotification, 11, [])
+register_message_type(messages.EnterLobbyMessage, 12, [
+    ("player_name", STRING)
+])
+register_message_type(messages.GameStartRequest, 13, [])
+register_message_type(messages.LobbyStateUpdate, 14, [
+    ("connected_player_names", ListField(STRING)),
+    ("time_to_game_start", OptionalField(FLOAT64))
+])
+register_message_type(messages.ViewBoundsUpdate, 15, [
+    ("bottom_left", POSITION),
+    ("top_right", POSITION)
+])
+
+# compares the encoding of the per-tick game messages to pickle (used before this codec), and to sending every
+# quantized field as float64. Also prints the worst reconstruction error of each quantization profile
+if __name__ == "__main__":
+    import math
+    import random
+    import sys
+    from time import perf_counter
+
+    UNQUANTIZED_FIELDS = {POSITION: VEC2D, ANGLE: FLOAT64, HEALTH: FLOAT64, RADIUS: FLOAT64}
+    SAMPLE_COUNT = 1000
+    player_count, bullet_count = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 else (8, 40)
+    rng = random.Random(0)
+
+    def random_position():
+        return Vec2d(rng.uniform(-20, 20), rng.uniform(-20, 20))
+
+    samples = {
+        messages.MousePositionUpdate: [messages.MousePositionUpdate(random_position()) for _ in range(SAMPLE_COUNT)],
+        messages.ViewBoundsUpdate: [messages.ViewBoundsUpdate(random_position(), random_position()) for _ in range(SAMPLE_COUNT)],
+        messages.PlayerStateUpdate: [
+            messages.PlayerStateUpdate(i, rng.uniform(0, 1), random_position(), rng.uniform(0, math.tau), *(random_position() for _ in range(5)))
+            for i in range(SAMPLE_COUNT)
+        ],
+        messages.BulletStateUpdate: [messages.BulletStateUpdate(i, random_position(), rng.uniform(0.1, 1)) for i in range(SAMPLE_COUNT)]
+    }
+
+    sizes = {} # by type, (quantized, unquantized) in bytes
+    for message_type, sample_messages in samples.items():
+        schema = schemas_by_type[message_type]
+        unquantized_body = StructField(message_type, [(name, UNQUANTIZED_FIELDS.get(field, field)) for name, field in schema.body.fields])
+
+        start_time = perf_counter()
+        encoded_messages = [encode_message(message) for message in sample_messages]
+        encoding_time = (perf_counter() - start_time) / SAMPLE_COUNT
+        start_time = perf_counter()
+        for encoded_message in encoded_messages:
+            decode_complete_message(encoded_message)
+        decoding_time = (perf_counter() - start_time) / SAMPLE_COUNT
+        quantized_size = sum(len(encoded_message) for encoded_message in encoded_messages) / SAMPLE_COUNT
+
+        # what the messages cost before this codec
+        start_time = perf_counter()
+        pickled_messages = [pickle.dumps(message) for message in sample_messages]
+        pickling_time = (perf_counter() - start_time) / SAMPLE_COUNT
+        start_time = perf_counter()
+        for pickled_message in pickled_messages:
+            pickle.loads(pickled_message)
+        unpickling_time = (perf_counter() - start_time) / SAMPLE_COUNT
+        pickled_size = sum(len(pickled_message) for pickled_message in pickled_messages) / SAMPLE_COUNT
+
+        unquantized_size = 0
+        for message in sample_messages:
+            buffer = bytearray([schema.tag])
+            unquantized_body.encode(message, buffer)
+            unquantized_size += len(buffer) / SAMPLE_COUNT
+
+        sizes[message_type] = (quantized_size, unquantized_size)
+        print(f"{message_type.__name__}: pickle {pickled_size:.0f} bytes, float64 {unquantized_size:.0f} bytes, quantized {quantized_size:.0f} bytes")
+        print(f"  encoding {1e6 * encoding_time:.1f} us (pickle {1e6 * pickling_time:.1f} us), decoding {1e6 * decoding_time:.1f} us (pickle {1e6 * unpickling_time:.1f} us)")
+
+    (player_size, unquantized_player_size), (bullet_size, unquantized_bullet_size) = sizes[messages.PlayerStateUpdate], sizes[messages.BulletStateUpdate]
+    tick_size = player_count * player_size + bullet_count * bullet_size
+    unquantized_tick_size = player_count * unquantized_player_size + bullet_count * unquantized_bullet_size
+    print(f"full state of {player_count} players and {bullet_count} bullets: {unquantized_tick_size:.0f} -> {tick_size:.0f} bytes per client per tick, before delta compression")
+
+    for name in ("POSITION", "ANGLE", "HEALTH", "RADIUS"):
+        profile: messages.QuantizationProfile = getattr(messages, f"{name}_QUANTIZATION")
+        period = profile.max_value - profile.min_value
+        values = [rng.uniform(profile.min_value, profile.max_value - profile.step) for _ in range(100_000)]
+        errors = (abs(profile.dequantize(profile.quantize(value)) - value) for value in values)
+        worst_error = max(min(error, period - error) if profile.is_periodic else error for error in errors)
+        print(f"{name}: step {profile.step:.2e}, worst error {worst_error:.2e}")